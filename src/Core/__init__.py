@@ -1,4 +1,12 @@
 __author__ = 'Wilson'
 from melody import MelodyEngine, get_percent_valid_notes
 from chords import *
-from song_data import *
\ No newline at end of file
+from song_data import *
+from similarity import SongIndex
+from rng import RandomContext
+from serialize import encode_song, decode_song, write_song, read_song
+from batch import get_transition_matrix, sample_step_progressions, choose_different_enough, walk_melodies, \
+    generate_section_melodies
+from motif import Motif, MotifCache
+from parts import PartEngine, generate_parts
+from scoring import METRICS, score_songs, score_encoded_songs, rank_songs, write_metrics_csv
\ No newline at end of file
@@ -0,0 +1,280 @@
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from music_theory import EIGHTH_TICKS, Note, Pitch, beats_to_ticks
+from chords import CHORD_PROGRESSION_RULES, progression_steps
+from rhythm import iter_rhythm_ticks
+from melody import PITCH_CHANGE
+
+"""
+batch.py
+
+Bulk, NumPy-vectorized versions of the generation steps, for corpus jobs that need thousands of results per call. Each
+works on a whole batch at once - one NumPy operation per step of the result, however big the batch is - instead of
+building one result at a time like the functions they mirror.
+
+A batch of progressions is an int8 array with a row per progression and a column per chord, holding 1-index chord
+steps - the same as the tuples in chords.py, i.e. tuple(batch[i]). Where progressions are different lengths (see
+get_progression_array), rows are padded with zero steps.
+
+A batch of melodies is a pair of arrays with a row per melody and a column per note - note lengths in ticks, and pitches
+as indices into the key's scale_values (see KeyPitchIndex). Melodies are different lengths, so rows are padded with
+zero ticks and a pitch index of -1.
+"""
+
+def _require_numpy():
+    if numpy is None:
+        raise RuntimeError("Batch generation needs NumPy.")
+
+
+def get_transition_matrix():
+    """
+    CHORD_PROGRESSION_RULES as a Markov chain transition matrix - every allowed next step is equally likely, as in
+    chords.get_next_step.
+
+    Returns:
+        (numpy.ndarray): 7x7 floats - matrix[current_step][next_step], where current step 0 is the begin state
+    """
+    _require_numpy()
+    matrix = numpy.zeros((7, 7))
+    for step, next_steps in CHORD_PROGRESSION_RULES.items():
+        matrix[step, next_steps] = 1.0 / len(next_steps)
+    return matrix
+
+
+def _get_cumulative_matrix():
+    cumulative = numpy.cumsum(get_transition_matrix(), axis=1)
+    # Dividing by the row total makes the last allowed step (and every column after it) exactly 1, so a uniform draw
+    # in [0, 1) can't fall past it through rounding
+    return cumulative / cumulative[:, -1:]
+
+
+def sample_step_progressions(count, num_chords, random_state=None):
+    """
+    Bulk version of chords.get_step_progression.
+
+    Args:
+        count (int): Number of progressions
+        num_chords (int): Length of each progression
+        random_state (numpy.random.RandomState): i.e. from RandomContext.get_numpy_random() - numpy's global state
+            by default
+    Returns:
+        (numpy.ndarray): count x num_chords int8 chord steps
+    """
+    _require_numpy()
+    if random_state is None:
+        random_state = numpy.random
+    cumulative = _get_cumulative_matrix()
+    result = numpy.empty((count, num_chords), numpy.int8)
+    steps = numpy.zeros(count, numpy.intp)  # Everything starts in the begin state
+    for i in range(num_chords):
+        draws = random_state.random_sample(count)
+        # The next step is the first one whose cumulative probability is above the draw
+        steps = (draws[:, numpy.newaxis] < cumulative[steps]).argmax(axis=1)
+        result[:, i] = steps
+    return result
+
+
+def get_levenshtein_distances(progressions, progression):
+    """
+    Bulk version of chords.levenshtein_distance.
+
+    Args:
+        progressions (numpy.ndarray): A batch of progressions
+        progression (tuple of int): One progression to compare every progression in the batch with
+    Returns:
+        (numpy.ndarray): The Levenshtein distance from each progression in the batch to progression
+    """
+    _require_numpy()
+    progression = progression_steps(progression)
+    count, length = progressions.shape
+    previous = numpy.tile(numpy.arange(len(progression) + 1), (count, 1))
+    for i in range(1, length + 1):
+        current = numpy.empty_like(previous)
+        current[:, 0] = i
+        column = progressions[:, i - 1]
+        for j in range(1, len(progression) + 1):
+            change = previous[:, j - 1] + (column != progression[j - 1])
+            current[:, j] = numpy.minimum(numpy.minimum(previous[:, j] + 1, current[:, j - 1] + 1), change)
+        previous = current
+    return previous[:, -1]
+
+
+def get_different_enough_mask(progressions, progression):
+    """
+    Bulk version of chords.different_enough.
+
+    Returns:
+        (numpy.ndarray): bool for each progression in the batch - is it sufficiently different from progression?
+    """
+    _require_numpy()
+    progression = progression_steps(progression)
+    mask = progressions[:, 0] != progression[0]
+    candidates = numpy.flatnonzero(mask)  # Only these need the (slower) distance
+    distances = get_levenshtein_distances(progressions[candidates], progression)
+    mask[candidates] = distances.astype(float) / progressions.shape[1] > 0.5
+    return mask
+
+
+def filter_different_enough(progressions, existing):
+    """
+    Returns:
+        (numpy.ndarray): The progressions in the batch that are different enough from all of the existing ones
+    """
+    _require_numpy()
+    mask = numpy.ones(len(progressions), bool)
+    for progression in existing:
+        mask &= get_different_enough_mask(progressions, progression)
+    return progressions[mask]
+
+
+def choose_different_enough(progressions, count, existing=()):
+    """
+    Picks progressions from the batch (in order) that are different enough from each other and from the existing ones -
+    i.e. one for each section of a song, as main.create_chord_progressions does one at a time.
+
+    Returns:
+        (list of tuple of int): Up to count progressions - fewer if the batch runs out
+    """
+    _require_numpy()
+    remaining = filter_different_enough(progressions, existing)
+    chosen = []
+    while len(chosen) < count and len(remaining) > 0:
+        progression = tuple(int(step) for step in remaining[0])
+        chosen.append(progression)
+        remaining = remaining[1:][get_different_enough_mask(remaining[1:], progression)]
+    return chosen
+
+
+def get_rhythm_array(rhythms):
+    """
+    Args:
+        rhythms (list of list of int): Note lengths in ticks, i.e. from rhythm.gen_rhythm_ticks
+    Returns:
+        (numpy.ndarray): The rhythms as a batch, padded with zeros
+    """
+    _require_numpy()
+    result = numpy.zeros((len(rhythms), max([len(rhythm) for rhythm in rhythms])), numpy.int32)
+    for i, rhythm in enumerate(rhythms):
+        result[i, :len(rhythm)] = rhythm
+    return result
+
+
+def get_progression_array(progressions):
+    """
+    Args:
+        progressions (list of tuple of int): i.e. from Song.get_progression
+    Returns:
+        (numpy.ndarray): The progressions as a batch, padded with zeros
+    """
+    _require_numpy()
+    result = numpy.zeros((len(progressions), max([len(progression) for progression in progressions])), numpy.int8)
+    for i, progression in enumerate(progressions):
+        result[i, :len(progression)] = progression
+    return result
+
+
+def walk_melodies(key, rhythms, progressions, beats_per_measure, random_state=None):
+    """
+    Bulk version of MelodyEngine.iter_melody - advances every melody's random walk at once, one note per step.
+
+    Each note moves PITCH_CHANGE scale steps from the last one, staying inside the treble clef, and if possible
+    fitting every chord behind it. The choice among the allowed moves is the argmax of a random key per move, with the
+    disallowed ones masked out - a uniform choice, like the rng.randint in MelodyEngine.get_next_note.
+
+    Args:
+        key (KeySignature): Key of every melody
+        rhythms (numpy.ndarray): A batch of note lengths - see get_rhythm_array
+        progressions (numpy.ndarray): A chord progression for each melody (one chord per measure, repeating) - i.e.
+            from sample_step_progressions, or get_progression_array for progressions of different lengths
+        beats_per_measure (int)
+        random_state (numpy.random.RandomState): numpy's global state by default
+    Returns:
+        (numpy.ndarray): The pitch index of every note - see the top of this module
+    Raises:
+        Exception: If a melody has nowhere to go, as in get_next_note
+    """
+    _require_numpy()
+    if random_state is None:
+        random_state = numpy.random
+    pitch_index = key.get_pitch_index()
+    chord_fits = numpy.array(pitch_index.chord_fits[1:], bool)  # chord_fits[step - 1][scale index]
+    first, last = pitch_index.treble_indices
+    changes = numpy.array(PITCH_CHANGE)
+    measure_ticks = beats_to_ticks(beats_per_measure)
+    count, max_notes = rhythms.shape
+    rows = numpy.arange(count)
+    num_chords = (progressions > 0).sum(axis=1)  # Each progression's length, not counting padding
+    chord_rows = numpy.asarray(progressions, numpy.intp) - 1
+
+    result = numpy.full((count, max_notes), -1, numpy.int32)
+    current = random_state.randint(0, 3, count) * 2 + 4 * 7  # Start on a triad pitch, in octave 4
+    result[:, 0] = numpy.where(rhythms[:, 0] > 0, current, -1)
+    current_ticks = numpy.zeros(count, numpy.int64)  # As in iter_melody, ticks are counted from the second note
+    for i in range(1, max_notes):
+        note_ticks = rhythms[:, i]
+        active = note_ticks > 0
+
+        candidates = current[:, numpy.newaxis] + changes
+        allowed = (candidates >= first) & (candidates < last)
+        if not allowed[active].any(axis=1).all():
+            raise Exception("There are no possible values for the next note!!!")
+
+        # Every measure that an eighth-note step from the start of the note lands in - see iter_melody
+        first_measures = current_ticks // measure_ticks
+        last_measures = (current_ticks + ((note_ticks - 1) // EIGHTH_TICKS) * EIGHTH_TICKS) // measure_ticks
+        fits = numpy.ones_like(allowed)
+        safe_candidates = numpy.clip(candidates, 0, chord_fits.shape[1] - 1)
+        for offset in range(int((last_measures - first_measures)[active].max()) + 1 if active.any() else 0):
+            spanned = first_measures + offset <= last_measures
+            chord_steps = chord_rows[rows, (first_measures + offset) % num_chords]
+            fits &= chord_fits[chord_steps[:, numpy.newaxis], safe_candidates] | ~spanned[:, numpy.newaxis]
+        fitting = allowed & fits & (note_ticks >= EIGHTH_TICKS)[:, numpy.newaxis]
+        use_fitting = fitting.any(axis=1)
+        allowed = numpy.where(use_fitting[:, numpy.newaxis], fitting, allowed)
+
+        keys = random_state.random_sample(allowed.shape)
+        keys[~allowed] = -1
+        chosen = candidates[rows, keys.argmax(axis=1)]
+        current = numpy.where(active, chosen, current)
+        result[:, i] = numpy.where(active, current, -1)
+        current_ticks += note_ticks
+    return result
+
+
+def melodies_to_notes(key, rhythms, pitch_indices):
+    """
+    Turns a batch of melodies into Note objects - only needed by code that works with Notes, not arrays.
+
+    Returns:
+        (list of list of Note): The notes of each melody, i.e. for Song.set_section_melody
+    """
+    _require_numpy()
+    scale_values = key.get_pitch_index().scale_values
+    return [[Note.from_ticks(Pitch(scale_values[pitch], key), int(ticks))
+             for ticks, pitch in zip(rhythm_row, pitch_row) if ticks > 0]
+            for rhythm_row, pitch_row in zip(rhythms.tolist(), pitch_indices.tolist())]
+
+
+def generate_section_melodies(song, sections, random_state=None):
+    """
+    Generates the melodies of several sections of a song in one batch. Chord progressions and rhythm weights must
+    already be set.
+
+    Rhythms come from each section's ("batch_rhythm", section) random stream. They can't match MelodyEngine.iter_melody
+    for the same seed anyway - it draws pitches from the same stream as rhythms, in between them - so they get a stream
+    of their own rather than the section's "melody" stream.
+
+    Returns:
+        (list of list of Note): A melody per section, in the order of sections
+    """
+    _require_numpy()
+    rhythms = get_rhythm_array([list(iter_rhythm_ticks(song.num_measures_in_section(section), song.beats_per_measure,
+                                                       song.get_rhythm_weight(section),
+                                                       rng=song.get_random("batch_rhythm", section)))
+                                for section in sections])
+    progressions = get_progression_array([song.get_progression(section) for section in sections])
+    pitch_indices = walk_melodies(song.key, rhythms, progressions, song.beats_per_measure, random_state)
+    return melodies_to_notes(song.key, rhythms, pitch_indices)
@@ -1,5 +1,5 @@
 from music_theory import *
-from rhythm import gen_rhythm
+from rhythm import gen_rhythm_ticks
 
 import random
 import itertools  # Used for cartesian product in Chord.get_random_voicing()
@@ -22,9 +22,17 @@ CHORD_PROGRESSION_RULES = {
 }
 
 
+"""
+Internally, a chord progression is just a tuple of 1-index chord steps, i.e. (1, 4, 5, 1) - the chord type of each step
+is given by CHORD_TYPES and the key is the song's, so nothing else needs storing. Progressions are hashable and compare
+as plain integers; Chord objects are only made (via get_chord, which interns them) when something needs one.
+"""
+
+
 class Chord:
     """
     Class for chords that are typically stored in a progression (list). Must have a key for context.
+    Use get_chord() rather than the constructor, so that chords are shared instead of re-created.
 
     step        1-index int (1-6, for now), scale value
     chordType   str, "maj" "min" etc.
@@ -75,45 +83,51 @@ class Chord:
             octave (int):
         :return:
         """
-        pitch = self.key.get_pitch(self.step,octave)    # root pitch
-
-        half_steps_to_root = scale_steps[self.step-1]
-        half_steps_to_pitch = scale_steps[(self.step + step) % 7 -2]
-        pitch.add_half_steps(half_steps_to_pitch-half_steps_to_root)
-        return pitch
+        # Chord tones stay in the octave of the key's root, so tones past the 7th step of the key wrap down
+        scale_index = 7*octave + (self.step + step - 2) % 7
+        return Pitch(self.key.get_pitch_index().get_value(scale_index),self.key)
 
 
-    def get_random_voicing(self, duration):
+    def get_random_voicing(self, duration, rng=random):
         """
         Creates a random "voicing" of a chord, either with 1 and 5, or 1, 3, and 5. The voicing will be in the bass clef.
         :param duration: (int) length of note.
+        :param rng: source of randomness - the random module, or a random.Random
         :return: list of Note objects
         """
-        all_scale_tones = self.key.get_all_note_values_in_key()
-        if (random.random() < 0.60):
+        pitch_index = self.key.get_pitch_index()
+        if (rng.random() < 0.60):
             valid_steps = [self.step, (self.step - 1 + 2) % 7 + 1, (self.step - 1 + 4) % 7 + 1]
         else:
             valid_steps = [self.step, (self.step - 1 + 4) % 7 + 1]
-        tones_in_bass_clef = [x for x in all_scale_tones if
-                              Pitch(x, self.key).scale_step in valid_steps and 28 <= x <= 48]
         result = []
         for step in valid_steps:
-            notes_on_step = [x for x in tones_in_bass_clef if Pitch(x, self.key).scale_step == step]
+            notes_on_step = pitch_index.get_step_values_in_range(step, BASS_CLEF_RANGE[0], BASS_CLEF_RANGE[1])
             result.append(notes_on_step)
         combos = list(itertools.product(*result))  # Get all combinations of 1, 3, and 5 (or possibly just 1 and 5)
         combos = [c for c in combos if
                   max(c) - min(c) < 15 and min(c) > 35]  # filter combos to voicings that aren't too tight/loose
-        final_result = combos[random.randint(0, len(combos) - 1)]
+        final_result = combos[rng.randint(0, len(combos) - 1)]
         return [Note(Pitch(x, self.key), duration) for x in final_result]
 
 
-def get_next_chord(current_chord):
+def get_next_chord(current_chord, rng=random):
     """
     :param current_chord: (Chord) current chord in progression, used to find the next
+    :param rng: source of randomness - the random module, or a random.Random
+    :return: (int) step of next chord
+    """
+    return get_next_step(current_chord.step, rng)
+
+
+def get_next_step(current_step, rng=random):
+    """
+    :param current_step: (int) step of the current chord in progression, or 0 for the begin state
+    :param rng: source of randomness - the random module, or a random.Random
     :return: (int) step of next chord
     """
-    possible_chords = CHORD_PROGRESSION_RULES[current_chord.step]
-    return possible_chords[random.randint(0, len(possible_chords) - 1)]
+    possible_chords = CHORD_PROGRESSION_RULES[current_step]
+    return possible_chords[rng.randint(0, len(possible_chords) - 1)]
 
 
 def get_type(chord_step):
@@ -126,22 +140,67 @@ def get_type(chord_step):
     return "maj" if CHORD_TYPES[chord_step - 1] == 1 else "min"
 
 
-def get_chord_progression(key, num_chords):
-    result = [Chord(0, None, None)]
-    while len(result) - 1 < num_chords:
-        next_step = get_next_chord(result[-1])
-        next_type = get_type(next_step)
-        chord = Chord(next_step, next_type, key)
-        result.append(chord)
-    return result[1:]
+def get_chord(key, step, chord_type=None):
+    """
+    :param key: (KeySignature)
+    :param step: (int) 1-index step of chord
+    :param chord_type: (str) "maj", "min", etc. - defaults to get_type(step)
+    :return: (Chord) the one shared Chord object for this key, step and type
+    """
+    if chord_type is None:
+        chord_type = get_type(step)
+    chords_in_key = key.interned_chords
+    if chords_in_key is None:
+        chords_in_key = key.interned_chords = {}
+    chord = chords_in_key.get((step, chord_type))
+    if chord is None:
+        chord = chords_in_key[(step, chord_type)] = Chord(step, chord_type, key)
+    return chord
+
+
+def get_chords(key, progression):
+    """
+    :param key: (KeySignature)
+    :param progression: (tuple of int) chord steps
+    :return: (list of Chord)
+    """
+    return [get_chord(key, step) for step in progression]
+
+
+def progression_steps(progression):
+    """
+    :param progression: tuple of chord steps, or list of Chord objects
+    :return: (tuple of int) the progression as chord steps
+    """
+    if type(progression) is tuple:
+        return progression
+    return tuple([chord.step for chord in progression])
+
+
+def get_step_progression(num_chords, rng=random):
+    """
+    :param num_chords: (int) length of the progression
+    :param rng: source of randomness - the random module, or a random.Random
+    :return: (tuple of int) chord steps, walked from the begin state of CHORD_PROGRESSION_RULES
+    """
+    result = []
+    step = 0
+    while len(result) < num_chords:
+        step = get_next_step(step, rng)
+        result.append(step)
+    return tuple(result)
+
+
+def get_chord_progression(key, num_chords, rng=random):
+    return get_chords(key, get_step_progression(num_chords, rng))
 
 
 def levenshtein_distance(a, b):
     """
     Calculates the Levenshtein distance between a and b.
     http://hetland.org/coding/python/levenshtein.py
-    :param a: str
-    :param b: str
+    :param a: str (or any sequence, i.e. a tuple of chord steps)
+    :param b: str (or any sequence, i.e. a tuple of chord steps)
     :return:  int
     """
     n, m = len(a), len(b)
@@ -166,14 +225,16 @@ def levenshtein_distance(a, b):
 def different_enough(prog1, prog2):
     """
     I want to ensure that Chord progressions in different sections are very different from each other. This method uses levenshtein_distance to ensure that the two progressions are different enough.
-    :param prog1: list of Chord objects
-    :param prog2: list of Chord objects
+    :param prog1: tuple of chord steps (or list of Chord objects)
+    :param prog2: tuple of chord steps (or list of Chord objects)
     :return: boolean: True if the progressions are sufficiently different from one another.
     """
-    prog1_str = ''.join([str(x.step) for x in prog1])
-    prog2_str = ''.join([str(x.step) for x in prog2])
-    distance = float(levenshtein_distance(prog1_str, prog2_str)) / len(prog1_str)
-    return distance > 0.5 and prog1[0].step != prog2[0].step
+    prog1 = progression_steps(prog1)
+    prog2 = progression_steps(prog2)
+    if prog1[0] == prog2[0]:
+        return False
+    distance = float(levenshtein_distance(prog1, prog2)) / len(prog1)
+    return distance > 0.5
 
 chord_tuples = [
     (3,5),
@@ -181,19 +242,20 @@ chord_tuples = [
     (5,1)
 ]
 
-def make_chord_measure(chord,measure_duration):
+def make_chord_measure(chord,measure_duration,rng=random):
     '''
     :param chord:
     :param measure_duration:
+    :param rng: source of randomness - the random module, or a random.Random
     :return: list of Note (lists), to be played by the left hand of the piano player
     '''
 
-    rhythm = gen_rhythm(1,measure_duration,notes=[1,2,3,4])
+    rhythm = gen_rhythm_ticks(1,measure_duration,notes=[1,2,3,4],rng=rng)
     first_pitch = chord.get_pitch(1,2)
-    first_note = Note(first_pitch,rhythm[0])
+    first_note = Note.from_ticks(first_pitch,rhythm[0])
     result = [[first_note]]
     for r in rhythm[1:]:
-        steps = chord_tuples[random.randint(0,len(chord_tuples)-1)]
+        steps = chord_tuples[rng.randint(0,len(chord_tuples)-1)]
 
         dist1 = scale_steps[steps[0]-1]
         dist2 = scale_steps[steps[1]-1]
@@ -204,5 +266,5 @@ def make_chord_measure(chord,measure_duration):
         bottom_pitch = first_pitch.add_scale_steps(dist1)
         top_pitch = first_pitch.add_scale_steps(dist2)
 
-        result.append([Note(bottom_pitch,r),Note(top_pitch,r)])
+        result.append([Note.from_ticks(bottom_pitch,r),Note.from_ticks(top_pitch,r)])
     return result
@@ -2,9 +2,41 @@ import random
 
 from music_theory import *
 from rhythm import *
-from song_data import Measure
+from song_data import Measure, iter_section_measures
+from chords import get_chord
+from motif import VARIATIONS, Motif, MotifCache
 
 PITCH_CHANGE = [-2, -1, 1, 2]
+HARMONY_INTERVALS = [-2, 2, -5, 5]  # Thirds and sixths below and above a melody note, in scale steps
+
+_harmony_tables = {}  # KeySignature value => harmony table, see get_harmony_table()
+
+
+def get_harmony_table(key):
+    """
+    Works out, once per key, which harmony notes are allowed under/over each melody note for each chord.
+
+    Args:
+        key (KeySignature)
+    Returns:
+        (list of list of tuple of int): table[chord_step][scale_index] is a tuple of the scale indices (indices into
+            key.get_all_note_values_in_key()) that are a third or sixth away from scale_index, fit the chord, and are
+            in the treble clef range.
+    """
+    table = _harmony_tables.get(key.value)
+    if table is None:
+        scale_values = key.get_all_note_values_in_key()
+        table = [[]]  # There's no chord step 0
+        for chord_step in range(1, 7):
+            allowed_steps = set([(chord_step - 1) % 7, (chord_step + 1) % 7, (chord_step + 3) % 7] +
+                                [x - 1 for x in MELODIC_ALLOWANCES[chord_step]])  # Same as Chord.note_fits
+            table.append([tuple([i + interval for interval in HARMONY_INTERVALS
+                                 if 0 <= i + interval < len(scale_values)
+                                 and (i + interval) % 7 in allowed_steps
+                                 and TREBLE_CLEF_RANGE[0] <= scale_values[i + interval] <= TREBLE_CLEF_RANGE[1]])
+                          for i in range(len(scale_values))])
+        _harmony_tables[key.value] = table
+    return table
 
 
 class MelodyEngine:
@@ -14,40 +46,62 @@ class MelodyEngine:
     Fields:
         song (Song)
         scale_values (list of int)
+        scale_pitches (list of Pitch)       A Pitch for each of scale_values, shared by harmony notes
+        pitch_index (KeyPitchIndex)         The song key's pitch index
+        harmony_table (list of list)        See get_harmony_table()
+        harmony_probability (float)         Chance that a note of a quarter or longer gets a harmony note. 0 skips the
+                                            harmony stage altogether.
+        motif_cache (MotifCache)            If set, melodies are built a measure at a time, from cached motifs where
+                                            possible - see iter_motif_melody
+        motif_probability (float)           Chance that a measure is built from a cached motif
     """
 
     song = None
     scale_values = None
+    scale_pitches = None
+    pitch_index = None
+    harmony_table = None
+    harmony_probability = 0
+    motif_cache = None
+    motif_probability = 0
 
-    def __init__(self, song):
+    def __init__(self, song, harmony_probability=0, motif_cache=None, motif_probability=0.5):
         self.song = song
         self.scale_values = song.key.get_all_note_values_in_key()
+        self.scale_pitches = [Pitch(value, song.key) for value in self.scale_values]
+        self.pitch_index = song.key.get_pitch_index()
+        self.harmony_table = get_harmony_table(song.key)
+        self.harmony_probability = harmony_probability
+        self.motif_cache = motif_cache
+        self.motif_probability = motif_probability
+        self._motif_versions = {}  # Section => motif_cache.size when the section was first generated
 
-    def get_next_note(self, last_pitch_index, duration, chords):
+    def get_next_note(self, last_pitch_index, duration, chords, rng=random, index_range=None):
         """Gets the next note in a melody line.
         Args:
             last_pitch_index (int): index in self.scale_values of the last pitch
-            duration: rhythm of the note that is being decided on
+            duration (int): rhythm of the note that is being decided on, in ticks
             chords: chords behind the note in question
+            rng: source of randomness - the random module, or a random.Random
+            index_range (tuple of int): (first, last + 1) indices in self.scale_values that the note must be in - by
+                default, the treble clef
         :return: index (in self.scale_values) of new note
         """
-        possible_values = [last_pitch_index + pc for pc in
-                           PITCH_CHANGE]  # Get all possible next notes, by index in scale_values
-        possible_values = [p for p in possible_values if
-                           self.scale_values[p] <= TREBLE_CLEF_RANGE[1] and self.scale_values[p] >= TREBLE_CLEF_RANGE[
-                               0]]  # Filter to valid range in treble clef
+        first, last = index_range if index_range is not None else self.pitch_index.treble_indices
+        possible_values = [last_pitch_index + pc for pc in PITCH_CHANGE
+                           if first <= last_pitch_index + pc < last]  # All possible next notes in range, by index in scale_values
         if len(possible_values) == 0:
             raise Exception("There are no possible values for the next note!!!")
 
-        if duration >= 0.5:
-            filtered_to_chord = [pI for pI in possible_values if
-                                 all([chord.note_fits(Pitch(self.scale_values[pI], self.song.key)) for chord in chords])]
+        if duration >= EIGHTH_TICKS:
+            chord_fits = [self.pitch_index.chord_fits[chord.step] for chord in chords]
+            filtered_to_chord = [pI for pI in possible_values if all([fits[pI] for fits in chord_fits])]
             if len(filtered_to_chord) > 0:
                 possible_values = filtered_to_chord
             else:
                 brk = 0
 
-        return possible_values[random.randint(0, len(possible_values) - 1)]
+        return possible_values[rng.randint(0, len(possible_values) - 1)]
 
     def get_final_measure(self, num_beats, chord, last_pitch):
         """
@@ -57,44 +111,53 @@ class MelodyEngine:
         :param last_pitch: Last pitch of the preceding measure - used to make sure melody doesn't "jump around" from measure to measure.
         :return: Measure object
         """
-        triad_steps = [chord.step, (chord.step - 1 + 2) % 7 + 1, (chord.step - 1 + 4) % 7 + 1]
-        all_triad_pitches = [x for x in self.scale_values if Pitch(x, self.song.key).scale_step in triad_steps]
-        closest_pitch = all_triad_pitches[0]
-        distance = abs(closest_pitch - last_pitch.value)
-        for x in range(1, len(all_triad_pitches)):
-            current_distance = abs(all_triad_pitches[x] - last_pitch.value)
-            if current_distance < distance:
-                closest_pitch = all_triad_pitches[x]
-                distance = current_distance
+        closest_pitch = self.pitch_index.get_nearest_chord_tone(chord.step, last_pitch.value)
         final_note = Note(Pitch(closest_pitch, self.song.key), num_beats)
         result = Measure(num_beats, [final_note])
         result.assign_chords([chord])
         return result
 
-    def basic_harmonize(self, measure):
-        max_note_occurences = max([n.duration for n in measure.notes])
-        all_max_length_notes = [n for n in measure.notes if n.duration == max_note_occurences]
-        note_to_work_with = all_max_length_notes[random.randint(0, len(all_max_length_notes) - 1)]
-        note_index = self.scale_values.index(note_to_work_with.pitch.value)
-        lower_harmony_index = note_index - 2
-        higher_harmony_index = note_index + 2
-
-        lower_pitch = Pitch(self.scale_values[lower_harmony_index], self.song.key)
-        higher_pitch = Pitch(self.scale_values[higher_harmony_index], self.song.key)
-
-        interval_low = scale_steps.index(lower_pitch.get_interval(self.song.key.get_root_pitch())) + 1
-        interval_hi = scale_steps.index(higher_pitch.get_interval(self.song.key.get_root_pitch())) + 1
-
-        allowed = MELODIC_ALLOWANCES[measure.chords[0].step]
-        possible = [step for step in allowed if step == interval_low or step == interval_hi]
+    def basic_harmonize(self, measure, rng=random):
+        """
+        Picks one of the longest notes in the measure, and (30% of the time, if one is allowed) a harmony note for it.
+        :return: tuple of (beat, Note), or None
+        """
+        max_note_occurences = max([n.ticks for n in measure._notes])
+        all_max_length_notes = [n for n in measure._notes if n.ticks == max_note_occurences]
+        note_to_work_with = all_max_length_notes[rng.randint(0, len(all_max_length_notes) - 1)]
+        possible = self.harmony_table[measure.chords[0].step][note_to_work_with.pitch.scale_index]
 
-        if (len(possible) > 0 and random.random() > 0.7):
-            interval = possible[random.randint(0, len(possible) - 1)]
-            pitch = lower_pitch if interval == interval_low else higher_pitch
-            harmony_note = Note(pitch, note_to_work_with.duration)
+        if (len(possible) > 0 and rng.random() > 0.7):
+            harmony_index = possible[rng.randint(0, len(possible) - 1)]
+            harmony_note = Note.from_ticks(self.scale_pitches[harmony_index], note_to_work_with.ticks)
             return (measure.get_beat_of_note(note_to_work_with), harmony_note)
         else:
             return None
+
+    def harmonize_measures(self, measures, rng=random):
+        """
+        The harmony stage - adds harmony notes to measures as they go past, in a single pass.
+
+        Every note that's a quarter or longer gets a harmony note with probability self.harmony_probability, drawn from
+        the thirds/sixths in self.harmony_table that fit the measure's chord. Given a random.Random seeded the same way,
+        a section gets the same harmonies every time it's harmonized.
+
+        :param measures: iterable of Measure objects
+        :return: generator of the same Measure objects, with harmonies appended
+        """
+        for measure in measures:
+            table = self.harmony_table[measure.chords[0].step]
+            current_tick = 0
+            for note in measure._notes:
+                if note.ticks >= PPQ and rng.random() < self.harmony_probability:
+                    possible = table[note.pitch.scale_index]
+                    if len(possible) > 0:
+                        harmony_index = possible[rng.randint(0, len(possible) - 1)]
+                        harmony_note = Note.from_ticks(self.scale_pitches[harmony_index], note.ticks)
+                        measure.harmonies.append((ticks_to_beats(current_tick), harmony_note))
+                current_tick += note.ticks
+            yield measure
+
     def create_melody_beta(self,section):
         """
         Creates a melody for a section of a song.
@@ -102,30 +165,138 @@ class MelodyEngine:
         Melodies span many measures, but will account for things like downbeats and beginnings of measures,
         so that the melodic line somewhat adheres rhythmically.
         """
+        return list(self.iter_melody(section))
+
+    def iter_melody(self,section,rng=random,rhythm_weight=None,index_range=None):
+        """
+        Generator version of create_melody_beta - yields the notes of the melody as they're decided on.
+
+        Given a random.Random seeded the same way, this yields the same melody every time. rhythm_weight (by default,
+        the section's) and index_range (see get_next_note) let other melodic lines be walked the same way - i.e. a
+        counter-melody, in parts.py.
+        """
         chord_progression = self.song.get_chord_progression(section)
-        rhythm = gen_rhythm(self.song.num_measures_in_section(section),self.song.beats_per_measure,self.song.get_rhythm_weight(section))
+        if rhythm_weight is None:
+            rhythm_weight = self.song.get_rhythm_weight(section)
+        rhythm = iter_rhythm_ticks(self.song.num_measures_in_section(section),self.song.beats_per_measure,rhythm_weight,rng=rng)
+        measure_ticks = beats_to_ticks(self.song.beats_per_measure)
 
-        pitch_index = random.randint(0, 2) * 2 + (4 * 7)  #Start on a triad pitch, in octave 4
+        pitch_index = rng.randint(0, 2) * 2 + (4 * 7)  #Start on a triad pitch, in octave 4
         current_pitch = self.scale_values[pitch_index]
-        melody = [Note(Pitch(current_pitch, self.song.key), rhythm[0])]
-        current_beat = 0
-        for x in range(1,len(rhythm)):
-            end_note = current_beat+rhythm[x]
-            #current_beat => end_note
-            result = []
-            while current_beat < end_note:
-                #Do stuff
-                chord_index = int(current_beat/4) % self.song.num_chords_in_section(section)
-                """
-
-                """
-                result.append(chord_progression[chord_index])
-                current_beat += 0.5
-            pitch_index = self.get_next_note(pitch_index, rhythm[x], result)
+        yield Note.from_ticks(Pitch(current_pitch, self.song.key), next(rhythm))
+        num_chords = self.song.num_chords_in_section(section)
+        current_tick = 0
+        for note_ticks in rhythm:
+            # The chords behind the note are those of every measure that an eighth-note step from current_tick lands
+            # in. Measures are a whole number of eighths long, so that's every measure from the first step to the last.
+            last_step = current_tick + ((note_ticks - 1) // EIGHTH_TICKS) * EIGHTH_TICKS
+            result = [chord_progression[measure_index % num_chords]
+                      for measure_index in range(current_tick // measure_ticks, last_step // measure_ticks + 1)]
+            pitch_index = self.get_next_note(pitch_index, note_ticks, result, rng, index_range)
             pitch = Pitch(self.scale_values[pitch_index], self.song.key)
-            melody.append(Note(pitch, rhythm[x]))
-            current_beat=end_note
-        return melody
+            yield Note.from_ticks(pitch, note_ticks)
+            current_tick += note_ticks
+
+    def iter_motif_melody(self,section,rng=random):
+        """
+        Motif version of iter_melody. The melody is built a measure at a time - each measure either varies a cached
+        motif for its chord (transposed to start a step away from the last note, maybe inverted, and maybe with its
+        first half augmented or repeated - see Motif.get_variation), or is generated as usual and cached as a new
+        motif. Notes never cross a barline.
+
+        Only motifs that were cached before the section was first generated are used (along with the section's own),
+        so regenerating the section always gives the same melody.
+        """
+        chord_progression = self.song.get_chord_progression(section)
+        beats_per_measure = self.song.beats_per_measure
+        measure_ticks = beats_to_ticks(beats_per_measure)
+        key_value = self.song.key.value
+        first, last = self.pitch_index.treble_indices
+        version = self._motif_versions.setdefault(section, self.motif_cache.size)
+        section_motifs = MotifCache(self.motif_cache.max_motifs)
+
+        pitch_index = None
+        for measure_index in range(self.song.num_measures_in_section(section)):
+            chord = chord_progression[measure_index % len(chord_progression)]
+            indices = None
+            if pitch_index is not None and rng.random() < self.motif_probability:
+                motifs = (self.motif_cache.get_motifs(key_value, chord.step, version) +
+                          section_motifs.get_motifs(key_value, chord.step))
+                if len(motifs) > 0:
+                    motif = motifs[rng.randint(0, len(motifs) - 1)]
+                    motif = motif.get_variation(VARIATIONS[rng.randint(0, len(VARIATIONS) - 1)])
+                    if motif is not None and motif.get_total_ticks() != measure_ticks:
+                        motif = None  # Cached from a song in a different meter
+                    if motif is not None and rng.random() < 0.5:
+                        motif = motif.inverted()
+                    if motif is not None:
+                        changes = list(PITCH_CHANGE)
+                        rng.shuffle(changes)
+                        for change in changes:
+                            placed = motif.get_indices(pitch_index + change)
+                            if motif.fits(placed, self.pitch_index.chord_fits[chord.step], first, last):
+                                indices = placed
+                                break
+            if indices is not None:
+                rhythm = motif.ticks
+            else:
+                rhythm = gen_rhythm_ticks(1, beats_per_measure, self.song.get_rhythm_weight(section), rng=rng)
+                indices = []
+                for note_ticks in rhythm:
+                    if pitch_index is None:
+                        pitch_index = rng.randint(0, 2) * 2 + (4 * 7)  #Start on a triad pitch, in octave 4
+                    else:
+                        pitch_index = self.get_next_note(pitch_index, note_ticks, [chord], rng)
+                    indices.append(pitch_index)
+                motif = Motif.from_indices(rhythm, indices)
+                self.motif_cache.add(key_value, chord.step, motif)
+                section_motifs.add(key_value, chord.step, motif)
+            for note_ticks, i in zip(rhythm, indices):
+                yield Note.from_ticks(Pitch(self.scale_values[i], self.song.key), note_ticks)
+            pitch_index = indices[-1]
+
+    def create_section_measures(self,section):
+        """
+        Generates the melody for a section and cuts it into measures (with ties and chords) in the same pass.
+
+        :return: list of Measure objects
+        """
+        return list(self.iter_section_measures(section))
+
+    def iter_section_measures(self,section):
+        """
+        Generator version of create_section_measures. Measures are harmonized too, unless harmony_probability is 0.
+
+        The melody and harmony each get their own random stream for the section (see Song.get_random), so the section
+        comes out the same every time, whether or not it's harmonized.
+        """
+        if self.motif_cache is not None:
+            melody = self.iter_motif_melody(section, self.song.get_random("melody", section))
+        else:
+            melody = self.iter_melody(section, self.song.get_random("melody", section))
+        measures = iter_section_measures(melody,
+                                         self.song.beats_per_measure,
+                                         self.song.get_chord_progression(section),
+                                         self.song.num_measures_in_section(section))
+        if self.harmony_probability > 0:
+            measures = self.harmonize_measures(measures, self.song.get_random("harmony", section))
+        return measures
+
+    def iter_song_measures(self):
+        """
+        Yields every measure of the song, in order and including the final measure, generating each one as it's needed.
+
+        Sections aren't kept around for their repeats - every time a section comes up, it's generated again from the
+        section's random streams, which gives identical measures. So only the measure being yielded is alive at any
+        time, however long the song is. Chord progressions and rhythm weights must already be set.
+        """
+        last_measure = None
+        for section in self.song.section_structure:
+            for measure in self.iter_section_measures(section):
+                yield measure
+                last_measure = measure
+        final_chord = get_chord(self.song.key, 1, "maj")
+        yield self.get_final_measure(self.song.beats_per_measure, final_chord, last_measure._notes[-1].pitch)
 
     def divide_cross_measure_notes(self,melody):
         result = []
@@ -157,8 +328,8 @@ def get_percent_valid_notes(song, measure, chord):
     """
     :return: Percent by duration of notes in measure that fit into the chord
     """
-    valid_duration = 0
+    valid_ticks = 0
     for note in measure._notes:
         if (chord.note_fits(note.pitch)):
-            valid_duration += note.duration
-    return valid_duration / float(measure.duration)
\ No newline at end of file
+            valid_ticks += note.ticks
+    return valid_ticks / float(measure.ticks)
\ No newline at end of file
@@ -0,0 +1,202 @@
+from music_theory import EIGHTH_TICKS, beats_to_ticks
+from rhythm import global_notes
+
+"""
+motif.py
+
+Motifs - one-measure melody fragments that new measures can be built from, instead of generating every measure's
+melody from scratch.
+
+A motif is a rhythm and a contour: the note lengths in ticks, and each note's distance in scale steps from the first
+note (see Pitch.scale_index). Neither depends on where the motif is played, so a cached motif can be reused over any
+chord on the same step, in any octave. Varying it is cheap integer work - transposing is just choosing a different
+starting scale index, inverting negates the contour, and augmenting or truncating changes the rhythm (see VARIATIONS).
+"""
+
+_RHYTHM_TICKS = set([beats_to_ticks(n) for n in global_notes])  # Note lengths the rhythm generator uses
+
+# Ways of varying a motif that keep its length - see Motif.get_variation
+VARIATIONS = ("none", "augmented", "repeated")
+
+
+class Motif:
+    """
+    Fields:
+        ticks (tuple of int)        Length of each note, in ticks
+        contour (tuple of int)      Scale steps from the first note to each note - contour[0] is always 0
+    """
+
+    def __init__(self, ticks, contour):
+        self.ticks = tuple(ticks)
+        self.contour = tuple(contour)
+
+    @staticmethod
+    def from_indices(ticks, scale_indices):
+        return Motif(ticks, [i - scale_indices[0] for i in scale_indices])
+
+    def get_total_ticks(self):
+        return sum(self.ticks)
+
+    def get_indices(self, start):
+        """
+        Transposes the motif to start on a scale index.
+
+        Returns:
+            (list of int): The scale index of each note
+        """
+        return [start + step for step in self.contour]
+
+    def inverted(self):
+        """
+        Returns:
+            (Motif): The motif upside down - every step up becomes a step down
+        """
+        return Motif(self.ticks, [-step for step in self.contour])
+
+    def augmented(self, factor=2):
+        """
+        Returns:
+            (Motif): The motif with every note `factor` times as long
+        """
+        return Motif([ticks * factor for ticks in self.ticks], self.contour)
+
+    def truncated(self, total_ticks):
+        """
+        Returns:
+            (Motif): The first total_ticks of the motif, with the last note cut short - or None if that note would
+                be a length the rhythm generator never makes
+        """
+        ticks = []
+        remaining = total_ticks
+        for note_ticks in self.ticks:
+            if remaining <= 0:
+                break
+            ticks.append(min(note_ticks, remaining))
+            remaining -= note_ticks
+        if remaining > 0 or ticks[-1] not in _RHYTHM_TICKS:
+            return None
+        return Motif(ticks, self.contour[:len(ticks)])
+
+    def repeated(self):
+        """
+        Returns:
+            (Motif): The motif played twice - the second time starting on the same note as the first
+        """
+        return Motif(self.ticks * 2, self.contour * 2)
+
+    def get_variation(self, variation):
+        """
+        Varies the motif without changing its length, so a motif of a measure still fills a measure.
+
+        Args:
+            variation (str): One of VARIATIONS -
+                none        The motif as it is
+                augmented   Its first half, augmented to twice as long
+                repeated    Its first half, played twice
+        Returns:
+            (Motif): The variation - or None if the motif can't be varied that way (its first half would end partway
+                through a note that can't be cut short there, or an augmented note would be a length the rhythm
+                generator never makes)
+        """
+        if variation == "none":
+            return self
+        total = self.get_total_ticks()
+        if total % 2 != 0:
+            return None
+        first_half = self.truncated(total // 2)
+        if first_half is None:
+            return None
+        if variation == "repeated":
+            return first_half.repeated()
+        augmented = first_half.augmented(2)
+        if any([ticks not in _RHYTHM_TICKS for ticks in augmented.ticks]):
+            return None
+        return augmented
+
+    def fits(self, scale_indices, chord_fits, first, last):
+        """
+        Checks a placement of the motif against a KeyPitchIndex's tables - every note must be in
+        range(first, last), and every note of an eighth or longer must fit the chord (as in MelodyEngine.get_next_note).
+
+        Args:
+            scale_indices (list of int): From get_indices()
+            chord_fits (list of bool): KeyPitchIndex.chord_fits[chord step]
+            first (int), last (int): i.e. KeyPitchIndex.treble_indices
+        """
+        for ticks, i in zip(self.ticks, scale_indices):
+            if not first <= i < last:
+                return False
+            if ticks >= EIGHTH_TICKS and not chord_fits[i]:
+                return False
+        return True
+
+
+class MotifCache:
+    """
+    Motifs, by (key, chord step), each with its rhythm pattern. One cache can be shared by every song in a run.
+
+    Every motif added gets the next sequence number. Lookups can be limited to the motifs that were already there at
+    some point (a "version" - the cache's size at the time), so that something built from the cache can be built again
+    identically later, after other motifs have been added - i.e. a section that's regenerated for each of its repeats.
+
+    Fields:
+        max_motifs (int)    Most motifs kept for each (key, chord step) - later ones aren't added
+        size (int)          Number of motifs added so far
+    """
+
+    def __init__(self, max_motifs=16):
+        self.max_motifs = max_motifs
+        self.size = 0
+        self._motifs = {}  # (key value, chord step) => list of (sequence number, Motif)
+        self._added = set()  # (key value, chord step, rhythm, contour) of every motif, so none are added twice
+
+    def add(self, key_value, chord_step, motif):
+        """
+        Returns:
+            (bool): Whether the motif was added - it isn't if it's already cached, or the cache is full for the chord
+        """
+        identity = (key_value, chord_step, motif.ticks, motif.contour)
+        motifs = self._motifs.setdefault((key_value, chord_step), [])
+        if identity in self._added or len(motifs) >= self.max_motifs:
+            return False
+        self._added.add(identity)
+        motifs.append((self.size, motif))
+        self.size += 1
+        return True
+
+    def get_motifs(self, key_value, chord_step, version=None):
+        """
+        Args:
+            key_value (int): KeySignature.value
+            chord_step (int)
+            version (int): Only return motifs added before the cache reached this size - by default, all of them
+        Returns:
+            (list of Motif): In the order they were added
+        """
+        return [motif for number, motif in self._motifs.get((key_value, chord_step), ())
+                if version is None or number < version]
+
+    def get_state(self):
+        """
+        Returns:
+            (dict): Everything in the cache, as plain lists and numbers (i.e. for JSON) - see from_state()
+        """
+        motifs = []
+        for (key_value, chord_step), entries in sorted(self._motifs.items()):
+            for number, motif in entries:
+                motifs.append([key_value, chord_step, number, list(motif.ticks), list(motif.contour)])
+        return {"max_motifs": self.max_motifs, "size": self.size, "motifs": motifs}
+
+    @staticmethod
+    def from_state(state):
+        """
+        Returns:
+            (MotifCache): A cache identical to the one get_state() was called on, down to its sequence numbers
+        """
+        cache = MotifCache(state["max_motifs"])
+        cache.size = state["size"]
+        for key_value, chord_step, number, ticks, contour in sorted(state["motifs"], key=lambda entry: entry[2]):
+            motif = Motif(ticks, contour)
+            cache._motifs.setdefault((key_value, chord_step), []).append((number, motif))
+            cache._added.add((key_value, chord_step, motif.ticks, motif.contour))
+        return cache
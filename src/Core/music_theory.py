@@ -1,4 +1,5 @@
 import math  # For some weird expo/log operations in note duration (finding whether a note should have a dot
+from bisect import bisect_left, bisect_right  # For KeyPitchIndex lookups
 
 """
 The "absolute value" of a pitch is a zero-index integer that tells, essentially, how many half steps above C0 it is.
@@ -53,6 +54,41 @@ MELODIC_ALLOWANCES = {
     6: [2, 5]
 }
 
+"""
+Time is measured in integer "ticks" - PPQ ticks per quarter note (one beat). 48 is divisible by 2, 3, 4, 8, 12 and 16,
+so eighths, 16ths and triplets are all exact, and nothing in the core ever has to do float modulo on beats.
+
+i.e.    eighth => 24
+        quarter => 48
+        dotted half => 144
+"""
+PPQ = 48
+SIXTEENTH_TICKS = PPQ / 4
+EIGHTH_TICKS = PPQ / 2
+
+
+def beats_to_ticks(beats):
+    """
+    Args:
+        beats (float): A duration or position in beats
+    Returns:
+        (int): The same duration in ticks
+    """
+    return int(round(beats * PPQ))
+
+
+def ticks_to_beats(ticks):
+    """
+    Args:
+        ticks (int)
+    Returns:
+        (int or float): The same duration in beats - an int when it's a whole number of beats, so that "4" stays "4".
+    """
+    if ticks % PPQ == 0:
+        return ticks / PPQ
+    return ticks / float(PPQ)
+
+
 def get_sharp_notes():
     """
     Returns:
@@ -136,6 +172,8 @@ class Pitch:
         octave (int)        Zero-index octave of the pitch
         key (KeySignature)  key that the pitch is in
         scale_step (int)    One-index int representing where the pitch is on the scale
+        scale_index (int)   Number of scale steps from the root of the key in octave 0 (octave*7 + scale_step-1) -
+                            scale step arithmetic is plain integer arithmetic on this (see KeyPitchIndex)
         letter (str)        Note letter, i.e. "C", "Eb", etc.
     """
 
@@ -143,6 +181,7 @@ class Pitch:
     octave = None
     key = None
     scale_step = None
+    scale_index = None
     letter = None
 
     def __init__(self, value, key):
@@ -161,7 +200,8 @@ class Pitch:
         Used essentially as a helper function, but also to re-setup fields after adding half steps to a pitch.
         """
         self.octave = self.value / 12
-        self.scale_step = Pitch.get_step_in_scale(self.value, self.key)
+        self.scale_index = self.key.get_pitch_index().get_index(self.value)
+        self.scale_step = self.scale_index % 7 + 1
         self.letter = self.key.scale[self.scale_step - 1]
         if len(self.letter) == 2:
             if self.letter[1] == 'b':
@@ -190,17 +230,11 @@ class Pitch:
         Args:
             half_steps (int): Number of half steps to increment by
         """
-        original_value = self.value
-        original_key = self.key
-        try:
-            self.value += half_steps
-            self.set_up()
-        except ValueError:
-            self.value = original_value
-            self.key = original_key
-            self.set_up()
+        if not self.key.get_pitch_index().is_in_key(self.value + half_steps):
             errorMsg = "Error - Adding " + str(half_steps) + " to " + self.letter + " in the key of " + self.key.root_note + " is not valid."
             raise ValueError(errorMsg)
+        self.value += half_steps
+        self.set_up()
 
     def get_interval(self, base_pitch):
         """Get interval between a lower pitch and this one.         ***Perhaps I should implement __le__ in-case self < base_pitch?***
@@ -250,29 +284,34 @@ class Pitch:
         """ Returns a NEW pitch, with the given # of scale steps.
 
         Args:
-            scale_steps (int): Number of scale steps to increment by
+            scale_steps (int): Number of scale steps to increment by - negative to go down
         """
-        new_pitch = Pitch(self.value,self.key)
-        while scale_steps > 0:
-            # increment by that scale_step
-            num_half_steps = (12+get_scale_step(new_pitch.scale_step)-get_scale_step(new_pitch.scale_step-1)) % 12
-            new_pitch.value += num_half_steps
-            scale_steps -= 1
-            new_pitch.set_up()
-        return new_pitch
+        return Pitch(self.key.get_pitch_index().get_value(self.scale_index + scale_steps), self.key)
+
+    def get_scale_interval(self, base_pitch):
+        """
+        Args:
+            base_pitch (Pitch): A pitch in the same key
+        Returns:
+            (int): Number of scale steps from base_pitch up to this pitch (negative if this pitch is lower)
+        """
+        if self.key != base_pitch.key:
+            raise ValueError("Param base_pitch must share the same key with the pitch calling get_scale_interval!")
+        return self.scale_index - base_pitch.scale_index
 
 class Note(object):
     """A musical note, made up of a pitch and a duration.
 
     Fields:
         pitch (Pitch)       The pitch of the note
-        duration (int)      The duration of the note, in beats.
+        ticks (int)         The duration of the note, in ticks (see PPQ)
+        duration (float)    The duration of the note, in beats - derived from ticks.
         type (str)          The type of the note, assuming quarter note is 1 beat. i.e. "eighth" - this doesn't address dotted notes, just the "base" type
         dot (bool)          Is this note a dotted note?
         tie (str)           Is this the beginning of a tie ("start"), the end of one ("stop"), or not tied (None)?
     """
     pitch = None
-    duration = None
+    ticks = None
     type = None
     dot = None
     tie = None
@@ -281,23 +320,36 @@ class Note(object):
         """
         Args:
             pitch (Pitch)
-            duration (int)
+            duration (int): In beats - use Note.from_ticks to skip the conversion.
             tie (str)
 
         See Note documentation for argument details.
         """
         self.pitch = pitch
-        self.duration = duration
-        if duration < 0:
-            print self.duration
-            raw_input()
-        self.type = Note.duration_names[2 ** (math.floor(math.log(duration, 2)))]
-        if (math.log(float(duration) * 2 / 3, 2) % 1 == 0):
-            self.dot = True
-        else:
-            self.dot = False
+        self.set_ticks(beats_to_ticks(duration))
         self.tie = tie
 
+    @classmethod
+    def from_ticks(cls, pitch, ticks, tie=None):
+        note = cls.__new__(cls)
+        note.pitch = pitch
+        note.set_ticks(ticks)
+        note.tie = tie
+        return note
+
+    def set_ticks(self, ticks):
+        if ticks <= 0:
+            raise ValueError("Invalid note duration: " + str(ticks) + " ticks.")
+        self.ticks = ticks
+        try:
+            self.type, self.dot = Note.tick_types[ticks]
+        except KeyError:
+            self.type, self.dot = Note.get_type_of_ticks(ticks)
+
+    @property
+    def duration(self):
+        return ticks_to_beats(self.ticks)
+
     def __str__(self):
         result = str(self.pitch) + ", " + str(self.duration)
         if self.tie == "start":
@@ -310,12 +362,32 @@ class Note(object):
         """Split into two tied notes with a total duration equal to self.duration - doesn't alter self.
 
         Args:
-            first_duration (int): Portion of self that should become the first tied note
+            first_duration (int): Portion of self that should become the first tied note, in beats
         Returns:
             (tuple of Note): The two notes
         """
-        second_duration = self.duration-first_duration
-        return (Note(self.pitch,first_duration,"start"),Note(self.pitch,second_duration,"stop"))
+        return self.split_at_ticks(beats_to_ticks(first_duration))
+
+    def split_at_ticks(self,first_ticks):
+        """Same as split_into_tied_notes, but first_ticks is in ticks.
+        """
+        return (Note.from_ticks(self.pitch,first_ticks,"start"),Note.from_ticks(self.pitch,self.ticks-first_ticks,"stop"))
+
+    @staticmethod
+    def get_type_of_ticks(ticks):
+        """
+        Works out the note type and dot for a duration. This is only used to build Note.tick_types (and for odd
+        durations that aren't in it) - notes themselves just do a table lookup.
+
+        Args:
+            ticks (int)
+        Returns:
+            (tuple of (str, bool)): The type, i.e. "eighth", and whether the note is dotted
+        """
+        duration = float(ticks) / PPQ
+        note_type = Note.duration_names[2 ** (math.floor(math.log(duration, 2)))]
+        dot = math.log(duration * 2 / 3, 2) % 1 == 0
+        return note_type, dot
 
     duration_names = {
         0.25: "16th",
@@ -325,6 +397,10 @@ class Note(object):
         4: "whole"
     }
 
+# Maps every duration (in ticks) shorter than two whole notes, in steps of a 16th, to its (type, dot).
+Note.tick_types = dict((ticks, Note.get_type_of_ticks(ticks))
+                       for ticks in range(SIXTEENTH_TICKS, 8 * PPQ, SIXTEENTH_TICKS))
+
 
 
 class KeySignature:
@@ -333,6 +409,8 @@ class KeySignature:
         value (int)                     0-octave absolute value representation, i.e. 4 for E, 8 for Ab
         root_note (str)                 String representation, i.e. "E", "Ab"
         scale (list of str)             List of note names w/ len 7, i.e. ["E", "F#", "G", "A", "B", "C#", "D#"]
+        interned_chords (dict)          (step, chord_type) => Chord, filled in by chords.get_chord()
+        pitch_index (KeyPitchIndex)     Built the first time get_pitch_index() is called
     Static Fields:
         flat_or_sharp (list of int)     1 is flat, 0 is sharp => tells which to use in key signature
         key_sig_values (list of int)    Circle of fifths: i.e. -5 is 5 flats, 3 is 3 sharps, 0 is no flats or sharps
@@ -346,6 +424,8 @@ class KeySignature:
     value = None
     root_note = None
     scale = None
+    interned_chords = None
+    pitch_index = None
 
     flat_or_sharp = [1, 1, 0, 1, 0, 1, 1, 0, 1, 0, 1, 0]  # STATIC =>
     key_sig_values = [0,-5,2,-3,4,-1,-6,1,-4,3,-2,5]
@@ -393,6 +473,15 @@ class KeySignature:
         scale_values = [item for sublist in sublisted_scale_values for item in sublist]
         return scale_values
 
+    def get_pitch_index(self):
+        """
+        Returns:
+            (KeyPitchIndex): The (shared) pitch index of this key
+        """
+        if self.pitch_index is None:
+            self.pitch_index = KeyPitchIndex(self)
+        return self.pitch_index
+
     def get_pitch(self,step,octave=0):
         """
         Get the pitch on the given scale step and octave.
@@ -469,4 +558,121 @@ class KeySignature:
         if letter == 'C':
             return "None"
         index = get_note_index(letter)
-        return "Flats" if KeySignature.flat_or_sharp[index] == 1 else "Sharps"
\ No newline at end of file
+        return "Flats" if KeySignature.flat_or_sharp[index] == 1 else "Sharps"
+
+
+class KeyPitchIndex:
+    """
+    Sorted arrays of the pitches in a key, so that questions like "which chord tone is closest to X, within range R?"
+    are answered with a bisect (O(log n), no new objects) instead of filtering every pitch in the key.
+    Use KeySignature.get_pitch_index() rather than the constructor - the index only needs building once per key.
+
+    It also maps between absolute values and scale indices (see Pitch.scale_index) - scale_values[i] is the value of
+    scale index i, and value_indices[v] is the scale index of value v.
+
+    Fields:
+        key_value (int)                         Value of the key's root in octave 0
+        scale_values (list of int)              Same as KeySignature.get_all_note_values_in_key()
+        value_indices (list of int)             value_indices[v] - scale index of value v, or None if v isn't one of
+                                                scale_values
+        step_values (list of list of int)       step_values[s] - every value on 1-index scale step s, sorted
+        chord_tones (list of list of int)       chord_tones[s] - every value in the triad of the chord on step s, sorted
+        chord_fits (list of list of bool)       chord_fits[s][i] - can scale_values[i] be played over the chord on
+                                                step s? (the same test as Chord.note_fits)
+        treble_indices (tuple of int)           (first, last + 1) indices of scale_values inside TREBLE_CLEF_RANGE
+        bass_indices (tuple of int)             (first, last + 1) indices of scale_values inside BASS_CLEF_RANGE
+    """
+
+    def __init__(self, key):
+        self.key_value = key.value
+        self.scale_values = key.get_all_note_values_in_key()
+        self.value_indices = [None] * (self.scale_values[-1] + 1)
+        for i, value in enumerate(self.scale_values):
+            self.value_indices[value] = i
+        # scale_values starts on the root of the key, so scale_values[i] is on scale step i % 7 + 1
+        self.step_values = [[]] + [self.scale_values[step - 1::7] for step in range(1, 8)]
+        self.chord_tones = [[]]
+        self.chord_fits = [[]]
+        for chord_step in range(1, 8):
+            triad = [(chord_step - 1) % 7, (chord_step + 1) % 7, (chord_step + 3) % 7]
+            allowed = triad + [x - 1 for x in MELODIC_ALLOWANCES.get(chord_step, [])]
+            self.chord_tones.append([v for i, v in enumerate(self.scale_values) if i % 7 in triad])
+            self.chord_fits.append([i % 7 in allowed for i in range(len(self.scale_values))])
+        self.treble_indices = KeyPitchIndex.get_range(self.scale_values, TREBLE_CLEF_RANGE[0], TREBLE_CLEF_RANGE[1])
+        self.bass_indices = KeyPitchIndex.get_range(self.scale_values, BASS_CLEF_RANGE[0], BASS_CLEF_RANGE[1])
+
+    def get_value(self, scale_index):
+        """
+        Returns:
+            (int): Absolute value of the pitch at scale_index - O(1), and works outside of scale_values too
+        """
+        if 0 <= scale_index < len(self.scale_values):
+            return self.scale_values[scale_index]
+        return self.key_value + 12 * (scale_index // 7) + scale_steps[scale_index % 7]
+
+    def get_index(self, value):
+        """
+        Returns:
+            (int): Scale index of the absolute value - O(1)
+        Raises:
+            ValueError: If the value isn't in the key
+        """
+        if 0 <= value < len(self.value_indices):
+            scale_index = self.value_indices[value]
+            if scale_index is not None:
+                return scale_index
+        relative_value = value - self.key_value  # Outside of scale_values, or not in the key at all
+        if relative_value % 12 in scale_steps:
+            return 7 * (relative_value // 12) + scale_steps.index(relative_value % 12)
+        raise ValueError(str(value) + " is not in the key!")
+
+    def is_in_key(self, value):
+        return (value - self.key_value) % 12 in scale_steps
+
+    @staticmethod
+    def get_range(values, low, high):
+        """
+        Args:
+            values (list of int): Sorted values, i.e. one of the lists in this index
+            low (int): Lowest value in the range
+            high (int): Highest value in the range (inclusive)
+        Returns:
+            (tuple of int): (first, last + 1) - indices of the values in the range
+        """
+        return bisect_left(values, low), bisect_right(values, high)
+
+    @staticmethod
+    def get_nearest(values, target, low=None, high=None):
+        """
+        Args:
+            values (list of int): Sorted values, i.e. one of the lists in this index
+            target (int): Absolute value to get close to
+            low (int): Optional lowest allowed value
+            high (int): Optional highest allowed value (inclusive)
+        Returns:
+            (int): The value closest to target (the lower one, on a tie), or None if no values are in range
+        """
+        first = 0 if low is None else bisect_left(values, low)
+        last = len(values) if high is None else bisect_right(values, high)
+        i = bisect_left(values, target, first, last)
+        if i == last:
+            return values[i - 1] if i > first else None
+        if i == first or values[i] - target < target - values[i - 1]:
+            return values[i]
+        return values[i - 1]
+
+    def get_nearest_chord_tone(self, chord_step, target, low=None, high=None):
+        """
+        Returns:
+            (int): The value of the tone in the triad on chord_step that is closest to target - see get_nearest
+        """
+        return KeyPitchIndex.get_nearest(self.chord_tones[chord_step], target, low, high)
+
+    def get_step_values_in_range(self, step, low, high):
+        """
+        Returns:
+            (list of int): Every value on 1-index scale step `step`, from low to high inclusive
+        """
+        values = self.step_values[step]
+        first, last = KeyPitchIndex.get_range(values, low, high)
+        return values[first:last]
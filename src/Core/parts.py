@@ -0,0 +1,184 @@
+import multiprocessing
+
+from music_theory import Note, Pitch
+from chords import get_chord
+from rhythm import gen_rhythm_ticks
+from song_data import Measure, Part, iter_section_measures
+from melody import MelodyEngine
+from serialize import encode_song, decode_song, encode_measures, decode_measures
+
+"""
+parts.py
+
+Generates the parts of a song other than the melody (see Song.parts) - counter-melodies, bass lines and pads.
+
+Parts share the song's key, section structure and chord progressions, but nothing else: each section of a part is
+generated from its own random stream, ("part", part id, section). So parts don't depend on the melody or on each other,
+they can be generated in any order - or all at once, in separate processes (see generate_parts) - and a section of a
+part comes out the same every time. Generating a part walks each of its unique sections once, so the cost of a song
+grows with the number of parts, and nothing is regenerated when a part is added.
+"""
+
+COUNTER_RANGE = (43, 67)  # G3 to G5 - the counter-melody sits at and below the bottom of the melody's range
+COUNTER_RHYTHM_WEIGHT = 5  # Counter-melodies favor longer notes than the melody - see rhythm.get_weighted_list
+BASS_OCTAVE = 2
+PAD_OCTAVE = 3
+PAD_STEPS = (1, 3, 5)  # Steps of the chord that pads play
+
+
+class PartEngine:
+    """
+    Contains logic used to create one part of a song. What's generated depends on the part's role:
+
+        counter     A second melody - the same random walk as the melody, with longer notes, in COUNTER_RANGE
+        bass        The root of each chord on the downbeat, then other tones of the chord
+        pad         Each chord's triad, held for the whole measure
+
+    Fields:
+        song (Song)
+        part (Part)
+        melody_engine (MelodyEngine)        Walks counter-melodies
+        counter_indices (tuple of int)      (first, last + 1) indices of the key's scale values inside COUNTER_RANGE
+    """
+
+    song = None
+    part = None
+    melody_engine = None
+    counter_indices = None
+
+    def __init__(self, song, part):
+        self.song = song
+        self.part = part
+        self.melody_engine = MelodyEngine(song)
+        self.counter_indices = self.melody_engine.pitch_index.get_range(self.melody_engine.scale_values,
+                                                                        COUNTER_RANGE[0], COUNTER_RANGE[1])
+
+    def get_random(self, section):
+        return self.song.get_random("part", self.part.part_id, section)
+
+    def iter_section_measures(self, section):
+        """
+        Yields the part's measures for a section. Chord progressions must already be set.
+        """
+        rng = self.get_random(section)
+        if self.part.role == "counter":
+            melody = self.melody_engine.iter_melody(section, rng, COUNTER_RHYTHM_WEIGHT, self.counter_indices)
+            for measure in iter_section_measures(melody, self.song.beats_per_measure,
+                                                 self.song.get_chord_progression(section),
+                                                 self.song.num_measures_in_section(section)):
+                yield measure
+            return
+
+        chord_progression = self.song.get_chord_progression(section)
+        for measure_index in range(self.song.num_measures_in_section(section)):
+            chord = chord_progression[measure_index % len(chord_progression)]
+            if self.part.role == "bass":
+                yield self.make_bass_measure(chord, rng)
+            else:
+                yield self.make_pad_measure(chord)
+
+    def make_bass_measure(self, chord, rng):
+        rhythm = gen_rhythm_ticks(1, self.song.beats_per_measure, notes=[1, 2, 3, 4], rng=rng)
+        notes = [Note.from_ticks(chord.get_pitch(1, BASS_OCTAVE), rhythm[0])]
+        for note_ticks in rhythm[1:]:
+            step = PAD_STEPS[rng.randint(0, len(PAD_STEPS) - 1)]
+            notes.append(Note.from_ticks(chord.get_pitch(step, BASS_OCTAVE), note_ticks))
+        measure = Measure(self.song.beats_per_measure, notes)
+        measure.assign_chords([chord])
+        return measure
+
+    def make_pad_measure(self, chord):
+        """
+        The lowest tone of the triad is the measure's note, and the others are harmonies on the first beat - so the
+        triad is written as one chord.
+        """
+        pitches = sorted([chord.get_pitch(step, PAD_OCTAVE) for step in PAD_STEPS], key=lambda pitch: pitch.value)
+        measure = Measure(self.song.beats_per_measure, [Note(pitches[0], self.song.beats_per_measure)])
+        measure.assign_chords([chord])
+        for pitch in pitches[1:]:
+            measure.harmonies.append((0, Note(pitch, self.song.beats_per_measure)))
+        return measure
+
+    def get_final_measure(self, last_measure):
+        """
+        :param last_measure: the part's last measure before the final measure
+        :return: Measure object, on the I chord like the melody's final measure
+        """
+        final_chord = get_chord(self.song.key, 1, "maj")
+        if self.part.role == "counter":
+            return self.melody_engine.get_final_measure(self.song.beats_per_measure, final_chord,
+                                                        last_measure._notes[-1].pitch)
+        elif self.part.role == "bass":
+            measure = Measure(self.song.beats_per_measure,
+                              [Note(final_chord.get_pitch(1, BASS_OCTAVE), self.song.beats_per_measure)])
+            measure.assign_chords([final_chord])
+            return measure
+        return self.make_pad_measure(final_chord)
+
+    def create_part_measures(self):
+        """
+        Generates each unique section of the part once, and populates the part's measures.
+        """
+        for section in self.song.get_unique_sections():
+            self.part.set_section_measures(section, list(self.iter_section_measures(section)))
+        last_measure = self.part.get_section_measures(self.song.section_structure[-1])[-1]
+        self.part.populate_measures(self.song.section_structure, self.get_final_measure(last_measure))
+
+    def iter_part_measures(self):
+        """
+        Same as MelodyEngine.iter_song_measures, for the part - every measure is generated as it's needed, and
+        sections are generated again for their repeats, so only the measure being yielded is alive at any time.
+        """
+        last_measure = None
+        for section in self.song.section_structure:
+            for measure in self.iter_section_measures(section):
+                yield measure
+                last_measure = measure
+        yield self.get_final_measure(last_measure)
+
+
+def generate_parts(song, processes=1):
+    """
+    Generates and populates the measures of every part of the song. Chord progressions must already be set.
+
+    With more than one process, each part is generated in its own process of a multiprocessing.Pool. Workers get the
+    song in the serialize.py format rather than pickled, and send each part's measures back the same way. The parts
+    come out the same however many processes there are.
+
+    Args:
+        song (Song)
+        processes (int): Most parts generated at once
+    """
+    if processes <= 1 or len(song.parts) <= 1:
+        for part in song.parts:
+            PartEngine(song, part).create_part_measures()
+        return
+
+    song_data = encode_song(song)
+    jobs = [(song_data, part.part_id, part.role, part.name) for part in song.parts]
+    pool = multiprocessing.Pool(min(processes, len(song.parts)))
+    try:
+        results = pool.map(_generate_part_job, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    for part, (section_data, final_data) in zip(song.parts, results):
+        for section, data in section_data.items():
+            part.set_section_measures(section, decode_measures(data, song.key))
+        part.populate_measures(song.section_structure, decode_measures(final_data, song.key)[0])
+
+
+def _generate_part_job(job):
+    """
+    Runs in a worker process of generate_parts.
+
+    :param job: tuple of the encoded song, and the part's id, role and name
+    :return: dict of section => encoded measures, and the encoded final measure
+    """
+    song_data, part_id, role, name = job
+    song = decode_song(song_data)
+    part = Part(part_id, role, name)
+    PartEngine(song, part).create_part_measures()
+    section_data = dict([(section, encode_measures(part.get_section_measures(section)))
+                         for section in song.get_unique_sections()])
+    return section_data, encode_measures(part.get_measures()[-1:])
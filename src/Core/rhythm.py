@@ -1,47 +1,68 @@
 import random
 
+from music_theory import PPQ, EIGHTH_TICKS, beats_to_ticks, ticks_to_beats
+
 """
 rhythm.py
 
-This module is responsible for generating rhythms, represented as lists of floats.
+This module is responsible for generating rhythms, represented as lists of ticks (see music_theory.PPQ).
+gen_rhythm() still returns beats (floats), for older callers.
 
 Currently, rhythms are generated for an entire section at a time (i.e. many measures).
 """
 
 global_notes = [3,2,1.5,1,0.5] #Notes to use. More will be included in future versions!
 
-def gen_rhythm(num_measures,beats_per_measure,note_length_weight=3,notes=global_notes):
+def gen_rhythm(num_measures,beats_per_measure,note_length_weight=3,notes=global_notes,rng=random):
+    """
+    Same as gen_rhythm_ticks, but the rhythm is returned in beats.
+    """
+    return [ticks_to_beats(t) for t in iter_rhythm_ticks(num_measures,beats_per_measure,note_length_weight,notes,rng)]
+
+def gen_rhythm_ticks(num_measures,beats_per_measure,note_length_weight=3,notes=global_notes,rng=random):
     """
     
     :param num_measures:
     :param beats_per_measure:
     :param note_length_weight: 1 - 5 inclusive!
-    :return:
+    :param notes: note lengths to choose from, in beats
+    :param rng: source of randomness - the random module, or a random.Random
+    :return: list of note lengths, in ticks
+    """
+    return list(iter_rhythm_ticks(num_measures,beats_per_measure,note_length_weight,notes,rng))
+
+def iter_rhythm_ticks(num_measures,beats_per_measure,note_length_weight=3,notes=global_notes,rng=random):
     """
-    total_beats = beats_per_measure*num_measures
+    Generator version of gen_rhythm_ticks - yields note lengths (in ticks) as they're decided on, so that a long
+    section's rhythm never has to be held in memory.
+    """
+    measure_ticks = beats_to_ticks(beats_per_measure)
+    total_ticks = measure_ticks*num_measures
     if notes == global_notes:
         notes = get_weighted_list(note_length_weight)
-    result = []
-    while(sum(result) < total_beats):
-        current_beat = sum(result)
-        total_remaining = total_beats-current_beat
-        remaining_in_measure = total_remaining % 4
+    notes = [beats_to_ticks(n) for n in notes]
+    current_tick = 0
+    while(current_tick < total_ticks):
+        total_remaining = total_ticks-current_tick
+        remaining_in_measure = total_remaining % measure_ticks
         available_notes = [note for note in notes if note <= total_remaining]
 
-        if total_remaining % 1 == 0: #Downbeat
-            if random.random() > 0.5:
-                available_notes = [x for x in available_notes if x != 0.5]
-        if random.random() < 0.6:
+        on_downbeat = total_remaining % PPQ == 0
+        if on_downbeat:
+            if rng.random() > 0.5:
+                available_notes = [x for x in available_notes if x != EIGHTH_TICKS]
+        if rng.random() < 0.6:
             notes_that_fit_measure = [x for x in available_notes if x <= remaining_in_measure]
             if len(notes_that_fit_measure) > 0:
                 available_notes = notes_that_fit_measure
 
-        note = available_notes[random.randint(0,len(available_notes)-1)]
-        result.append(note)
-        if total_remaining % 1 == 0 and total_remaining > 0 and note == 0.5:
-            if random.random() > 0.5:
-                result.append(0.5)
-    return result
+        note = available_notes[rng.randint(0,len(available_notes)-1)]
+        yield note
+        current_tick += note
+        if on_downbeat and note == EIGHTH_TICKS:
+            if rng.random() > 0.5:
+                yield EIGHTH_TICKS
+                current_tick += EIGHTH_TICKS
 
 def get_weighted_list(weight):
     shifted_weight = weight-3
@@ -52,11 +73,16 @@ def get_weighted_list(weight):
     return result
 
 def count_over_measure_ties(rhythm,beats_per_measure):
+    """
+    :param rhythm: list of note lengths, in beats
+    :return: number of notes in the rhythm that cross a barline
+    """
+    measure_ticks = beats_to_ticks(beats_per_measure)
     result = 0
-    current_beat = 0
+    current_tick = 0
     for note in rhythm:
-        current_measure = current_beat / beats_per_measure
-        current_beat = current_beat + note
-        if int(current_beat / beats_per_measure) > current_measure and current_beat % beats_per_measure != 0:
+        current_measure = current_tick // measure_ticks
+        current_tick = current_tick + beats_to_ticks(note)
+        if current_tick // measure_ticks > current_measure and current_tick % measure_ticks != 0:
             result += 1
     return result
\ No newline at end of file
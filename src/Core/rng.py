@@ -0,0 +1,76 @@
+import hashlib
+import random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""
+rng.py
+
+Seedable, independent random streams.
+
+Nothing in the generation pipeline should draw from the global random module - if it did, what a stage generates would
+depend on everything that ran before it. Instead, each song has a RandomContext, and each stage asks it for its own
+random.Random, named by a path like ("melody", "A"). The seed of each stream is a hash of the song's seed and that path,
+so a stream always gives the same numbers whichever other stages ran, in whatever order, in whatever process.
+
+i.e.    RandomContext(42).get_random("melody", "A")     # Always the same melody for section A of song 42
+        RandomContext(42).derive("song", 7)             # Context for the 8th song of a corpus seeded with 42
+"""
+
+
+class RandomContext:
+    """
+    Fields:
+        seed (int)
+    """
+
+    seed = None
+
+    def __init__(self, seed=None):
+        """
+        Args:
+            seed (int): Seed of the context, or None for a random one
+        """
+        if seed is None:
+            seed = random.getrandbits(63)
+        self.seed = seed
+
+    def __str__(self):
+        return "RandomContext(" + str(self.seed) + ")"
+
+    def derive_seed(self, *path):
+        """
+        Args:
+            *path: Names (str or int) identifying what the seed is for
+        Returns:
+            (int): A 63-bit seed that only depends on this context's seed and the path
+        """
+        key = str(self.seed) + ":" + "/".join([str(name) for name in path])
+        return int(hashlib.sha1(key).hexdigest()[:16], 16) >> 1
+
+    def derive(self, *path):
+        """
+        Returns:
+            (RandomContext): A child context - i.e. for one song out of a corpus
+        """
+        return RandomContext(self.derive_seed(*path))
+
+    def get_random(self, *path):
+        """
+        Returns:
+            (random.Random): A new random stream for the given path. Calling this again with the same path gives a
+                stream that starts over with the same numbers.
+        """
+        return random.Random(self.derive_seed(*path))
+
+    def get_numpy_random(self, *path):
+        """
+        Returns:
+            (numpy.random.RandomState): A NumPy random stream for the given path, for the batch functions in batch.py
+        """
+        if numpy is None:
+            raise RuntimeError("NumPy random streams need NumPy.")
+        return numpy.random.RandomState(self.derive_seed("numpy", *path) & 0xffffffff)
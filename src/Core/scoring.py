@@ -0,0 +1,287 @@
+import csv
+from itertools import islice
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from music_theory import MELODIC_ALLOWANCES, get_note_index, scale_steps
+from serialize import encode_song, scan_song
+
+"""
+scoring.py
+
+Quality metrics for whole corpora of songs at once - so that millions of generated songs can be ranked, and filtered
+down to the best ones.
+
+Songs are packed into flat NumPy arrays, with the melody notes of every song back to back (see PackedSongs), and each
+metric is computed for every song with a handful of NumPy operations over those arrays, instead of a loop over each
+song's notes like get_percent_valid_notes. Packing works on songs encoded by serialize.py (i.e. from a corpus file),
+and never builds the Note or Measure objects: notes are gathered straight out of the encoded data.
+
+The result is a metrics table - a NumPy structured array with a row per song and a field per metric (see METRICS),
+which can be filtered like any array, i.e. metrics[metrics["chord_fit"] > 0.9].
+"""
+
+METRICS = [
+    ("notes", "i4"),            # Melody notes - a note tied over a barline counts as two
+    ("measures", "i4"),
+    ("chord_fit", "f4"),        # Fraction of the melody, by length, that fits the chord behind it (as in
+                                # get_percent_valid_notes)
+    ("ties", "i4"),             # Melody notes tied over a barline (as in rhythm.count_over_measure_ties)
+    ("range", "i2"),            # Half steps from the lowest melody note to the highest
+    ("mean_step", "f4"),        # Mean size of the moves from one melody note to the next, in scale steps - not
+                                # counting tied notes
+    ("repeats", "f4"),          # Fraction of those moves that repeat the note (0 scale steps), ...
+    ("steps", "f4"),            # ... that are steps (1), ...
+    ("skips", "f4"),            # ... skips (2) ...
+    ("leaps", "f4"),            # ... and leaps (3 or more)
+    ("chord_entropy", "f4"),    # Bits - how evenly the song's measures are spread over different chords
+    ("distinct_chords", "i1"),
+]
+
+_NOTE_SIZE = 4  # A note in serialize.py's format - pitch value (byte), ticks (ushort), tie (byte)
+_TIE_START = 1
+
+
+def _require_numpy():
+    if numpy is None:
+        raise RuntimeError("Scoring needs NumPy.")
+
+
+def _get_fit_table():
+    """
+    Returns:
+        (numpy.ndarray): 8x7 bools - table[chord step][scale degree], the same test as Chord.note_fits
+    """
+    table = numpy.zeros((8, 7), bool)
+    for chord_step in range(1, 8):
+        triad = [(chord_step - 1) % 7, (chord_step + 1) % 7, (chord_step + 3) % 7]
+        table[chord_step, triad + [x - 1 for x in MELODIC_ALLOWANCES.get(chord_step, [])]] = True
+    return table
+
+
+def _get_degree_table():
+    """
+    Returns:
+        (numpy.ndarray): The scale degree (0-6) of each number of half steps above the key's root, or -1 if it isn't in
+            the key
+    """
+    table = numpy.full(12, -1, numpy.int16)
+    table[scale_steps] = numpy.arange(7)
+    return table
+
+
+class PackedSongs:
+    """
+    The melodies of many songs, as flat arrays. Song i's notes are notes[note_offsets[i]:note_offsets[i + 1]] in each
+    of the note arrays, and its measures are likewise measure_offsets[i]:measure_offsets[i + 1].
+
+    Fields:
+        count (int)                             Number of songs
+        note_offsets (numpy.ndarray)            count + 1 ints
+        values (numpy.ndarray)                  Pitch value of every note
+        scale_indices (numpy.ndarray)           Scale index of every note (see Pitch.scale_index)
+        degrees (numpy.ndarray)                 Scale degree (0-6) of every note, or -1 if it isn't in the key
+        ticks (numpy.ndarray)                   Length of every note
+        tie_starts (numpy.ndarray)              bool for every note - is it tied to the next one?
+        chord_steps (numpy.ndarray)             Step of the chord behind every note
+        measure_offsets (numpy.ndarray)         count + 1 ints
+        measure_chord_steps (numpy.ndarray)     Step of every measure's chord
+    """
+
+    def __init__(self, note_offsets, values, scale_indices, degrees, ticks, tie_starts, chord_steps, measure_offsets,
+                 measure_chord_steps):
+        self.count = len(note_offsets) - 1
+        self.note_offsets = note_offsets
+        self.values = values
+        self.scale_indices = scale_indices
+        self.degrees = degrees
+        self.ticks = ticks
+        self.tie_starts = tie_starts
+        self.chord_steps = chord_steps
+        self.measure_offsets = measure_offsets
+        self.measure_chord_steps = measure_chord_steps
+
+    def get_note_songs(self):
+        """
+        Returns:
+            (numpy.ndarray): Index of the song that each note is in
+        """
+        return numpy.repeat(numpy.arange(self.count), numpy.diff(self.note_offsets))
+
+    def get_measure_songs(self):
+        return numpy.repeat(numpy.arange(self.count), numpy.diff(self.measure_offsets))
+
+
+def pack_encoded_songs(datas):
+    """
+    Packs songs encoded by serialize.encode_song - whole songs, with their measures populated.
+
+    Each measure's position in the data is found with serialize.scan_song, and then the notes of every measure of
+    every song are gathered out of the data in one go.
+
+    Args:
+        datas (iterable of str or buffer): i.e. from corpus.iter_encoded, or songpool.SongRecord.data
+    Returns:
+        (PackedSongs)
+    """
+    _require_numpy()
+    datas = [str(data) for data in datas]
+    measures = []  # (chord step, notes offset, note count) of every measure of every song, in order
+    song_measures = []
+    key_values = []
+    for data in datas:
+        root_note, beats_per_measure, section_structure, sections, final_measure = scan_song(data)
+        count = len(measures)
+        for letter in section_structure:
+            measures.extend(sections[letter])
+        if final_measure is not None:
+            measures.append(final_measure)
+        song_measures.append(len(measures) - count)
+        key_values.append(get_note_index(root_note))
+
+    measures = numpy.array(measures, numpy.int64).reshape(-1, 3)
+    song_measures = numpy.array(song_measures, numpy.int64)
+    measure_offsets = numpy.concatenate([[0], numpy.cumsum(song_measures)])
+    # Offsets are within each song's data - make them offsets into all of the data, joined together
+    data_offsets = numpy.cumsum([0] + [len(data) for data in datas])[:-1]
+    measures[:, 1] += numpy.repeat(data_offsets, song_measures)
+
+    counts = measures[:, 2]
+    first_notes = numpy.cumsum(counts) - counts  # Index of each measure's first note
+    note_positions = numpy.arange(counts.sum()) - numpy.repeat(first_notes, counts)
+    byte_offsets = numpy.repeat(measures[:, 1], counts) + note_positions * _NOTE_SIZE
+    joined = numpy.frombuffer("".join(datas), numpy.uint8)
+    values = joined[byte_offsets].astype(numpy.int16)
+    ticks = joined[byte_offsets + 1].astype(numpy.int32) | (joined[byte_offsets + 2].astype(numpy.int32) << 8)
+    tie_starts = joined[byte_offsets + 3] == _TIE_START
+
+    song_notes = numpy.bincount(numpy.repeat(numpy.arange(len(datas)), song_measures), weights=counts,
+                                minlength=len(datas)).astype(numpy.int64)
+    note_offsets = numpy.concatenate([[0], numpy.cumsum(song_notes)])
+    relative_values = values - numpy.repeat(numpy.array(key_values, numpy.int16), song_notes)
+    degrees = _get_degree_table()[relative_values % 12]
+    scale_indices = 7 * (relative_values // 12) + degrees
+    chord_steps = numpy.repeat(measures[:, 0], counts).astype(numpy.int8)
+    return PackedSongs(note_offsets, values, scale_indices, degrees, ticks, tie_starts, chord_steps,
+                       measure_offsets, measures[:, 0].astype(numpy.int8))
+
+
+def pack_songs(songs):
+    """
+    Args:
+        songs (iterable of Song): Songs with their measures populated
+    Returns:
+        (PackedSongs)
+    """
+    return pack_encoded_songs([encode_song(song) for song in songs])
+
+
+def score_packed_songs(packed):
+    """
+    Returns:
+        (numpy.ndarray): The metrics table - a row for each song, with the fields in METRICS
+    """
+    _require_numpy()
+    count = packed.count
+    metrics = numpy.zeros(count, METRICS)
+    if count == 0:
+        return metrics
+    note_songs = packed.get_note_songs()
+    note_counts = numpy.diff(packed.note_offsets)
+    metrics["notes"] = note_counts
+    metrics["measures"] = numpy.diff(packed.measure_offsets)
+
+    fits = _get_fit_table()[packed.chord_steps, packed.degrees] & (packed.degrees >= 0)
+    fitting_ticks = numpy.bincount(note_songs, weights=packed.ticks * fits, minlength=count)
+    total_ticks = numpy.bincount(note_songs, weights=packed.ticks, minlength=count)
+    metrics["chord_fit"] = fitting_ticks / numpy.maximum(total_ticks, 1)
+    metrics["ties"] = numpy.bincount(note_songs, weights=packed.tie_starts, minlength=count)
+
+    has_notes = note_counts > 0
+    starts = packed.note_offsets[:-1][has_notes]
+    metrics["range"][has_notes] = (numpy.maximum.reduceat(packed.values, starts) -
+                                   numpy.minimum.reduceat(packed.values, starts))
+
+    # A move is from one note to the next in the same song - unless the first note is tied to the second
+    moves = (note_songs[1:] == note_songs[:-1]) & ~packed.tie_starts[:-1]
+    move_songs = note_songs[1:][moves]
+    sizes = numpy.abs(numpy.diff(packed.scale_indices))[moves]
+    num_moves = numpy.maximum(numpy.bincount(move_songs, minlength=count), 1).astype(float)
+    metrics["mean_step"] = numpy.bincount(move_songs, weights=sizes, minlength=count) / num_moves
+    histogram = numpy.bincount(move_songs * 4 + numpy.minimum(sizes, 3), minlength=count * 4).reshape(count, 4)
+    for i, field in enumerate(("repeats", "steps", "skips", "leaps")):
+        metrics[field] = histogram[:, i] / num_moves
+
+    chord_counts = numpy.bincount(packed.get_measure_songs() * 8 + packed.measure_chord_steps,
+                                  minlength=count * 8).reshape(count, 8).astype(float)
+    probabilities = chord_counts / numpy.maximum(chord_counts.sum(axis=1), 1)[:, numpy.newaxis]
+    logs = numpy.log2(numpy.where(probabilities > 0, probabilities, 1))
+    metrics["chord_entropy"] = -(probabilities * logs).sum(axis=1)
+    metrics["distinct_chords"] = (chord_counts > 0).sum(axis=1)
+    return metrics
+
+
+def score_songs(songs):
+    """
+    Returns:
+        (numpy.ndarray): The metrics table for songs (with their measures populated)
+    """
+    return score_packed_songs(pack_songs(songs))
+
+
+def score_encoded_songs(datas, batch_size=10000):
+    """
+    Scores any number of encoded songs, packing batch_size of them at a time - so memory use doesn't grow with the
+    size of the corpus, other than for the metrics table itself.
+
+    Returns:
+        (numpy.ndarray): The metrics table for the songs, in order
+    """
+    _require_numpy()
+    datas = iter(datas)
+    tables = []
+    while True:
+        batch = list(islice(datas, batch_size))
+        if len(batch) == 0:
+            break
+        tables.append(score_packed_songs(pack_encoded_songs(batch)))
+    if len(tables) == 0:
+        return numpy.zeros(0, METRICS)
+    return numpy.concatenate(tables)
+
+
+def rank_songs(metrics, weights):
+    """
+    Ranks songs by a weighted sum of their metrics, each scaled to a z-score across the table first.
+
+    Args:
+        metrics (numpy.ndarray): A metrics table
+        weights (dict): Field name => weight - i.e. {"chord_fit": 1, "leaps": -0.5} for songs that fit their chords
+            but don't jump around
+    Returns:
+        (numpy.ndarray): Indices of the songs in the table, best first
+    """
+    _require_numpy()
+    scores = numpy.zeros(len(metrics))
+    for field, weight in weights.items():
+        column = metrics[field].astype(float)
+        deviation = column.std()
+        if deviation > 0:
+            scores += weight * (column - column.mean()) / deviation
+    return numpy.argsort(-scores, kind="mergesort")
+
+
+def write_metrics_csv(metrics, file_name):
+    """
+    Writes a metrics table to file_name as CSV, with a "song" column holding each row's index. Fractions are written
+    to the 7 significant digits that float32 holds, rather than the float64 digits it would be printed with.
+    """
+    with open(file_name, "wb") as f:
+        writer = csv.writer(f)
+        writer.writerow(("song",) + metrics.dtype.names)
+        for song_number, row in enumerate(metrics.tolist()):
+            writer.writerow((song_number,) + tuple(["%.7g" % value if isinstance(value, float) else value
+                                                    for value in row]))
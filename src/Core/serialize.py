@@ -0,0 +1,303 @@
+import struct
+from array import array
+
+from music_theory import Note, Pitch, beats_to_ticks, ticks_to_beats
+from chords import get_chord
+from song_data import Song, Section, Measure
+from rng import RandomContext
+
+"""
+serialize.py
+
+A compact, versioned binary format for Song objects - much smaller and faster than MusicXML, and unlike pickle it only
+stores the song's own data (pitch values, ticks and chord steps), not the KeySignature/Pitch/Chord objects around it.
+
+Layout (little-endian). A "string" is a byte with its length, followed by its bytes.
+
+    header      "MMSNG", version (byte)
+    song        key root note (string), beats per measure (byte), random seed (int64),
+                section structure (ushort count, then a string per section)
+    sections    ushort count, then per unique section:
+                    letter (string), num_measures (ushort), num_chords (ushort), rhythm weight (byte), flags (byte),
+                    progression (ushort count + steps) if it has one,
+                    measures (ushort count + measures) if it has them, or else melody (ushort count + notes)
+    final       flag (byte), then the final measure if the song's measures are populated
+
+    measure     ticks (ushort), chords (byte count + (step, chord type) bytes), notes (ushort count + notes),
+                harmonies (ushort count + (tick, note))
+    note        pitch value (byte), ticks (ushort), tie (byte: 0 none, 1 start, 2 stop)
+
+Songs are written and read in a single pass. Repeated sections aren't stored again - they're rebuilt from the
+section's measures (see Song.populate_measures), so they share Measure objects just as they did before.
+"""
+
+_MAGIC = "MMSNG"
+_VERSION = 2
+
+_HEADER = struct.Struct("<5sB")
+_SONG = struct.Struct("<Bq")
+_SECTION = struct.Struct("<HHBB")
+_MEASURE = struct.Struct("<H")
+_CHORD = struct.Struct("<BB")
+_NOTE = struct.Struct("<BHB")
+_BYTE = struct.Struct("<B")
+_USHORT = struct.Struct("<H")
+
+_HAS_PROGRESSION = 1
+_HAS_MEASURES = 2
+_HAS_MELODY = 4
+
+_TIES = (None, "start", "stop")
+_CHORD_TYPES = ("maj", "min", "dim", "aug")
+
+
+def encode_song(song):
+    """
+    Args:
+        song (Song)
+    Returns:
+        (str): The song in the binary format above
+    """
+    parts = [_HEADER.pack(_MAGIC, _VERSION)]
+    _encode_string(parts, song.key.root_note)
+    parts.append(_SONG.pack(song.beats_per_measure, song.random_context.seed))
+    parts.append(_USHORT.pack(len(song.section_structure)))
+    for letter in song.section_structure:
+        _encode_string(parts, letter)
+
+    sections = song.get_unique_sections()
+    parts.append(_USHORT.pack(len(sections)))
+    for letter in sections:
+        section = song._section_attributes[letter]
+        flags = 0
+        if section.progression is not None:
+            flags |= _HAS_PROGRESSION
+        if section.measures is not None:
+            flags |= _HAS_MEASURES
+        elif section.melody is not None:
+            flags |= _HAS_MELODY
+        _encode_string(parts, letter)
+        parts.append(_SECTION.pack(section.num_measures, section.num_chords, section.rhythm_weight, flags))
+        if flags & _HAS_PROGRESSION:
+            parts.append(_USHORT.pack(len(section.progression)))
+            parts.append(array("B", section.progression).tostring())
+        if flags & _HAS_MEASURES:
+            parts.append(_USHORT.pack(len(section.measures)))
+            for measure in section.measures:
+                _encode_measure(parts, measure)
+        elif flags & _HAS_MELODY:
+            parts.append(_USHORT.pack(len(section.melody)))
+            for note in section.melody:
+                _encode_note(parts, note)
+
+    if len(song._measures) > 0:
+        parts.append(_BYTE.pack(1))
+        _encode_measure(parts, song._measures[-1])
+    else:
+        parts.append(_BYTE.pack(0))
+    return "".join(parts)
+
+
+def decode_song(data):
+    """
+    Args:
+        data (str): From encode_song()
+    Returns:
+        (Song)
+    Raises:
+        ValueError: If data isn't a song in this version of the format
+    """
+    reader = _Reader(data)
+    magic, version = reader.read(_HEADER)
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError("Not a version " + str(_VERSION) + " song!")
+    root_note = reader.read_string()
+    beats_per_measure, seed = reader.read(_SONG)
+    section_structure = [reader.read_string() for x in range(reader.read(_USHORT)[0])]
+
+    sections = {}
+    song = Song(root_note, beats_per_measure, section_structure, sections, RandomContext(seed))
+    for x in range(reader.read(_USHORT)[0]):
+        letter = reader.read_string()
+        num_measures, num_chords, rhythm_weight, flags = reader.read(_SECTION)
+        section = sections[letter] = Section(letter, num_measures, num_chords)
+        section.rhythm_weight = rhythm_weight
+        if flags & _HAS_PROGRESSION:
+            count = reader.read(_USHORT)[0]
+            section.set_progression(tuple(array("B", reader.read_bytes(count))), song.key)
+        if flags & _HAS_MEASURES:
+            section.set_measures([_decode_measure(reader, song.key) for y in range(reader.read(_USHORT)[0])])
+        elif flags & _HAS_MELODY:
+            section.set_melody([_decode_note(reader, song.key) for y in range(reader.read(_USHORT)[0])])
+
+    if reader.read(_BYTE)[0]:
+        song.populate_measures()
+        song.append_final_measure(_decode_measure(reader, song.key))
+    if reader.offset != len(data):
+        raise ValueError("Unexpected data after the end of the song!")
+    return song
+
+
+def scan_song(data):
+    """
+    Reads where everything is in an encoded song, without building any objects from it - for code that works on the
+    encoded data directly, i.e. scoring.py.
+
+    Args:
+        data (str or buffer): From encode_song()
+    Returns:
+        (tuple): root note (str), beats per measure (int), section structure (list of str), a dict mapping each
+            section's letter to its measures, and the final measure (or None). Each measure is a tuple of its first
+            chord's step, and the offset and count of its notes in data - notes are stored back to back, in the
+            format above.
+    Raises:
+        ValueError: If data isn't a song in this version of the format, or a section has no measures (only a melody)
+    """
+    reader = _Reader(data)
+    magic, version = reader.read(_HEADER)
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError("Not a version " + str(_VERSION) + " song!")
+    root_note = reader.read_string()
+    beats_per_measure, seed = reader.read(_SONG)
+    section_structure = [reader.read_string() for x in range(reader.read(_USHORT)[0])]
+
+    sections = {}
+    for x in range(reader.read(_USHORT)[0]):
+        letter = reader.read_string()
+        num_measures, num_chords, rhythm_weight, flags = reader.read(_SECTION)
+        if flags & _HAS_PROGRESSION:
+            reader.skip(reader.read(_USHORT)[0])
+        if not flags & _HAS_MEASURES:
+            raise ValueError("Section " + letter + " has no measures!")
+        sections[letter] = [_scan_measure(reader) for y in range(reader.read(_USHORT)[0])]
+
+    final_measure = _scan_measure(reader) if reader.read(_BYTE)[0] else None
+    if reader.offset != len(data):
+        raise ValueError("Unexpected data after the end of the song!")
+    return root_note, beats_per_measure, section_structure, sections, final_measure
+
+
+def encode_measures(measures):
+    """
+    Args:
+        measures (list of Measure)
+    Returns:
+        (str): The measures in the binary format above - a ushort count, then the measures. i.e. for passing
+            measures between processes (see parts.generate_parts) without pickling their objects.
+    """
+    parts = [_USHORT.pack(len(measures))]
+    for measure in measures:
+        _encode_measure(parts, measure)
+    return "".join(parts)
+
+
+def decode_measures(data, key):
+    """
+    Args:
+        data (str): From encode_measures()
+        key (KeySignature): Key of the song the measures are from
+    Returns:
+        (list of Measure)
+    """
+    reader = _Reader(data)
+    measures = [_decode_measure(reader, key) for x in range(reader.read(_USHORT)[0])]
+    if reader.offset != len(data):
+        raise ValueError("Unexpected data after the end of the measures!")
+    return measures
+
+
+def write_song(song, file_name):
+    with open(file_name, "wb") as f:
+        f.write(encode_song(song))
+
+
+def read_song(file_name):
+    with open(file_name, "rb") as f:
+        return decode_song(f.read())
+
+
+def _encode_string(parts, string):
+    parts.append(_BYTE.pack(len(string)))
+    parts.append(string)
+
+
+def _encode_note(parts, note):
+    parts.append(_NOTE.pack(note.pitch.value, note.ticks, _TIES.index(note.tie)))
+
+
+def _encode_measure(parts, measure):
+    parts.append(_MEASURE.pack(measure.ticks))
+    parts.append(_BYTE.pack(len(measure.chords)))
+    for chord in measure.chords:
+        parts.append(_CHORD.pack(chord.step, _CHORD_TYPES.index(chord.chord_type)))
+    parts.append(_USHORT.pack(len(measure._notes)))
+    for note in measure._notes:
+        _encode_note(parts, note)
+    parts.append(_USHORT.pack(len(measure.harmonies)))
+    for beat, note in measure.harmonies:
+        parts.append(_USHORT.pack(beats_to_ticks(beat)))
+        _encode_note(parts, note)
+
+
+def _scan_measure(reader):
+    reader.read(_MEASURE)
+    num_chords = reader.read(_BYTE)[0]
+    chord_step = reader.read(_CHORD)[0] if num_chords > 0 else 0
+    reader.skip((num_chords - 1) * _CHORD.size if num_chords > 0 else 0)
+    num_notes = reader.read(_USHORT)[0]
+    notes_offset = reader.offset
+    reader.skip(num_notes * _NOTE.size)
+    reader.skip(reader.read(_USHORT)[0] * (_USHORT.size + _NOTE.size))
+    return chord_step, notes_offset, num_notes
+
+
+def _decode_note(reader, key):
+    value, ticks, tie = reader.read(_NOTE)
+    return Note.from_ticks(Pitch(value, key), ticks, _TIES[tie])
+
+
+def _decode_measure(reader, key):
+    ticks = reader.read(_MEASURE)[0]
+    chords = []
+    for x in range(reader.read(_BYTE)[0]):
+        step, chord_type = reader.read(_CHORD)
+        chords.append(get_chord(key, step, _CHORD_TYPES[chord_type]))
+    measure = Measure(ticks_to_beats(ticks), [_decode_note(reader, key) for x in range(reader.read(_USHORT)[0])])
+    measure.assign_chords(chords)
+    for x in range(reader.read(_USHORT)[0]):
+        tick = reader.read(_USHORT)[0]
+        measure.harmonies.append((ticks_to_beats(tick), _decode_note(reader, key)))
+    return measure
+
+
+class _Reader:
+    """
+    Reads through a str of encoded data, front to back.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, structure):
+        try:
+            values = structure.unpack_from(self.data, self.offset)
+        except struct.error:
+            raise ValueError("Song data ends unexpectedly!")
+        self.offset += structure.size
+        return values
+
+    def read_bytes(self, length):
+        if self.offset + length > len(self.data):
+            raise ValueError("Song data ends unexpectedly!")
+        result = self.data[self.offset:self.offset + length]
+        self.offset += length
+        return result
+
+    def skip(self, length):
+        if self.offset + length > len(self.data):
+            raise ValueError("Song data ends unexpectedly!")
+        self.offset += length
+
+    def read_string(self):
+        return self.read_bytes(self.read(_BYTE)[0])
@@ -0,0 +1,228 @@
+import os
+import struct
+import sys
+import zlib
+from array import array
+from collections import deque
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""
+similarity.py
+
+Near-duplicate detection across a whole corpus of songs, using MinHash signatures and locality-sensitive hashing.
+
+A song is boiled down to a set of "shingles" - n-grams of the chord steps in each section's progression, and n-grams of
+the intervals (in scale steps) between consecutive melody notes. The MinHash signature of that set estimates the Jaccard
+similarity between two songs, and splitting signatures into bands means a query only has to look at songs that share at
+least one whole band with it, instead of every song in the corpus.
+
+With NumPy, a signature is computed for every hash function and shingle at once. Without it, the same values are worked
+out one at a time.
+"""
+
+PROGRESSION_NGRAM = 3
+MELODY_NGRAM = 4
+
+_PRIME = (1 << 31) - 1  # Keeps (a*x + b) inside an int64
+_MAGIC = "MMLSH"
+_VERSION = 1
+_HEADER = struct.Struct("<5sBHHI")  # magic, version, bands, rows, number of songs
+
+
+def get_song_shingles(song, section_notes=None):
+    """
+    Args:
+        song (Song): A song with chord progressions and melodies
+        section_notes (callable): Section => iterable of the section's melody notes, for songs that don't keep their
+            melodies (i.e. in --stream mode) - by default, each section's melody in the song
+    Returns:
+        (set of int): Hashed progression and melody n-grams of the song
+    """
+    if section_notes is None:
+        section_notes = song.get_section_melody
+    shingles = set()
+    for progression in song.get_all_progressions():
+        for i in range(len(progression) - PROGRESSION_NGRAM + 1):
+            shingles.add(_hash_ngram("p", progression[i:i + PROGRESSION_NGRAM]))
+    for section in song.get_unique_sections():
+        melody = section_notes(section)
+        if melody is None:
+            continue
+        # Intervals between notes, MELODY_NGRAM at a time - notes are read as they come, so the melody can be a generator
+        intervals = deque(maxlen=MELODY_NGRAM)
+        last_index = None
+        for note in melody:
+            if note.tie == "stop":
+                continue
+            index = get_scale_index(note.pitch)
+            if last_index is not None:
+                intervals.append(index - last_index)
+                if len(intervals) == MELODY_NGRAM:
+                    shingles.add(_hash_ngram("m", list(intervals)))
+            last_index = index
+    return shingles
+
+
+def get_scale_index(pitch):
+    """
+    Args:
+        pitch (Pitch)
+    Returns:
+        (int): Number of scale steps between the pitch and the root of its key in octave 0
+    """
+    return pitch.scale_index
+
+
+def _hash_ngram(kind, ngram):
+    return zlib.crc32(kind + struct.pack("<%db" % len(ngram), *ngram)) & _PRIME
+
+
+class SongIndex:
+    """
+    A persistent LSH index of song MinHash signatures.
+
+    Fields:
+        bands (int)                 Number of bands each signature is split into
+        rows (int)                  Number of MinHash values per band - signatures have bands*rows values
+        signatures (array of int)   Every indexed signature, back to back. The n-th song added is song n.
+        _buckets (list of dict)     One dict per band, mapping a hash of the band's values to a list of song numbers
+
+    More bands (or fewer rows) finds more candidates for a query, at the cost of checking more of them. The
+    probability that two songs become candidates is 1-(1-s**rows)**bands, where s is their Jaccard similarity.
+    """
+
+    bands = None
+    rows = None
+    signatures = None
+    _buckets = None
+    _coefficients = None
+    _a = None
+    _b = None
+
+    def __init__(self, bands=16, rows=4):
+        self.bands = bands
+        self.rows = rows
+        self.signatures = array("I")
+        self._buckets = [{} for x in range(bands)]
+        self._coefficients = [(zlib.crc32("a%d" % i) & _PRIME | 1, zlib.crc32("b%d" % i) & _PRIME)
+                              for i in range(bands * rows)]
+        if numpy is not None:
+            # As columns, so they broadcast against a row of shingles
+            self._a = numpy.array([a for a, b in self._coefficients], numpy.int64)[:, numpy.newaxis]
+            self._b = numpy.array([b for a, b in self._coefficients], numpy.int64)[:, numpy.newaxis]
+
+    def __len__(self):
+        return len(self.signatures) // (self.bands * self.rows)
+
+    def get_signature(self, song, section_notes=None):
+        """
+        Args:
+            song (Song)
+            section_notes (callable): See get_song_shingles
+        Returns:
+            (list of int): MinHash signature of the song
+        """
+        shingles = get_song_shingles(song, section_notes)
+        if len(shingles) == 0:
+            raise ValueError("Song has no progressions or melodies to index!")
+        if numpy is None:
+            return [min([(a * x + b) % _PRIME for x in shingles]) for a, b in self._coefficients]
+        # Every value is below 2**31, so a*x + b is below 2**63 and can't overflow
+        x = numpy.fromiter(shingles, numpy.int64, len(shingles))
+        return ((self._a * x + self._b) % _PRIME).min(axis=1).tolist()
+
+    def find_near_duplicate(self, signature, max_distance):
+        """
+        Args:
+            signature (list of int): From get_signature()
+            max_distance (float): 0 - 1, estimated Jaccard distance at or below which songs count as near-duplicates
+        Returns:
+            (int): Number of an indexed song within max_distance of the signature, or None
+        """
+        length = self.bands * self.rows
+        checked = set()
+        for band, band_hash in enumerate(self._get_band_hashes(signature)):
+            for song_number in self._buckets[band].get(band_hash, ()):
+                if song_number in checked:
+                    continue
+                checked.add(song_number)
+                offset = song_number * length
+                stored = self.signatures[offset:offset + length]
+                matches = sum([1 for x, y in zip(signature, stored) if x == y])
+                if 1 - float(matches) / length <= max_distance:
+                    return song_number
+        return None
+
+    def add(self, signature):
+        """
+        Args:
+            signature (list of int): From get_signature()
+        Returns:
+            (int): Number of the song in this index
+        """
+        song_number = len(self)
+        self.signatures.extend(signature)
+        self._add_to_buckets(signature, song_number)
+        return song_number
+
+    def truncate(self, num_songs):
+        """
+        Removes every song after the first num_songs - i.e. songs added after a checkpoint that's being resumed from.
+        """
+        if num_songs > len(self):
+            raise ValueError("The index only has " + str(len(self)) + " songs!")
+        length = self.bands * self.rows
+        del self.signatures[num_songs * length:]
+        for buckets in self._buckets:
+            for band_hash in buckets.keys():
+                song_numbers = [n for n in buckets[band_hash] if n < num_songs]
+                if len(song_numbers) > 0:
+                    buckets[band_hash] = song_numbers
+                else:
+                    del buckets[band_hash]
+
+    def _add_to_buckets(self, signature, song_number):
+        for band, band_hash in enumerate(self._get_band_hashes(signature)):
+            self._buckets[band].setdefault(band_hash, []).append(song_number)
+
+    def _get_band_hashes(self, signature):
+        rows = self.rows
+        return [hash(tuple(signature[band * rows:(band + 1) * rows])) for band in range(self.bands)]
+
+    def save(self, file_name):
+        """
+        Writes the signatures to file_name. The buckets aren't stored - they're rebuilt by load().
+
+        The index is written to a temporary file first, and renamed to file_name once it's complete - so if writing is
+        interrupted, file_name still holds the last index that was saved.
+
+        Signatures are little-endian, like the header, whatever the byte order of the machine.
+        """
+        signatures = self.signatures
+        if sys.byteorder == "big":
+            signatures = array("I", signatures)
+            signatures.byteswap()
+        temp_name = file_name + ".tmp"
+        with open(temp_name, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, self.bands, self.rows, len(self)))
+            signatures.tofile(f)
+        os.rename(temp_name, file_name)
+
+    @staticmethod
+    def load(file_name):
+        with open(file_name, "rb") as f:
+            magic, version, bands, rows, num_songs = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != _MAGIC or version != _VERSION:
+                raise ValueError(file_name + " is not a version " + str(_VERSION) + " song index!")
+            index = SongIndex(bands, rows)
+            index.signatures.fromfile(f, num_songs * bands * rows)
+        if sys.byteorder == "big":
+            index.signatures.byteswap()
+        length = bands * rows
+        for song_number in range(num_songs):
+            index._add_to_buckets(index.signatures[song_number * length:(song_number + 1) * length], song_number)
+        return index
@@ -1,7 +1,10 @@
 import random
+from bisect import bisect_right
 from datetime import timedelta  # For Song.getTimeWithBPM()
 
 from music_theory import *
+from chords import get_chords, progression_steps
+from rng import RandomContext
 
 
 class Song:
@@ -14,20 +17,38 @@ class Song:
         section_structure (list of str)         ['A','B','A'] etc.
 
         _section_attributes (dict str->Section) Maps 'A' to the Section object containing all section data
+        random_context (RandomContext)          Where every stage of generation gets its random numbers - see rng.py
         _measures (list of Measure)             All measures in the song - must be populated when section data is complete
+        _timeline (SongTimeline)                Built from _measures the first time it's needed
+        parts (list of Part)                    Parts played alongside the melody, which share its sections and chord
+                                                progressions - see parts.py
     """
     key = None
     beats_per_measure = None
     section_structure = None
+    random_context = None
+    parts = None
     _section_attributes = None
     _measures = None
+    _timeline = None
 
-    def __init__(self, key, beats_per_measure, section_structure, section_attributes):
+    def __init__(self, key, beats_per_measure, section_structure, section_attributes, random_context=None):
         self.key = KeySignature(key)
         self.beats_per_measure = beats_per_measure
         self.section_structure = section_structure
         self._section_attributes = section_attributes
+        self.random_context = random_context if random_context is not None else RandomContext()
         self._measures = []
+        self.parts = []
+
+    def get_random(self, *path):
+        """
+        Gets the random stream for a stage of generation, i.e. song.get_random("melody", "A"). See rng.py.
+
+        Returns:
+            (random.Random)
+        """
+        return self.random_context.get_random(*path)
 
     def populate_measures(self):
         """Takes all the data in _section_attributes and correctly populates the measures in this song.
@@ -39,12 +60,59 @@ class Song:
         for section_id in self.section_structure:
             for measure in section_measures[section_id]:
                 self._measures.append(measure)
+        self._timeline = None
 
     def get_measures(self):
         if len(self._measures) == 0:
             raise Exception("Song measures haven't yet been populated!")
         return self._measures
 
+    def get_timeline(self):
+        """
+        Returns:
+            (SongTimeline): Index of every note and chord in the song by tick - built once, after the measures are
+                populated
+        """
+        if self._timeline is None:
+            self._timeline = SongTimeline(self.get_measures())
+        return self._timeline
+
+    def iter_measure_positions(self):
+        """
+        Yields (section, position) for every measure of the song in order, not counting the final measure - i.e.
+        ('A', 0), ('A', 1), ... ('B', 0). Measures at the same position of the same section are identical.
+        """
+        for section in self.section_structure:
+            for position in range(self.num_measures_in_section(section)):
+                yield section, position
+
+    def get_accompaniment_random(self, index, position):
+        """
+        Gets the random stream for the accompaniment of a measure. Repeats of a section get the same accompaniment.
+
+        Args:
+            index (int): Index of the measure in the song
+            position (tuple): (section, position) of the measure (see iter_measure_positions), or None for the final
+                measure
+        Returns:
+            (random.Random)
+        """
+        if position is not None:
+            return self.get_random("accompaniment", *position)
+        return self.get_random("accompaniment", index)
+
+    def add_part(self, role, name=None):
+        """
+        Args:
+            role (str): One of PART_ROLES
+            name (str): Shown in the score - by default, the role's name
+        Returns:
+            (Part): The new part, without any measures yet. Its id follows the melody's "P1".
+        """
+        part = Part("P" + str(len(self.parts) + 2), role, name)
+        self.parts.append(part)
+        return part
+
     def get_measure_at_index(self, index):
         return self.get_measures()[index]
 
@@ -62,20 +130,36 @@ class Song:
         return self._section_attributes[section].num_chords
 
     def get_unique_sections(self):
-        return list(set(self.section_structure))
+        return sorted(set(self.section_structure))
 
     def set_chord_progression(self, section, chord_progression):
-        self._section_attributes[section].chord_progression = chord_progression
+        """
+        Args:
+            section (str)
+            chord_progression (tuple of int or list of Chord): Chord steps, or Chord objects - only the steps are kept
+        """
+        self._section_attributes[section].set_progression(
+            progression_steps(chord_progression) if chord_progression is not None else None, self.key)
 
     def set_section_melody(self, section_id, melody):
         self._section_attributes[section_id].set_melody(melody)
 
+    def set_section_measures(self, section_id, measures):
+        self._section_attributes[section_id].set_measures(measures)
+
     def get_section_melody(self, section_id):
         return self._section_attributes[section_id].get_melody()
 
     def get_chord_progression(self, section):
         return self._section_attributes[section].chord_progression
 
+    def get_progression(self, section):
+        """
+        Returns:
+            (tuple of int): The section's chord progression as chord steps
+        """
+        return self._section_attributes[section].progression
+
     def get_all_chord_progressions(self):
         result = []
         for section in self.get_unique_sections():
@@ -84,6 +168,18 @@ class Song:
                 result.append(chord_progression)
         return result
 
+    def get_all_progressions(self):
+        """
+        Returns:
+            (list of tuple of int): The chord progressions of all sections that have one, as chord steps
+        """
+        result = []
+        for section in self.get_unique_sections():
+            progression = self.get_progression(section)
+            if progression is not None:
+                result.append(progression)
+        return result
+
     def clear_all_chord_progressions(self):
         for section in self.get_unique_sections():
             self.set_chord_progression(section, None)
@@ -96,31 +192,39 @@ class Song:
 
     def append_final_measure(self, measure):
         self._measures.append(measure)
+        self._timeline = None
 
 
     @staticmethod
-    def create_random_attributes(key_signature=None, beats_per_measure=None, unique_sections=None, total_sections=None):
+    def create_random_attributes(key_signature=None, beats_per_measure=None, unique_sections=None, total_sections=None,
+                                 num_measures=16, random_context=None):
         """
         measures_per_section and chords_per_section must be random. They are different for every section.
+
+        num_measures is the number of measures in each section. random_context is the song's RandomContext - a new,
+        randomly seeded one by default.
         """
+        if random_context is None:
+            random_context = RandomContext()
+        rng = random_context.get_random("structure")
         if key_signature is None:
-            key_signature = get_flat_notes()[random.randint(0, 11)]
+            key_signature = get_flat_notes()[rng.randint(0, 11)]
         if beats_per_measure is None:
-            beats_per_measure = random.randint(2, 4)
+            beats_per_measure = rng.randint(2, 4)
 
         if unique_sections is None:
-            unique_sections = random.randint(2, 4)
+            unique_sections = rng.randint(2, 4)
         if total_sections is None:
-            total_sections = random.randint(4, 6)
-        section_structure = Section.get_rand_sectioning(total_sections, unique_sections)
+            total_sections = rng.randint(4, 6)
+        section_structure = Section.get_rand_sectioning(total_sections, unique_sections, rng)
         unique_sections = set(section_structure)
         section_attributes = {}
         for section in section_structure:
             # num_measures = 2 ** random.randint(2, 4)
-            num_measures = 16
-            num_chords = num_measures / (2 ** random.randint(0, 2))
+            divisors = [d for d in [1, 2, 4] if num_measures % d == 0]  # Chords have to divide the section evenly
+            num_chords = num_measures / divisors[rng.randint(0, len(divisors) - 1)]
             section_attributes[section] = Section(section, num_measures, num_chords)
-        return Song(key_signature, beats_per_measure, section_structure, section_attributes)
+        return Song(key_signature, beats_per_measure, section_structure, section_attributes, random_context)
 
 
 class Section:
@@ -131,15 +235,18 @@ class Section:
     letter          A
     num_measures    8
     num_chords      4
+    progression     (1, 4, 5, 1) - chord steps
     """
     letter = None
     num_measures = None
     num_chords = None
     melody = None
+    measures = None
 
     rhythm_weight = 3  # 1-5
 
-    chord_progression = None
+    progression = None
+    chord_progression = None  # The same progression as a list of (interned) Chord objects
 
     def __init__(self, letter, num_measures, num_chords, chord_progression=None, melody=None):
         if num_measures % num_chords != 0:
@@ -147,44 +254,36 @@ class Section:
         self.letter = letter
         self.num_measures = num_measures
         self.num_chords = num_chords
+        self.progression = progression_steps(chord_progression) if chord_progression is not None else None
         self.chord_progression = chord_progression
         self.melody = melody
+        self.measures = None
+
+    def set_progression(self, progression, key):
+        self.progression = progression
+        self.chord_progression = get_chords(key, progression) if progression is not None else None
 
     def set_melody(self, melody):
         self.melody = melody
 
     def get_melody(self):
+        if self.melody is None and self.measures is not None:
+            return [note for measure in self.measures for note in measure._notes]
         return self.melody
 
-    def get_section_measures(self, beats_per_measure):
-
-        current_beat = 0
-        result = []
+    def set_measures(self, measures):
+        self.measures = measures
 
-        current_measure_notes = []
-
-        chord_index = -1
-        for note in self.melody:
-            start_note = current_beat
-            current_beat = current_beat + note.duration
-            if start_note % beats_per_measure == 0:
-                if start_note > 0:
-                    measure = Measure(beats_per_measure, current_measure_notes)
-                    measure.assign_chords([self.chord_progression[chord_index]])
-                    result.append(measure)
-                current_measure_notes = []
-                chord_index = (chord_index + 1) % len(self.chord_progression)
-            current_measure_notes.append(note)
-        if self.num_measures != int(sum([n.duration for n in self.get_melody()]) / beats_per_measure):
-            print "fack"
-            raw_input()
-        measure = Measure(beats_per_measure, current_measure_notes)
-        measure.assign_chords([self.chord_progression[chord_index]])
-        result.append(measure)
-        return result
+    def get_section_measures(self, beats_per_measure):
+        """Gets the measures of this section, building them from the melody if they haven't been set directly.
+        """
+        if self.measures is None:
+            self.measures = list(iter_section_measures(self.melody, beats_per_measure, self.chord_progression,
+                                                       self.num_measures))
+        return self.measures
 
     @staticmethod
-    def get_rand_sectioning(total_sections, unique_sections):
+    def get_rand_sectioning(total_sections, unique_sections, rng=random):
         if total_sections < 1 or unique_sections < 1:
             raise Exception("total_sections and unique_sections must both be at least 1!")
         elif total_sections == 1:
@@ -203,29 +302,93 @@ class Section:
                 possible.append('C')
             for x in range(2, total_sections):
                 working_with = [p for p in possible if p != result[-1]]
-                chosen = working_with[random.randint(0, len(working_with) - 1)]
+                chosen = working_with[rng.randint(0, len(working_with) - 1)]
                 if chosen == possible[-1] and len(possible) < unique_sections:
                     possible.append(chr(65 + len(possible)))
                 result.append(chosen)
             return result
 
 
+PART_ROLES = ("counter", "bass", "pad")
+PART_NAMES = {"counter": "Counter-melody", "bass": "Bass", "pad": "Pad"}
+PART_CLEFS = {"counter": "G", "bass": "F", "pad": "F"}
+
+
+class Part:
+    """
+    One instrument's part of a song, other than the melody - i.e. a bass line. How it's generated depends on its role
+    (see parts.PartEngine).
+
+    Fields:
+        part_id (str)                               MusicXML part id, i.e. "P2"
+        role (str)                                  One of PART_ROLES
+        name (str)
+        clef (str)                                  "G" or "F"
+        _section_measures (dict str->list)          Maps 'A' to the part's measures for section A
+        _measures (list of Measure)                 All measures in the part, including the final measure - populated
+                                                    like Song._measures
+    """
+    part_id = None
+    role = None
+    name = None
+    clef = None
+    _section_measures = None
+    _measures = None
+
+    def __init__(self, part_id, role, name=None):
+        if role not in PART_ROLES:
+            raise ValueError("Unknown part role: " + str(role))
+        self.part_id = part_id
+        self.role = role
+        self.name = name if name is not None else PART_NAMES[role]
+        self.clef = PART_CLEFS[role]
+        self._section_measures = {}
+        self._measures = []
+
+    def set_section_measures(self, section_id, measures):
+        self._section_measures[section_id] = measures
+
+    def get_section_measures(self, section_id):
+        return self._section_measures[section_id]
+
+    def populate_measures(self, section_structure, final_measure):
+        """Same as Song.populate_measures - repeated sections share their Measure objects.
+        """
+        self._measures = []
+        for section_id in section_structure:
+            self._measures.extend(self._section_measures[section_id])
+        self._measures.append(final_measure)
+
+    def get_measures(self):
+        if len(self._measures) == 0:
+            raise Exception("Part measures haven't yet been populated!")
+        return self._measures
+
+
 class Measure:
     """
     duration    int: number of beats in the measure
+    ticks       int: number of ticks in the measure (see music_theory.PPQ)
     notes       list of Note objects
     harmonies   list of tuple(int,Note) objects, where int is the beat that the Note object falls on
 
-    Currently, harmonies only ever has one element.
+    There can be any number of harmonies, including more than one on the same beat.
+
+    Lookups by tick bisect the onsets of the notes (O(log n)), and lookups of a note's position are O(1). Both indexes
+    are built the first time they're needed, so notes must not change length once they're in a measure.
     """
 
     duration = None
+    ticks = None
     _notes = None
     harmonies = None
     chords = []
+    _onsets = None  # Tick that each note starts on
+    _note_indices = None  # id(note) => index in _notes
 
     def __init__(self, duration, notes=[]):
         self.duration = duration
+        self.ticks = beats_to_ticks(duration)
         self._notes = notes
         self.harmonies = []
 
@@ -237,33 +400,188 @@ class Measure:
 
     def append_note(self, note):
         self._notes.append(note)
+        self._onsets = self._note_indices = None
+
+    def get_onsets(self):
+        """
+        :return: list of int, the tick that each note starts on - a prefix sum of the note lengths
+        """
+        if self._onsets is None:
+            onsets = []
+            current_tick = 0
+            for n in self._notes:
+                onsets.append(current_tick)
+                current_tick += n.ticks
+            self._onsets = onsets
+        return self._onsets
 
     def get_note_at_beat(self, beat):
-        if (beat < 0 or beat >= self.duration):
+        return self.get_note_at_tick(beats_to_ticks(beat))
+
+    def get_note_at_tick(self, tick):
+        index = self.get_note_index_at_tick(tick)
+        if index is not None:
+            return self._notes[index]
+
+    def get_note_index_at_tick(self, tick):
+        if (tick < 0 or tick >= self.ticks):
             return None
-            # raise ValueError("Invalid beat parameter for getNoteAtBeat: "+str(beat))
-        current_beat = 0
-        for n in self._notes:
-            current_beat += n.duration
-            if beat < current_beat:
-                return n
-        raise Exception("Something went wrong.")
+            # raise ValueError("Invalid tick parameter for get_note_at_tick: "+str(tick))
+        index = bisect_right(self.get_onsets(), tick) - 1
+        if index < 0 or tick >= self._onsets[index] + self._notes[index].ticks:
+            raise Exception("Something went wrong.")
+        return index
 
     def get_chord_at_beat(self, beat):
         """
         :param beat: This is currently zero index, but that might not be the best strategy.
         :return:
         """
-        if (beat < 0 or beat >= self.duration):
-            return None
-        chord_duration = self.duration / len(self.chords)
-        return self.chords[beat / chord_duration]
+        return self.get_chord_at_tick(beats_to_ticks(beat))
 
+    def get_chord_at_tick(self, tick):
+        if (tick < 0 or tick >= self.ticks):
+            return None
+        chord_ticks = self.ticks // len(self.chords)
+        return self.chords[tick // chord_ticks]
 
     def get_beat_of_note(self, note):
-        current_beat = 0
-        for n in self._notes:
-            if n == note:
-                return current_beat
+        tick = self.get_tick_of_note(note)
+        if tick is not None:
+            return ticks_to_beats(tick)
+
+    def get_tick_of_note(self, note):
+        if self._note_indices is None:
+            self._note_indices = dict((id(n), i) for i, n in enumerate(self._notes))
+        index = self._note_indices.get(id(note))
+        if index is not None:
+            return self.get_onsets()[index]
+
+
+class SongTimeline:
+    """
+    Index of a whole song by tick, built once from its measures. Every lookup is a bisect (O(log n)) or an array
+    lookup (O(1)), instead of a walk over the measures and notes before it.
+
+    Notes are numbered in the order they're played, across the whole song. Repeated sections share their Measure (and
+    Note) objects, so a note is identified by its number here, not by the object.
+
+    Fields:
+        measures (list of Measure)
+        measure_onsets (list of int)    Tick that each measure starts on
+        note_onsets (list of int)       Tick that each note starts on
+        note_measures (list of int)     Index of the measure that each note is in
+        first_notes (list of int)       Number of the first note of each measure
+        ticks (int)                     Length of the song
+    """
+
+    def __init__(self, measures):
+        self.measures = measures
+        self.measure_onsets = []
+        self.note_onsets = []
+        self.note_measures = []
+        self.first_notes = []
+        current_tick = 0
+        for measure_index, measure in enumerate(measures):
+            self.measure_onsets.append(current_tick)
+            self.first_notes.append(len(self.note_onsets))
+            for onset in measure.get_onsets():
+                self.note_onsets.append(current_tick + onset)
+                self.note_measures.append(measure_index)
+            current_tick += measure.ticks
+        self.ticks = current_tick
+
+    def __len__(self):
+        return len(self.note_onsets)
+
+    def get_measure_index_at_tick(self, tick):
+        if tick < 0 or tick >= self.ticks:
+            return None
+        return bisect_right(self.measure_onsets, tick) - 1
+
+    def get_note_index_at_tick(self, tick):
+        """
+        :return: number of the note sounding at the tick, or None if the tick is outside of the song
+        """
+        if tick < 0 or tick >= self.ticks:
+            return None
+        return bisect_right(self.note_onsets, tick) - 1
+
+    def get_note(self, note_index):
+        """
+        :return: the Note with that number, or None if there isn't one (i.e. the note after the last one)
+        """
+        if note_index < 0 or note_index >= len(self.note_onsets):
+            return None
+        measure_index = self.note_measures[note_index]
+        return self.measures[measure_index]._notes[note_index - self.first_notes[measure_index]]
+
+    def get_note_at_tick(self, tick):
+        note_index = self.get_note_index_at_tick(tick)
+        if note_index is not None:
+            return self.get_note(note_index)
+
+    def get_chord_at_tick(self, tick):
+        measure_index = self.get_measure_index_at_tick(tick)
+        if measure_index is not None:
+            return self.measures[measure_index].get_chord_at_tick(tick - self.measure_onsets[measure_index])
+
+    def get_note_at_beat(self, beat):
+        return self.get_note_at_tick(beats_to_ticks(beat))
+
+    def get_chord_at_beat(self, beat):
+        return self.get_chord_at_tick(beats_to_ticks(beat))
+
+    def get_tick_of_note(self, note_index):
+        return self.note_onsets[note_index]
+
+    def get_previous_note(self, note_index):
+        return self.get_note(note_index - 1)
+
+    def get_next_note(self, note_index):
+        return self.get_note(note_index + 1)
+
+
+def iter_section_measures(notes, beats_per_measure, chord_progression, num_measures=None):
+    """Builds the measures of a section from its melody, in a single pass.
+
+    Notes that cross a barline are split into tied notes on the way through, each measure is assigned the next chord
+    in the progression, and measure lengths are validated as measures are cut - so the melody can come straight from
+    MelodyEngine.iter_melody() without ever being held in a list.
+
+    Args:
+        notes (iterable of Note): The melody of the section, in order
+        beats_per_measure (int)
+        chord_progression (list of Chord): Chords are assigned one per measure, repeating if necessary
+        num_measures (int): Expected number of measures, or None to skip that check
+    Yields:
+        (Measure)
+    Raises:
+        ValueError: If the melody doesn't fill a whole number of measures, or doesn't fill num_measures of them
+    """
+    measure_ticks = beats_to_ticks(beats_per_measure)
+    current_measure_notes = []
+    current_tick = 0  # Tick within the current measure
+    measure_count = 0
+    for note in notes:
+        while note is not None:
+            space_in_measure = measure_ticks - current_tick
+            if note.ticks > space_in_measure:
+                first, note = note.split_at_ticks(space_in_measure)
+                current_measure_notes.append(first)
+                current_tick = measure_ticks
             else:
-                current_beat += n.duration
\ No newline at end of file
+                current_measure_notes.append(note)
+                current_tick += note.ticks
+                note = None
+            if current_tick == measure_ticks:
+                measure = Measure(beats_per_measure, current_measure_notes)
+                measure.assign_chords([chord_progression[measure_count % len(chord_progression)]])
+                yield measure
+                measure_count += 1
+                current_measure_notes = []
+                current_tick = 0
+    if len(current_measure_notes) > 0:
+        raise ValueError("Melody ends " + str(ticks_to_beats(current_tick)) + " beats into an incomplete measure.")
+    if num_measures is not None and measure_count != num_measures:
+        raise ValueError("Expected " + str(num_measures) + " measures, but the melody filled " + str(measure_count) + ".")
@@ -0,0 +1,173 @@
+import wave
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from Core.chords import make_chord_measure
+from Core.music_theory import PPQ, beats_to_ticks
+
+"""
+audio.py
+
+Quick WAV previews of songs, synthesized directly - no MusicXML or external renderer involved.
+
+Every note is read out of one shared single-cycle wavetable, at a phase increment set by its pitch, and shaped by an
+attack/release envelope. Notes are rendered in batches of the same length: one NumPy operation computes the samples of
+every note in the batch, and another adds them all into the song's buffer, which is allocated once at its full length.
+"""
+
+A4 = 57  # Pitch value of A4 (see music_theory.py), which is 440Hz
+
+
+class AudioRenderer:
+    """
+    Fields:
+        sample_rate (int)
+        bpm (int)                   Tempo - quarter notes per minute
+        volume (float)              Gain of a melody note. Harmony and accompaniment notes are quieter.
+        attack (float)              Seconds that a note takes to fade in, and ...
+        release (float)             ... to fade out, at the end of its length
+        table_size (int)            Samples in the wavetable
+        batch_samples (int)         Most samples computed in one batch of notes, which bounds the memory used
+    """
+
+    melody_gain = 1.0
+    harmony_gain = 0.6
+    accompaniment_gain = 0.5
+    harmonics = (1.0, 0.5, 0.25, 0.125)  # Amplitudes of the harmonics in the wavetable - a soft, organ-like tone
+
+    def __init__(self, sample_rate=22050, bpm=120, volume=0.2, attack=0.01, release=0.05, table_size=2048,
+                 batch_samples=1 << 21):
+        if numpy is None:
+            raise RuntimeError("Audio previews need NumPy.")
+        self.sample_rate = sample_rate
+        self.bpm = bpm
+        self.volume = volume
+        self.attack = attack
+        self.release = release
+        self.table_size = table_size
+        self.batch_samples = batch_samples
+
+        phase = numpy.arange(table_size) * (2 * numpy.pi / table_size)
+        table = sum([amplitude * numpy.sin((i + 1) * phase) for i, amplitude in enumerate(self.harmonics)])
+        self.wavetable = (table / numpy.abs(table).max()).astype(numpy.float32)
+        # Wavetable steps per sample, for every pitch value
+        frequencies = 440.0 * 2 ** ((numpy.arange(128) - A4) / 12.0)
+        self.phase_increments = frequencies * table_size / sample_rate
+        self.samples_per_tick = sample_rate * 60.0 / (bpm * PPQ)
+        self._envelopes = {}
+
+    def get_events(self, song, measures=None):
+        """
+        Lists every note of the song - melody (with tied notes joined), harmonies and accompaniment - in ticks.
+
+        Args:
+            song (Song)
+            measures (iterable of Measure): The song's measures, in order - see MusicXMLWriter.write
+        Returns:
+            (tuple): Arrays of start tick, length in ticks, pitch value and gain for each note, and the song's length
+                in ticks
+        """
+        if measures is None:
+            measures = song.get_measures()
+        starts, lengths, pitches, gains = [], [], [], []
+        positions = song.iter_measure_positions()
+        measure_start = 0
+        tied_event = None  # Index of the melody note that a tie continues
+        for index, measure in enumerate(measures):
+            tick = measure_start
+            for note in measure._notes:
+                if tied_event is not None:
+                    lengths[tied_event] += note.ticks
+                else:
+                    starts.append(tick)
+                    lengths.append(note.ticks)
+                    pitches.append(note.pitch.value)
+                    gains.append(self.melody_gain)
+                if note.tie == "start":
+                    if tied_event is None:
+                        tied_event = len(starts) - 1
+                else:
+                    tied_event = None
+                tick += note.ticks
+            for beat, note in measure.harmonies:
+                starts.append(measure_start + beats_to_ticks(beat))
+                lengths.append(note.ticks)
+                pitches.append(note.pitch.value)
+                gains.append(self.harmony_gain)
+
+            # The same accompaniment as the score
+            accompaniment_random = song.get_accompaniment_random(index, next(positions, None))
+            tick = measure_start
+            for notes in make_chord_measure(measure.chords[0], measure.duration, accompaniment_random):
+                for note in notes:
+                    starts.append(tick)
+                    lengths.append(note.ticks)
+                    pitches.append(note.pitch.value)
+                    gains.append(self.accompaniment_gain)
+                tick += notes[0].ticks
+            measure_start += measure.ticks
+        return (numpy.array(starts), numpy.array(lengths), numpy.array(pitches), numpy.array(gains, numpy.float32),
+                measure_start)
+
+    def render(self, song, measures=None):
+        """
+        Returns:
+            (numpy.ndarray of float32): The song as mono samples, from -1 to 1
+        """
+        start_ticks, length_ticks, pitches, gains, song_ticks = self.get_events(song, measures)
+        starts = numpy.rint(start_ticks * self.samples_per_tick).astype(numpy.int64)
+        lengths = numpy.rint(length_ticks * self.samples_per_tick).astype(numpy.int64)
+        release_samples = int(self.release * self.sample_rate)
+        buffer = numpy.zeros(int(round(song_ticks * self.samples_per_tick)) + release_samples, numpy.float32)
+
+        for length in numpy.unique(lengths):
+            batch = numpy.flatnonzero(lengths == length)
+            batch_size = max(1, self.batch_samples // int(length))
+            for first in range(0, len(batch), batch_size):
+                notes = batch[first:first + batch_size]
+                self._mix(buffer, starts[notes], int(length), pitches[notes], gains[notes])
+
+        peak = numpy.abs(buffer).max() if len(buffer) > 0 else 0
+        if peak * self.volume > 1:
+            buffer *= 1.0 / peak  # Only scale down, so that quiet songs stay quiet
+        else:
+            buffer *= self.volume
+        return buffer
+
+    def _mix(self, buffer, starts, length, pitches, gains):
+        """
+        Adds notes that all have the same length (in samples) into the buffer.
+        """
+        offsets = numpy.arange(length)
+        phases = numpy.outer(self.phase_increments[pitches], offsets).astype(numpy.int64) % self.table_size
+        samples = self.wavetable[phases] * (gains[:, numpy.newaxis] * self._get_envelope(length))
+        numpy.add.at(buffer, starts[:, numpy.newaxis] + offsets, samples)
+
+    def _get_envelope(self, length):
+        envelope = self._envelopes.get(length)
+        if envelope is None:
+            envelope = numpy.ones(length, numpy.float32)
+            attack = min(length, max(1, int(self.attack * self.sample_rate)))
+            release = min(length - attack, int(self.release * self.sample_rate))
+            envelope[:attack] = numpy.linspace(0, 1, attack, endpoint=False)
+            if release > 0:
+                envelope[length - release:] = numpy.linspace(1, 0, release)
+            self._envelopes[length] = envelope
+        return envelope
+
+    def write_wav(self, song, target, measures=None):
+        """
+        Renders the song to target - a file name or a file-like object - as a 16-bit mono WAV.
+        """
+        samples = self.render(song, measures)
+        output = wave.open(target, "wb")
+        try:
+            output.setnchannels(1)
+            output.setsampwidth(2)
+            output.setframerate(self.sample_rate)
+            output.writeframes((samples * 32767).astype("<i2").tostring())
+        finally:
+            output.close()
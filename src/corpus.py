@@ -0,0 +1,176 @@
+import json
+import os
+import struct
+from bisect import bisect_right
+
+from Core.serialize import encode_song, decode_song
+
+"""
+corpus.py
+
+Checkpointed corpus runs - long runs of main.py that can be stopped at any point (a crash, or the machine being taken
+away) and resumed later, without regenerating or duplicating a song, and with the same output an uninterrupted run
+would have had.
+
+A Checkpoint records which songs of the run are finished, as ranges of song numbers, and how much of the corpus file
+(if there is one) holds finished songs. It also records the only state that carries over from one song to the next -
+the motif cache, and how many songs are in the near-duplicate index. No random number generator state needs saving:
+every song's random streams are derived from the run's seed and the song's number (see rng.py), so a song comes out
+the same whenever it's generated.
+
+Checkpoints are JSON, written to a temporary file that's then renamed over the old checkpoint, so an interrupted save
+leaves the old checkpoint in place instead of half of a new one.
+"""
+
+_RECORD = struct.Struct("<I")  # Length of each song in a corpus file
+
+
+class Checkpoint:
+    """
+    Fields:
+        file_name (str)
+        settings (dict)                 The run's options that decide what it generates (including the seed) - a run
+                                        can only be resumed with the same ones
+        completed (list of list)        [first, end) ranges of finished song numbers - sorted, and never touching
+        offset (int)                    Bytes at the start of the corpus file that hold finished songs
+        index_size (int)                Songs in the near-duplicate index, or None if the run doesn't use one
+        motif_cache (dict)              MotifCache.get_state(), or None if the run doesn't use motifs
+    """
+
+    def __init__(self, file_name, settings):
+        self.file_name = file_name
+        self.settings = settings
+        self.completed = []
+        self.offset = 0
+        self.index_size = None
+        self.motif_cache = None
+
+    def get_num_completed(self):
+        return sum([end - first for first, end in self.completed])
+
+    def is_completed(self, song_number):
+        i = bisect_right(self.completed, [song_number, float("inf")]) - 1
+        return i >= 0 and song_number < self.completed[i][1]
+
+    def add_completed(self, song_number):
+        """
+        Marks a song as finished, merging it into the ranges next to it.
+        """
+        if self.is_completed(song_number):
+            return
+        i = bisect_right(self.completed, [song_number, float("inf")])
+        if i > 0 and self.completed[i - 1][1] == song_number:
+            self.completed[i - 1][1] += 1
+            if i < len(self.completed) and self.completed[i][0] == song_number + 1:
+                self.completed[i - 1][1] = self.completed.pop(i)[1]
+        elif i < len(self.completed) and self.completed[i][0] == song_number + 1:
+            self.completed[i][0] = song_number
+        else:
+            self.completed.insert(i, [song_number, song_number + 1])
+
+    def save(self):
+        temp_name = self.file_name + ".tmp"
+        with open(temp_name, "w") as f:
+            json.dump({"settings": self.settings, "completed": self.completed, "offset": self.offset,
+                       "index_size": self.index_size, "motif_cache": self.motif_cache}, f, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_name, self.file_name)
+
+    @staticmethod
+    def load(file_name):
+        with open(file_name, "r") as f:
+            state = json.load(f)
+        checkpoint = Checkpoint(file_name, state["settings"])
+        checkpoint.completed = state["completed"]
+        checkpoint.offset = state["offset"]
+        checkpoint.index_size = state["index_size"]
+        checkpoint.motif_cache = state["motif_cache"]
+        return checkpoint
+
+
+class CorpusFile:
+    """
+    Many songs in one file, in the serialize.py format - each song is its length (a uint32), then the encoded song.
+    Songs are only ever appended, so a corpus can be cut back to any song boundary (i.e. a Checkpoint's offset) and
+    carried on from there.
+
+    Fields:
+        file_name (str)
+        offset (int)        Bytes written so far - the offset that the next song will be written at
+    """
+
+    def __init__(self, file_name, offset=0):
+        """
+        Args:
+            file_name (str)
+            offset (int): Bytes of an existing corpus file to keep - anything after them is removed. With 0, the file
+                is started over.
+        """
+        self.file_name = file_name
+        if offset > 0:
+            self.file = open(file_name, "r+b")
+            self.file.seek(0, os.SEEK_END)
+            if self.file.tell() < offset:
+                self.file.close()
+                raise ValueError(file_name + " is shorter than the checkpoint says it should be!")
+            self.file.truncate(offset)
+            self.file.seek(offset)
+        else:
+            self.file = open(file_name, "wb")
+        self.offset = offset
+
+    def append(self, song):
+        self.append_encoded(encode_song(song))
+
+    def append_encoded(self, data):
+        """
+        Args:
+            data (str or buffer): A song that's already encoded - i.e. songpool.SongRecord.data
+        """
+        self.file.write(_RECORD.pack(len(data)))
+        self.file.write(data)
+        self.offset += _RECORD.size + len(data)
+
+    def sync(self):
+        """
+        Makes sure everything appended so far is on disk - before a checkpoint counts it as finished.
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+def iter_encoded(file_name):
+    """
+    Yields every song in a corpus file, in order, still encoded - i.e. for scoring.score_encoded_songs, which doesn't
+    need the songs decoded.
+
+    Raises:
+        ValueError: If the file ends partway through a song
+    """
+    with open(file_name, "rb") as f:
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) == 0:
+                return
+            if len(header) < _RECORD.size:
+                raise ValueError(file_name + " ends partway through a song!")
+            length = _RECORD.unpack(header)[0]
+            data = f.read(length)
+            if len(data) < length:
+                raise ValueError(file_name + " ends partway through a song!")
+            yield data
+
+
+def read_corpus(file_name):
+    """
+    Yields every song in a corpus file, in order.
+
+    Raises:
+        ValueError: If the file ends partway through a song
+    """
+    for data in iter_encoded(file_name):
+        yield decode_song(data)
@@ -1,79 +1,408 @@
 from Core import *
 from xml import MusicXMLWriter
+from render import RenderQueue, DEFAULT_COMMAND
+from memprofile import MemoryProfiler, no_profiling, REQUIREMENT as MEMPROFILE_REQUIREMENT
+from audio import AudioRenderer
+from playback import PlaybackScheduler
+from corpus import Checkpoint, CorpusFile, iter_encoded
+from songpool import SongPool
+import argparse
+import os
 import time
 
+MAX_SONG_ATTEMPTS = 20  # How many times a near-duplicate song is regenerated before giving up
+# Options that don't change what a run generates - a checkpointed run can be resumed with different ones
+RUN_ONLY_OPTIONS = ("checkpoint","checkpoint_interval","index_interval","stream","jobs","part_jobs","metrics","memprofile",
+                    "render_jobs","render_timeout","render_retries")
+
 def output_time_elapsed(name,start,end):
     print name+":","%.2f" % (1000*(end-start)) +"ms"
 
 
-start_time = time.time()
+def create_chord_progressions(song):
+    rng = song.get_random("progressions")
+    total_repeat_count = 0
+    while True:
+        repeat_needed = False
 
-song = Song.create_random_attributes(beats_per_measure=4,unique_sections=3,total_sections=6,key_signature="C")
-melody_engine = MelodyEngine(song)
+        # For each section, create the chord progression. (i.e. the chords for a verse, for a chorus, and so on.)
+        for section in song.get_unique_sections():
+            redo_count = 0
+            progression = get_step_progression(song.num_chords_in_section(section),rng)
 
-mark1 = time.time()
+            # TODO: rework this. It's EXTREMELY inefficient.
+            # Currently, I'm re-doing the chord progression generation if I make two chord progressions that are too similar
+            # In chords.py, I need to add logic to ALWAYS generate a chord progression that is more "unique"
+            while len([prog for prog in song.get_all_progressions() if not different_enough(progression, prog)]) > 0 and total_repeat_count < 50:
+                redo_count += 1
+                progression = get_step_progression(song.num_chords_in_section(section),rng)
+                if redo_count == 15:
+                    repeat_needed = True
+                    break # Restart all chord progresions
+            if repeat_needed:
+                break
+            song.set_chord_progression(section,progression)
+        if repeat_needed:
+            total_repeat_count += 1
+            continue
+        else:
+            break
 
-total_repeat_count = 0
-while True:
-    repeat_needed = False
 
-    # For each section, create the chord progression. (i.e. the chords for a verse, for a chorus, and so on.)
+def set_rhythm_weights(song):
     for section in song.get_unique_sections():
-        redo_count = 0
-        chords = get_chord_progression(song.key, song.num_chords_in_section(section))
-
-        # TODO: rework this. It's EXTREMELY inefficient.
-        # Currently, I'm re-doing the chord progression generation if I make two chord progressions that are too similar
-        # In chords.py, I need to add logic to ALWAYS generate a chord progression that is more "unique"
-        while len([prog for prog in song.get_all_chord_progressions() if not different_enough(chords, prog)]) > 0 and total_repeat_count < 50:
-            redo_count += 1
-            chords = get_chord_progression(song.key, song.num_chords_in_section(section))
-            if redo_count == 15:
-                repeat_needed = True
-                break # Restart all chord progresions
-        if repeat_needed:
-            break
-        song.set_chord_progression(section,chords)
-    if repeat_needed:
-        total_repeat_count += 1
-        continue
+        # See rhythm.py to understand this weight - it basically biases rhythm generation in favor of
+        # shorter notes or longer ones, depending on the value.
+        rhythmic_weight = song.get_random("rhythm_weight",section).randint(1,5)
+        song.set_rhythm_weight(section,rhythmic_weight)
+
+
+def create_melodies(song,melody_engine):
+    # For each section, generate a melody (both pitches and rhythms)
+    set_rhythm_weights(song)
+    for section in song.get_unique_sections():
+        # Ties across barlines, measure boundaries and chords are all handled while the melody is generated.
+        song.set_section_measures(section,melody_engine.create_section_measures(section))
+
+    # TODO: document this.
+    song.populate_measures()
+
+    last_pitch_before_final_measure = song.get_measures()[-1]._notes[-1].pitch
+    final_chord = get_chord(song.key,1,"maj")
+    song.append_final_measure(melody_engine.get_final_measure(song.beats_per_measure,final_chord,last_pitch_before_final_measure))
+
+
+def generate_song(args,index,random_context,stage=no_profiling,motif_cache=None):
+    """
+    Creates a song (measures aren't generated yet in --stream mode), regenerating it while it's a near-duplicate of
+    one in the index. Each attempt gets its own RandomContext, derived from random_context.
+
+    :param motif_cache: MotifCache shared by every song, or None to generate melodies without motifs
+
+    :param stage: wraps each stage of generation - i.e. MemoryProfiler.stage
+    :return: the song, its MelodyEngine, and time.time() marks for the start and end of each stage
+    """
+    for attempt in range(MAX_SONG_ATTEMPTS):
+        start = time.time()
+        with stage("Song Initialization"):
+            song = Song.create_random_attributes(beats_per_measure=4,unique_sections=min(3,args.sections),
+                                                 total_sections=args.sections,key_signature="C",
+                                                 num_measures=args.measures_per_section,
+                                                 random_context=random_context.derive("attempt",attempt))
+            melody_engine = MelodyEngine(song,args.harmony,motif_cache,args.motifs)
+
+        mark1 = time.time()
+        with stage("Chord Progression Generation"):
+            create_chord_progressions(song)
+        mark2 = time.time()
+        with stage("Melody Generation"):
+            if args.stream:
+                # Melodies are generated while the XML is written - see below
+                set_rhythm_weights(song)
+            else:
+                create_melodies(song,melody_engine)
+        mark3 = time.time()
+
+        if index is None:
+            return song,melody_engine,(start,mark1,mark2,mark3)
+        section_notes = None
+        if args.stream:
+            # Melodies aren't kept in --stream mode - each section's is generated once more as it's signed, so the
+            # song gets the same signature as it would without --stream
+            section_notes = lambda section: (note for measure in melody_engine.iter_section_measures(section)
+                                             for note in measure._notes)
+        signature = index.get_signature(song,section_notes)
+        if index.find_near_duplicate(signature,args.max_distance) is None:
+            index.add(signature) # Saved once the song is written - see below
+            return song,melody_engine,(start,mark1,mark2,mark3)
+        print "Song is a near-duplicate of one in the index - regenerating."
+    raise Exception("Couldn't generate a song that isn't a near-duplicate in " + str(MAX_SONG_ATTEMPTS) + " attempts!")
+
+
+def generate_worker_song(song_number):
+    """
+    Generates a song in a --jobs worker process.
+    """
+    return generate_song(args,None,random_context.derive("song",song_number))[0]
+
+
+def finish_song(song_number):
+    """
+    Records that a song is written - in the checkpoint every --checkpoint-interval songs, or without a checkpoint, in the
+    near-duplicate index every --index-interval songs. Saving the index rewrites all of it, so it isn't saved after every
+    song.
+    """
+    global unsaved_songs
+    unsaved_songs += 1
+    if checkpoint is None:
+        if index is not None and unsaved_songs >= args.index_interval:
+            index.save(args.index)
+            unsaved_songs = 0
     else:
-        break
-mark2 = time.time()
-# For each section, generate a melody (both pitches and rhythms)
-for section in song.get_unique_sections():
-    chords = song.get_chord_progression(section)
-    section_data = []
-    # See rhythm.py to understand this weight - it basically biases rhythm generation in favor of
-    # shorter notes or longer ones, depending on the value.
-    rhythmic_weight = random.randint(1,5)
-    song.set_rhythm_weight(section,rhythmic_weight)
-    melody = melody_engine.create_melody_beta(section)
-    num_beats_expected = song.num_measures_in_section(section)*song.beats_per_measure
-    num_beats_actual = sum([n.duration for n in melody])
-    song.set_section_melody(section,melody_engine.divide_cross_measure_notes(melody))
-
-# TODO: document this.
-song.populate_measures()
-
-last_pitch_before_final_measure = song.get_measures()[-1]._notes[-1].pitch
-final_chord = Chord(1,"maj",song.key)
-make_chord_measure(final_chord,4)
-song.append_final_measure(melody_engine.get_final_measure(song.beats_per_measure,final_chord,last_pitch_before_final_measure))
-
-mark3 = time.time()
-
-writer = MusicXMLWriter(song)
-writer.write("output.xml")
-
-end_time = time.time()
-
-print "Done generating song."
-
-output_time_elapsed("Time Elapsed",start_time,end_time)
-print "==================="
-
-output_time_elapsed("Song Initialization",start_time,mark1)
-output_time_elapsed("Chord Progression Generation",mark1,mark2)
-output_time_elapsed("Melody Generation",mark2,mark3)
-output_time_elapsed("Output (XML) Generation",mark3,end_time)
+        checkpoint.add_completed(song_number)
+        if unsaved_songs >= args.checkpoint_interval:
+            save_checkpoint(checkpoint,corpus,index,motif_cache)
+            unsaved_songs = 0
+
+
+def print_event(event):
+    print event
+
+
+def get_run_settings(args):
+    """
+    :return: dict of the options that decide what the run generates, for its Checkpoint
+    """
+    return dict([(name,value) for name,value in vars(args).items() if name not in RUN_ONLY_OPTIONS])
+
+
+def save_checkpoint(checkpoint,corpus,index,motif_cache):
+    if index is not None:
+        index.save(args.index)
+    if corpus is not None:
+        corpus.sync()
+        checkpoint.offset = corpus.offset
+    checkpoint.index_size = len(index) if index is not None else None
+    checkpoint.motif_cache = motif_cache.get_state() if motif_cache is not None else None
+    checkpoint.save()
+
+
+def get_output_name(output,song_number,count):
+    """
+    With more than one song, output names are numbered - i.e. out/output.pdf becomes out/output-0001.pdf
+    """
+    if count == 1:
+        return output
+    root,extension = os.path.splitext(output)
+    return "%s-%04d%s" % (root,song_number+1,extension)
+
+
+parser = argparse.ArgumentParser(description="Generate random songs, as MusicXML.")
+parser.add_argument("--seed",type=int,help="seed to generate from - the same seed always gives the same songs")
+parser.add_argument("--index",help="near-duplicate index file. Songs too close to one already in the index are "
+                                   "regenerated, and the accepted song is added to it.")
+parser.add_argument("--index-interval",type=int,default=100,
+                    help="songs between saves of the --index, without --checkpoint (it's always saved at the end of "
+                         "the run)")
+parser.add_argument("--max-distance",type=float,default=0.5,
+                    help="songs at or below this (estimated Jaccard) distance from an indexed song are near-duplicates")
+parser.add_argument("--stream",action="store_true",
+                    help="generate measures as they're written, instead of building the whole song first. Memory use "
+                         "doesn't grow with the length of the song.")
+parser.add_argument("--output",default="output.xml",
+                    help="file to write the song to. Use a .mxl extension for compressed MusicXML. With --render, "
+                         "this is the rendered file instead, i.e. out/output.pdf")
+parser.add_argument("--corpus",metavar="FILE",
+                    help="append every song to FILE in the compact binary song format (see Core/serialize.py), "
+                         "instead of writing a MusicXML file for each")
+parser.add_argument("--checkpoint",metavar="FILE",
+                    help="record the run's progress in FILE. If FILE already exists, the run it records is resumed - "
+                         "finished songs are skipped, and the output is the same as if the run had never stopped.")
+parser.add_argument("--checkpoint-interval",type=int,default=1,
+                    help="songs between checkpoints. Songs since the last checkpoint are generated again when a run "
+                         "is resumed.")
+parser.add_argument("--metrics",metavar="FILE",
+                    help="once the run is done, score every song in the --corpus and write the quality metrics "
+                         "(see Core/scoring.py) to FILE as CSV (needs NumPy)")
+parser.add_argument("--count",type=int,default=1,help="number of songs to generate (their output files are numbered)")
+parser.add_argument("--jobs",type=int,default=1,
+                    help="number of worker processes that generate songs at once. Songs come back to this process "
+                         "through shared memory, in the same order as without --jobs.")
+parser.add_argument("--harmony",type=float,default=0.3,
+                    help="chance that a melody note of a quarter or longer gets a harmony note (0 for no harmony)")
+parser.add_argument("--motifs",type=float,default=0,
+                    help="chance that a measure's melody is a variation of a motif from an earlier measure (of any "
+                         "song in the run) over the same chord, instead of a new one. 0 turns motifs off.")
+parser.add_argument("--parts",nargs="+",default=[],choices=PART_ROLES,metavar="ROLE",
+                    help="parts to play alongside the melody, each in its own staff - any of: %s. A role can be "
+                         "given more than once. Parts are only in the score, not in --play or --preview." % ", ".join(PART_ROLES))
+parser.add_argument("--part-jobs",type=int,default=1,
+                    help="number of processes that generate --parts at once (without --stream)")
+parser.add_argument("--sections",type=int,default=6,help="total number of sections in the song")
+parser.add_argument("--measures-per-section",type=int,default=16)
+parser.add_argument("--play",action="store_true",
+                    help="play each song in real time instead of writing it - note events are printed as they're "
+                         "due, and measures are generated just ahead of them (implies --stream)")
+parser.add_argument("--bpm",type=int,default=120,help="tempo for --play")
+parser.add_argument("--preview",action="store_true",
+                    help="also synthesize a WAV preview of each song, next to its output file (needs NumPy)")
+parser.add_argument("--memprofile",metavar="REPORT",
+                    help="trace memory allocations (with tracemalloc) around each stage of generation, and write a "
+                         "JSON report of peak and retained bytes per stage and per object type to REPORT (needs "
+                         "Python 2.7 with the pytracemalloc patch)")
+parser.add_argument("--render",action="store_true",
+                    help="render each song with --renderer, in the background while the next songs are generated")
+parser.add_argument("--renderer",default=DEFAULT_COMMAND,
+                    help="renderer command line, where {input} is the score and {output} is the file to create "
+                         "(default: %(default)s)")
+parser.add_argument("--render-jobs",type=int,default=2,help="number of renderers that can run at once")
+parser.add_argument("--render-timeout",type=float,default=120,help="seconds before a renderer is killed")
+parser.add_argument("--render-retries",type=int,default=1,help="times a failed render is retried")
+args = parser.parse_args()
+if args.play:
+    args.stream = True
+if args.corpus is not None and (args.stream or args.render or len(args.parts) > 0):
+    parser.error("--corpus can't be used with --stream, --play, --render or --parts")
+if args.metrics is not None and args.corpus is None:
+    parser.error("--metrics needs --corpus")
+if args.checkpoint is not None and (args.play or args.render):
+    parser.error("--checkpoint can't be used with --play or --render")
+if args.jobs > 1 and (args.index is not None or args.motifs > 0 or args.stream or len(args.parts) > 0):
+    # Near-duplicates and motifs depend on the songs before, and --stream generates while writing
+    parser.error("--jobs can't be used with --index, --motifs, --stream, --play or --parts")
+if args.memprofile is not None and not MemoryProfiler.is_available():
+    parser.error(MEMPROFILE_REQUIREMENT)
+
+checkpoint = None
+if args.checkpoint is not None and os.path.exists(args.checkpoint):
+    checkpoint = Checkpoint.load(args.checkpoint)
+    if args.seed is None:
+        args.seed = checkpoint.settings["seed"]
+    if checkpoint.settings != get_run_settings(args):
+        parser.error(args.checkpoint + " is a checkpoint of a run with different options")
+    print "Resuming from " + args.checkpoint + ": " + str(checkpoint.get_num_completed()) + " of " + \
+          str(args.count) + " songs are already finished."
+random_context = RandomContext(args.seed)
+args.seed = random_context.seed
+if args.checkpoint is not None and checkpoint is None:
+    checkpoint = Checkpoint(args.checkpoint,get_run_settings(args))
+
+index = None
+if args.index is not None:
+    index = SongIndex.load(args.index) if os.path.exists(args.index) else SongIndex()
+    if checkpoint is not None and checkpoint.index_size is not None:
+        index.truncate(checkpoint.index_size) # Songs after the checkpoint are generated again
+
+profiler = None
+stage = no_profiling
+if args.memprofile is not None:
+    profiler = MemoryProfiler()
+    stage = profiler.stage
+
+render_queue = None
+if args.render:
+    render_queue = RenderQueue(args.renderer,args.render_jobs,args.render_timeout,args.render_retries)
+
+audio_renderer = AudioRenderer() if args.preview else None
+
+motif_cache = None
+if checkpoint is not None and checkpoint.motif_cache is not None:
+    motif_cache = MotifCache.from_state(checkpoint.motif_cache)
+elif args.motifs > 0:
+    motif_cache = MotifCache()
+
+corpus = None
+if args.corpus is not None:
+    corpus = CorpusFile(args.corpus,checkpoint.offset if checkpoint is not None else 0)
+
+print "Seed: " + str(random_context.seed)
+
+unsaved_songs = 0 # Songs finished since the checkpoint (or without one, the index) was last saved
+song_numbers = (n for n in xrange(args.count) if checkpoint is None or not checkpoint.is_completed(n))
+
+if args.jobs > 1:
+    song_pool = SongPool(generate_worker_song,args.jobs)
+    try:
+        for record in song_pool.imap(song_numbers):
+            start_time = time.time()
+            output = get_output_name(args.output,record.song_number,args.count)
+            song = None # Only decoded if it's needed
+            with stage("Output (XML) Generation"):
+                if corpus is not None:
+                    corpus.append_encoded(record.data)
+                else:
+                    song = record.get_song()
+                    if render_queue is not None:
+                        render_queue.submit(song,output)
+                    else:
+                        MusicXMLWriter(song).write(output)
+            mark1 = time.time()
+            if audio_renderer is not None:
+                with stage("Preview (WAV) Synthesis"):
+                    audio_renderer.write_wav(song or record.get_song(),os.path.splitext(output)[0]+".wav")
+            end_time = time.time()
+            print "Done generating song " + str(record.song_number+1) + "."
+            output_time_elapsed("Output (XML) Generation",start_time,mark1)
+            if audio_renderer is not None:
+                output_time_elapsed("Preview (WAV) Synthesis",mark1,end_time)
+            finish_song(record.song_number)
+    except:
+        song_pool.terminate()
+        raise
+    song_pool.close()
+    song_numbers = ()
+
+for song_number in song_numbers:
+    song,melody_engine,(start_time,mark1,mark2,mark3) = generate_song(args,index,random_context.derive("song",song_number),stage,
+                                                                      motif_cache)
+    with stage("Part Generation"):
+        for role in args.parts:
+            song.add_part(role)
+        part_measures = None
+        if args.stream:
+            part_measures = [PartEngine(song,part).iter_part_measures() for part in song.parts]
+        elif len(song.parts) > 0:
+            generate_parts(song,args.part_jobs)
+    mark4 = time.time()
+    measures = melody_engine.iter_song_measures() if args.stream else None
+    output = get_output_name(args.output,song_number,args.count)
+
+    if args.play:
+        print PlaybackScheduler(song,args.bpm,print_event).play(measures)
+        finish_song(song_number)
+        continue
+
+    with stage("Output (XML) Generation"):
+        if corpus is not None:
+            corpus.append(song)
+        elif render_queue is not None:
+            render_queue.submit(song,output,measures,part_measures)
+        else:
+            MusicXMLWriter(song).write(output,measures,partMeasures=part_measures)
+    mark5 = time.time()
+    if audio_renderer is not None:
+        # --stream measures have been used up by now, but they generate again identically
+        with stage("Preview (WAV) Synthesis"):
+            audio_renderer.write_wav(song,os.path.splitext(output)[0]+".wav",
+                                     melody_engine.iter_song_measures() if args.stream else None)
+
+    end_time = time.time()
+
+    print "Done generating song."
+
+    output_time_elapsed("Time Elapsed",start_time,end_time)
+    print "==================="
+
+    output_time_elapsed("Song Initialization",start_time,mark1)
+    output_time_elapsed("Chord Progression Generation",mark1,mark2)
+    output_time_elapsed("Melody Generation",mark2,mark3)
+    output_time_elapsed("Part Generation",mark3,mark4)
+    output_time_elapsed("Output (XML) Generation",mark4,mark5)
+    if audio_renderer is not None:
+        output_time_elapsed("Preview (WAV) Synthesis",mark5,end_time)
+
+    finish_song(song_number)
+
+if checkpoint is not None and unsaved_songs > 0:
+    save_checkpoint(checkpoint,corpus,index,motif_cache)
+elif index is not None and unsaved_songs > 0:
+    index.save(args.index)
+if corpus is not None:
+    corpus.close()
+    if args.metrics is not None:
+        write_metrics_csv(score_encoded_songs(iter_encoded(args.corpus)),args.metrics)
+        print "Metrics written to " + args.metrics
+
+if profiler is not None:
+    profiler.write_json(args.memprofile)
+    profiler.stop()
+    print "Memory profile written to " + args.memprofile
+
+if render_queue is not None:
+    failed = 0
+    for job in render_queue.close():
+        print job
+        if not job.succeeded():
+            failed += 1
+    if failed > 0:
+        raise SystemExit(str(failed) + " song(s) failed to render.")
@@ -0,0 +1,155 @@
+import gc
+import json
+import sys
+from contextlib import contextmanager
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None  # Python 2.7 only has it with the pytracemalloc patch
+
+REQUIREMENT = "Memory profiling needs the tracemalloc module - Python 2.7 with the pytracemalloc patch."
+
+"""
+memprofile.py
+
+Per-stage memory reports for the generation pipeline (see --memprofile in main.py).
+
+Each stage is wrapped in MemoryProfiler.stage(), which records:
+    retained_bytes      Memory still allocated at the end of the stage that wasn't at the start
+    peak_bytes          Most memory allocated at any point during the stage
+    objects             Change in the number (and shallow size) of live objects of each type
+    top_lines           The source lines whose retained allocations changed the most
+
+Stages that run more than once (i.e. once per song) are added up. The JSON report is sorted and stable, so reports from
+two releases can be diffed directly.
+
+The pytracemalloc patch has no tracemalloc.reset_peak, so the only way to reset the peak is to trace from scratch -
+tracing is restarted at the start of each stage. Then only memory allocated during the stage is traced, and memory
+allocated before the stage but freed during it doesn't count against retained_bytes. (reset_peak is used where it
+exists.)
+"""
+
+
+class MemoryProfiler:
+    """
+    Fields:
+        top (int)               Number of source lines to keep per stage, in top_lines
+        stages (list of dict)   One report per stage name, in the order the stages first ran
+    """
+
+    def __init__(self, top=10):
+        if not MemoryProfiler.is_available():
+            raise RuntimeError(REQUIREMENT)
+        self.top = top
+        self.stages = []
+        self._stages_by_name = {}
+        self._peak = 0  # Highest traced memory of any stage - reset_peak and restarts both reset tracemalloc's own
+        tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name):
+        gc.collect()
+        objects_before = MemoryProfiler.count_objects()
+        can_reset_peak = hasattr(tracemalloc, "reset_peak")
+        if not can_reset_peak:
+            tracemalloc.stop()  # Otherwise peaks are since the profiler started
+            tracemalloc.start()
+        snapshot_before = self._take_snapshot()
+        current_before = tracemalloc.get_traced_memory()[0]
+        if can_reset_peak:
+            tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            current_after, peak = tracemalloc.get_traced_memory()
+            self._peak = max(self._peak, peak)
+            gc.collect()
+            snapshot_after = self._take_snapshot()
+            objects_after = MemoryProfiler.count_objects()
+            self._add(name, current_after - current_before, peak - current_before,
+                      MemoryProfiler.diff_objects(objects_before, objects_after),
+                      [line for line in snapshot_after.compare_to(snapshot_before, "lineno")
+                       if line.size_diff != 0][:self.top])
+
+    def _take_snapshot(self):
+        # Leave out the profiler's own allocations
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                                          tracemalloc.Filter(False, __file__)])
+
+    def _add(self, name, retained, peak, objects, top_lines):
+        stage = self._stages_by_name.get(name)
+        if stage is None:
+            stage = {"name": name, "runs": 0, "retained_bytes": 0, "peak_bytes": 0, "objects": {}, "top_lines": {}}
+            self._stages_by_name[name] = stage
+            self.stages.append(stage)
+        stage["runs"] += 1
+        stage["retained_bytes"] += retained
+        stage["peak_bytes"] = max(stage["peak_bytes"], peak)
+        for type_name, (count, size) in objects.items():
+            totals = stage["objects"].setdefault(type_name, {"count": 0, "bytes": 0})
+            totals["count"] += count
+            totals["bytes"] += size
+        for line in top_lines:
+            frame = line.traceback[0]
+            key = "%s:%d" % (frame.filename, frame.lineno)
+            totals = stage["top_lines"].setdefault(key, {"bytes": 0, "blocks": 0})
+            totals["bytes"] += line.size_diff
+            totals["blocks"] += line.count_diff
+
+    @staticmethod
+    def is_available():
+        return tracemalloc is not None
+
+    def get_report(self):
+        return {
+            "python": sys.version.split()[0],
+            "stages": self.stages,
+            "total_peak_bytes": max(self._peak, tracemalloc.get_traced_memory()[1]),
+        }
+
+    def write_json(self, file_name):
+        with open(file_name, "w") as f:
+            json.dump(self.get_report(), f, indent=2, sort_keys=True)
+
+    def stop(self):
+        tracemalloc.stop()
+
+    @staticmethod
+    def count_objects():
+        """
+        Returns:
+            (dict str->list of int): Type name => [number of live (gc-tracked) objects, their total shallow size]
+        """
+        result = {}
+        for obj in gc.get_objects():
+            # getattr covers old-style instances, whose type() is just "instance"
+            type_name = getattr(obj, "__class__", type(obj)).__name__
+            totals = result.get(type_name)
+            if totals is None:
+                totals = result[type_name] = [0, 0]
+            totals[0] += 1
+            totals[1] += sys.getsizeof(obj, 0)
+        return result
+
+    @staticmethod
+    def diff_objects(before, after):
+        """
+        Returns:
+            (dict str->tuple of int): Type name => (change in count, change in bytes), for types that changed
+        """
+        result = {}
+        for type_name in set(before) | set(after):
+            count_before, size_before = before.get(type_name, (0, 0))
+            count_after, size_after = after.get(type_name, (0, 0))
+            if count_before != count_after or size_before != size_after:
+                result[type_name] = (count_after - count_before, size_after - size_before)
+        return result
+
+
+@contextmanager
+def no_profiling(name):
+    """
+    Stand-in for MemoryProfiler.stage when profiling is off.
+    """
+    yield
@@ -0,0 +1,156 @@
+import struct
+import time
+import zlib
+
+"""
+mxl.py
+
+Compressed MusicXML (.mxl) output. An .mxl file is a zip archive holding a "mimetype" entry, META-INF/container.xml
+(which points at the score), and the score itself.
+
+Python's zipfile can only add an entry once all of its data is known, so MXLFile writes the zip format itself: the score
+entry is deflated a chunk at a time as it's written, and its CRC and sizes go in a data descriptor after the data.
+Nothing needs to seek, so the target can be a pipe or socket as well as a regular file.
+"""
+
+MIMETYPE = "application/vnd.recordare.musicxml"
+CONTAINER_XML = ("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n"
+                 "<container>\n"
+                 "  <rootfiles>\n"
+                 "    <rootfile full-path=\"%s\" media-type=\"application/vnd.recordare.musicxml+xml\"/>\n"
+                 "  </rootfiles>\n"
+                 "</container>\n")
+
+_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+_DATA_DESCRIPTOR = struct.Struct("<IIII")
+_CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+_END_OF_CENTRAL_DIRECTORY = struct.Struct("<IHHHHIIH")
+
+_STORED = 0
+_DEFLATED = 8
+_HAS_DATA_DESCRIPTOR = 0x08
+_ZIP_VERSION = 20
+
+
+class _Entry:
+    """
+    What the central directory needs to know about an entry that's already been written.
+    """
+    def __init__(self, name, method, flags, offset):
+        self.name = name
+        self.method = method
+        self.flags = flags
+        self.offset = offset
+        self.crc = 0
+        self.compressed_size = 0
+        self.size = 0
+
+
+class MXLFile:
+    """
+    A write-only file-like object - everything written to it becomes the score inside an .mxl archive.
+
+    Fields:
+        compression_level (int)     zlib compression level, 1-9
+    """
+
+    compression_level = 6
+
+    def __init__(self, target, score_name="score.xml", compression_level=None):
+        """
+        Args:
+            target (str or file): File name of the .mxl, or a file-like object to write it to
+            score_name (str): Name of the score entry inside the archive
+            compression_level (int)
+        """
+        if compression_level is not None:
+            self.compression_level = compression_level
+        if isinstance(target, basestring):
+            self._file = open(target, "wb")
+            self._owns_file = True
+        else:
+            self._file = target
+            self._owns_file = False
+        self._offset = 0
+        self._entries = []
+        self._date, self._time = _dos_date_time(time.localtime())
+
+        self._write_stored("mimetype", MIMETYPE)
+        self._write_stored("META-INF/container.xml", CONTAINER_XML % score_name)
+
+        self._score = self._start_entry(score_name, _DEFLATED, _HAS_DATA_DESCRIPTOR, 0, 0, 0)
+        self._compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.closed = False
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("I/O operation on closed MXLFile")
+        self._score.crc = zlib.crc32(data, self._score.crc)
+        self._score.size += len(data)
+        self._write_compressed(self._compressor.compress(data))
+
+    def flush(self):
+        """
+        Passes on whatever has been compressed so far. This doesn't force zlib to flush, which would hurt compression.
+        """
+        if hasattr(self._file, "flush"):
+            self._file.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._write_compressed(self._compressor.flush())
+        self._score.crc &= 0xffffffff
+        self._write(_DATA_DESCRIPTOR.pack(0x08074b50, self._score.crc, self._score.compressed_size,
+                                          self._score.size))
+        self._write_central_directory()
+        if self._owns_file:
+            self._file.close()
+        else:
+            self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write(self, data):
+        self._file.write(data)
+        self._offset += len(data)
+
+    def _write_compressed(self, data):
+        if data:
+            self._score.compressed_size += len(data)
+            self._write(data)
+
+    def _start_entry(self, name, method, flags, crc, compressed_size, size):
+        entry = _Entry(name, method, flags, self._offset)
+        self._entries.append(entry)
+        self._write(_LOCAL_HEADER.pack(0x04034b50, _ZIP_VERSION, flags, method, self._time, self._date,
+                                       crc, compressed_size, size, len(name), 0))
+        self._write(name)
+        return entry
+
+    def _write_stored(self, name, data):
+        crc = zlib.crc32(data) & 0xffffffff
+        entry = self._start_entry(name, _STORED, 0, crc, len(data), len(data))
+        entry.crc = crc
+        entry.compressed_size = entry.size = len(data)
+        self._write(data)
+
+    def _write_central_directory(self):
+        start = self._offset
+        for entry in self._entries:
+            self._write(_CENTRAL_HEADER.pack(0x02014b50, _ZIP_VERSION, _ZIP_VERSION, entry.flags, entry.method,
+                                             self._time, self._date, entry.crc, entry.compressed_size, entry.size,
+                                             len(entry.name), 0, 0, 0, 0, 0, entry.offset))
+            self._write(entry.name)
+        self._write(_END_OF_CENTRAL_DIRECTORY.pack(0x06054b50, 0, 0, len(self._entries), len(self._entries),
+                                                   self._offset - start, start, 0))
+
+
+def _dos_date_time(t):
+    return ((t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday,
+            t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2)
@@ -0,0 +1,74 @@
+"""
+output.py
+
+Where the writers send their output, when it isn't a file they open themselves. A ChunkedOutput can wrap any file-like
+object or a connected socket, and passes data on in chunks of at least flush_size bytes - so a score can be streamed
+to a client while it's still being generated, without a temporary file or a write() per XML tag.
+"""
+
+
+class ChunkedOutput:
+    """
+    A write-only file-like object that passes everything written to it on to a target.
+
+    Fields:
+        target              A file-like object (anything with write()), or a socket (anything with sendall())
+        flush_size (int)    Bytes to gather before passing them on, or None to pass every write on straight away
+        bytes_written (int) Bytes passed on to the target so far
+    """
+
+    def __init__(self, target, flush_size=None):
+        if hasattr(target, "write"):
+            self._send = target.write
+        elif hasattr(target, "sendall"):
+            self._send = target.sendall
+        else:
+            raise ValueError("Can't write to " + repr(target) + " - it has neither write() nor sendall()")
+        self.target = target
+        self.flush_size = flush_size
+        self.bytes_written = 0
+        self.closed = False
+        self._pending = []
+        self._pending_size = 0
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("I/O operation on closed ChunkedOutput")
+        if self.flush_size is None:
+            self._pass_on(data)
+            return
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= self.flush_size:
+            self._pass_on_pending()
+
+    def flush(self):
+        """
+        Called by the writers after each measure. Pending data is only passed on once there's a whole chunk of it -
+        close() passes on whatever is left.
+        """
+        if self.flush_size is None or self._pending_size >= self.flush_size:
+            self._pass_on_pending()
+            if hasattr(self.target, "flush"):
+                self.target.flush()
+
+    def close(self):
+        """
+        Passes on any pending data. The target itself is left open.
+        """
+        if self.closed:
+            return
+        self._pass_on_pending()
+        if hasattr(self.target, "flush"):
+            self.target.flush()
+        self.closed = True
+
+    def _pass_on_pending(self):
+        if self._pending_size > 0:
+            self._pass_on("".join(self._pending))
+            self._pending = []
+            self._pending_size = 0
+
+    def _pass_on(self, data):
+        self._send(data)
+        self.bytes_written += len(data)
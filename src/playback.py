@@ -0,0 +1,206 @@
+import time
+from collections import deque
+
+from Core.chords import make_chord_measure
+from Core.music_theory import PPQ, beats_to_ticks
+
+"""
+playback.py
+
+Live playback - timestamped note-on/note-off events, sent out in real time while the song is still being generated.
+
+PlaybackScheduler is a lookahead scheduler: it wakes up every `interval` seconds and sends out every event due in the
+next `lookahead` seconds, each with the time it should sound at. Measures are only generated once the playhead gets
+close to them (i.e. from MelodyEngine.iter_song_measures()), so the first notes go out as soon as the first measure
+exists, instead of after the whole song has been built. Late wake-ups are covered by the lookahead, and the
+PlaybackReport says how late the scheduler was.
+"""
+
+
+class NoteEvent:
+    """
+    Fields:
+        tick (int)      When the event happens, in ticks from the start of the song
+        time (float)    The same, in seconds at the scheduler's tempo
+        type (str)      "on" or "off"
+        pitch (int)     Pitch value (see music_theory.py) - the MIDI note number is pitch + 12
+        part (str)      "melody", "harmony" or "accompaniment"
+    """
+
+    def __init__(self, tick, time, type, pitch, part):
+        self.tick = tick
+        self.time = time
+        self.type = type
+        self.pitch = pitch
+        self.part = part
+
+    def __str__(self):
+        return "%.3f %s %d %s" % (self.time, self.type, self.pitch, self.part)
+
+
+def get_measure_events(song, measure, index, position, measure_start, tied_pitch=None):
+    """
+    Lists the note-on and note-off events of one measure, in order - melody, harmonies, and the same accompaniment
+    as the score. A tied melody note only gets one note-on (where it starts) and one note-off (where the tie ends).
+
+    Args:
+        song (Song)
+        measure (Measure)
+        index (int): Index of the measure in the song
+        position (tuple): See Song.get_accompaniment_random
+        measure_start (int): Tick that the measure starts on
+        tied_pitch (int): Pitch of a melody note tied over from the last measure, or None
+    Returns:
+        (tuple): list of (tick, type, pitch, part), and the pitch of a melody note tied over to the next measure
+    """
+    events = []
+    tick = measure_start
+    for note in measure._notes:
+        if tied_pitch is None:
+            events.append((tick, "on", note.pitch.value, "melody"))
+        tick += note.ticks
+        if note.tie == "start":
+            tied_pitch = note.pitch.value
+        else:
+            events.append((tick, "off", note.pitch.value, "melody"))
+            tied_pitch = None
+    for beat, note in measure.harmonies:
+        tick = measure_start + beats_to_ticks(beat)
+        events.append((tick, "on", note.pitch.value, "harmony"))
+        events.append((tick + note.ticks, "off", note.pitch.value, "harmony"))
+    tick = measure_start
+    for notes in make_chord_measure(measure.chords[0], measure.duration,
+                                    song.get_accompaniment_random(index, position)):
+        for note in notes:
+            events.append((tick, "on", note.pitch.value, "accompaniment"))
+            events.append((tick + note.ticks, "off", note.pitch.value, "accompaniment"))
+        tick += notes[0].ticks
+    events.sort(key=lambda event: (event[0], event[1] == "on"))  # Note-offs go out first, so repeated notes restart
+    return events, tied_pitch
+
+
+class PlaybackReport:
+    """
+    Fields:
+        measures (int)          Measures generated
+        events (int)            Events sent
+        first_sound (float)     Seconds from the start of play() until the first note-on was sent
+        late_events (int)       Events sent after the time they should have sounded at
+        max_lateness (float)    Seconds - the latest any event was sent (negative if none were late)
+        wakeups (int)           Times the scheduler woke up
+        mean_jitter (float)     Seconds - how late the scheduler woke up, on average and ...
+        max_jitter (float)      ... at worst, compared to when it asked to
+    """
+
+    def __init__(self):
+        self.measures = 0
+        self.events = 0
+        self.first_sound = None
+        self.late_events = 0
+        self.max_lateness = None
+        self.wakeups = 0
+        self.total_jitter = 0.0
+        self.max_jitter = 0.0
+
+    @property
+    def mean_jitter(self):
+        return self.total_jitter / self.wakeups if self.wakeups > 0 else 0.0
+
+    def add_wakeup(self, jitter):
+        self.wakeups += 1
+        self.total_jitter += jitter
+        self.max_jitter = max(self.max_jitter, jitter)
+
+    def add_event(self, lateness):
+        self.events += 1
+        if lateness > 0:
+            self.late_events += 1
+        if self.max_lateness is None or lateness > self.max_lateness:
+            self.max_lateness = lateness
+
+    def __str__(self):
+        return ("%d measures, %d events - first sound after %.1fms, %d late event(s) (at worst %.1fms), "
+                "wake-up jitter %.2fms mean, %.2fms max") % (
+            self.measures, self.events, 1000 * (self.first_sound or 0), self.late_events,
+            1000 * max(0, self.max_lateness or 0), 1000 * self.mean_jitter, 1000 * self.max_jitter)
+
+
+class PlaybackScheduler:
+    """
+    Fields:
+        song (Song)
+        bpm (int)               Tempo - quarter notes per minute, as in Song.get_time_with_BPM
+        output (callable)       Called with each NoteEvent, up to `lookahead` seconds before it should sound - it
+                                should sound at start_time + event.time
+        lookahead (float)       Seconds ahead of the playhead that events are sent
+        interval (float)        Seconds between wake-ups - must be well under lookahead
+        start_time (float)      Clock time that the song started at, once it's playing
+    """
+
+    def __init__(self, song, bpm=120, output=None, lookahead=0.1, interval=0.025, clock=time.time, sleep=time.sleep):
+        if interval >= lookahead:
+            raise ValueError("The scheduler interval must be shorter than the lookahead!")
+        self.song = song
+        self.bpm = bpm
+        self.output = output
+        self.lookahead = lookahead
+        self.interval = interval
+        self.start_time = None
+        self._clock = clock
+        self._sleep = sleep
+
+    def get_seconds_per_tick(self):
+        return 60.0 / (self.bpm * PPQ)
+
+    def play(self, measures=None):
+        """
+        Plays the song in real time, returning once every event has been sent.
+
+        Args:
+            measures (iterable of Measure): The song's measures, in order - ideally generated lazily, i.e. by
+                MelodyEngine.iter_song_measures(). By default, the song's populated measures.
+        Returns:
+            (PlaybackReport)
+        """
+        if measures is None:
+            measures = self.song.get_measures()
+        measures = iter(measures)
+        positions = self.song.iter_measure_positions()
+        seconds_per_tick = self.get_seconds_per_tick()
+        report = PlaybackReport()
+        pending = deque()
+        generated_ticks = 0  # Every event before this tick has been generated
+        tied_pitch = None
+        finished = False
+
+        self.start_time = wake_time = self._clock()
+        while True:
+            now = self._clock()
+            report.add_wakeup(now - wake_time)
+            horizon = now - self.start_time + self.lookahead
+
+            while not finished and generated_ticks * seconds_per_tick <= horizon:
+                measure = next(measures, None)
+                if measure is None:
+                    finished = True
+                    break
+                events, tied_pitch = get_measure_events(self.song, measure, report.measures, next(positions, None),
+                                                        generated_ticks, tied_pitch)
+                for tick, event_type, pitch, part in events:
+                    pending.append(NoteEvent(tick, tick * seconds_per_tick, event_type, pitch, part))
+                report.measures += 1
+                generated_ticks += measure.ticks
+
+            while len(pending) > 0 and pending[0].time <= horizon:
+                event = pending.popleft()
+                sent = self._clock()
+                if self.output is not None:
+                    self.output(event)
+                report.add_event(sent - (self.start_time + event.time))
+                if report.first_sound is None and event.type == "on":
+                    report.first_sound = sent - self.start_time
+
+            if finished and len(pending) == 0:
+                return report
+            wake_time = now + self.interval
+            self._sleep(max(0, wake_time - self._clock()))
@@ -0,0 +1,181 @@
+import os
+import Queue
+import shlex
+import subprocess
+import tempfile
+import threading
+import time
+
+from xml import MusicXMLWriter
+
+"""
+render.py
+
+Runs an external engraver (MuseScore, by default) over generated scores, in the background.
+
+Scores are written to unique temporary files as they're submitted, and a fixed number of worker threads run the
+renderer over them - so rendering overlaps with generating the next songs, and any number of runs can go at once
+without fighting over a fixed output.xml.
+"""
+
+DEFAULT_COMMAND = "musescore {input} -o {output}"
+
+
+class RenderJob:
+    """
+    Fields:
+        input_file (str)        Temporary score file that gets rendered
+        output_file (str)       File the renderer should create
+        attempts (int)          Number of times the renderer has been run for this job
+        returncode (int)        Exit status of the last attempt (None if it timed out)
+        error (str)             Why the job failed, or None if it succeeded
+        queued_at (float)       time.time() values - set when the job is submitted, first started and finished
+        started_at (float)
+        finished_at (float)
+    """
+
+    def __init__(self, input_file, output_file):
+        self.input_file = input_file
+        self.output_file = output_file
+        self.attempts = 0
+        self.returncode = None
+        self.error = None
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def succeeded(self):
+        return self.finished_at is not None and self.error is None
+
+    def get_wait_time(self):
+        return self.started_at - self.queued_at
+
+    def get_render_time(self):
+        return self.finished_at - self.started_at
+
+    def __str__(self):
+        status = "done" if self.error is None else "FAILED (" + self.error + ")"
+        return "%s: %s after %d attempt(s) - waited %.2fs, rendered in %.2fs" % (
+            self.output_file, status, self.attempts, self.get_wait_time(), self.get_render_time())
+
+
+class RenderQueue:
+    """
+    Renders scores with an external command, at most `concurrency` at a time.
+
+    Fields:
+        command (str)           Renderer command line - {input} and {output} are replaced by the file names
+        concurrency (int)       Number of renderer processes that can run at once
+        timeout (float)         Seconds before a renderer process is killed (and the attempt counts as failed)
+        retries (int)           How many times a failed render is retried
+        score_extension (str)   Extension of the temporary score files, which decides their format (.xml or .mxl)
+        jobs (list of RenderJob)
+    """
+
+    poll_interval = 0.05
+
+    def __init__(self, command=DEFAULT_COMMAND, concurrency=2, timeout=120, retries=1, score_extension=".mxl"):
+        self.command = command
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.score_extension = score_extension
+        self.jobs = []
+        # Bounded, so that generation can only get a little ahead of rendering
+        self._queue = Queue.Queue(maxsize=2 * concurrency)
+        self._workers = []
+        for x in range(concurrency):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, song, output_file, measures=None, part_measures=None):
+        """
+        Writes the song to a temporary score file and queues it to be rendered. Blocks while the queue is full.
+
+        Args:
+            song (Song)
+            output_file (str): File the renderer should create
+            measures (iterable of Measure): Passed on to MusicXMLWriter.write
+            part_measures (list of iterable of Measure): Passed on to MusicXMLWriter.write, as partMeasures
+        Returns:
+            (RenderJob)
+        """
+        handle, input_file = tempfile.mkstemp(prefix="makemusic-", suffix=self.score_extension)
+        os.close(handle)
+        MusicXMLWriter(song).write(input_file, measures, partMeasures=part_measures)
+        return self.submit_file(input_file, output_file)
+
+    def submit_file(self, input_file, output_file):
+        """
+        Queues an existing score file to be rendered. The queue owns input_file from here on, and deletes it.
+        """
+        job = RenderJob(input_file, output_file)
+        self.jobs.append(job)
+        self._queue.put(job)
+        return job
+
+    def close(self):
+        """
+        Waits for every submitted job to finish, and stops the workers.
+
+        Returns:
+            (list of RenderJob): All jobs, in the order they were submitted
+        """
+        for worker in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        return self.jobs
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            job.started_at = time.time()
+            # Anything unexpected fails the job, not the worker - so the rest of the jobs still get rendered
+            try:
+                while job.attempts <= self.retries:
+                    job.attempts += 1
+                    job.error = self._run(job)
+                    if job.error is None:
+                        break
+            except Exception as e:
+                job.error = "%s: %s" % (type(e).__name__, e)
+            try:
+                os.remove(job.input_file)
+            except Exception as e:
+                if job.error is None:
+                    job.error = "couldn't remove " + job.input_file + ": %s: %s" % (type(e).__name__, e)
+            job.finished_at = time.time()
+
+    def _run(self, job):
+        """
+        Runs the renderer once.
+
+        Returns:
+            (str): What went wrong, or None if the render succeeded
+        """
+        args = [arg.replace("{input}", job.input_file).replace("{output}", job.output_file)
+                for arg in shlex.split(self.command)]
+        with open(os.devnull, "w") as devnull:
+            try:
+                process = subprocess.Popen(args, stdout=devnull, stderr=devnull)
+            except OSError as e:
+                return "couldn't run " + args[0] + ": " + e.strerror
+            deadline = time.time() + self.timeout
+            while process.poll() is None:
+                if time.time() > deadline:
+                    process.kill()
+                    process.wait()
+                    job.returncode = None
+                    return "timed out after " + str(self.timeout) + "s"
+                time.sleep(self.poll_interval)
+        job.returncode = process.returncode
+        if process.returncode != 0:
+            return "exit status " + str(process.returncode)
+        if not os.path.exists(job.output_file):
+            return "no output file"
+        return None
@@ -0,0 +1,198 @@
+import mmap
+import multiprocessing
+import traceback
+from collections import deque
+
+from Core.serialize import encode_song, decode_song
+
+"""
+songpool.py
+
+Generates songs in worker processes, and hands them back to the parent process without pickling them.
+
+Pickling a Song sends its whole object graph - KeySignature, Pitch, Note, Measure and Chord objects - through a pipe,
+and rebuilding it in the parent costs more than generating it did. Instead, each worker encodes its song in the
+compact serialize.py format, straight into a slot of a ring buffer in shared memory, and only sends the parent a few
+numbers saying where it is. The parent reads the song in place, through a zero-copy view of the slot, and only decodes
+it back into a Song if it needs one - a corpus file (see corpus.CorpusFile) just takes the encoded bytes.
+
+The ring buffer is an anonymous shared mmap, created before the workers are forked - so this needs a platform with
+fork(), i.e. not Windows.
+"""
+
+
+class SharedRing:
+    """
+    A fixed number of fixed-size slots in shared memory. Each slot has a semaphore, which a worker holds from when it
+    starts writing to the slot until the parent is done reading from it.
+
+    Fields:
+        slots (int)
+        slot_size (int)     Bytes in each slot
+    """
+
+    def __init__(self, slots, slot_size):
+        self.slots = slots
+        self.slot_size = slot_size
+        self._map = mmap.mmap(-1, slots * slot_size)
+        self._free = [multiprocessing.Semaphore(1) for x in range(slots)]
+
+    def acquire(self, slot):
+        self._free[slot].acquire()
+
+    def release(self, slot):
+        self._free[slot].release()
+
+    def write(self, slot, data):
+        offset = slot * self.slot_size
+        self._map[offset:offset + len(data)] = data
+
+    def view(self, slot, length):
+        """
+        Returns:
+            (buffer): The first length bytes of the slot - a view of the shared memory, not a copy
+        """
+        return buffer(self._map, slot * self.slot_size, length)
+
+    def close(self):
+        self._map.close()
+
+
+class SongRecord:
+    """
+    A song generated by a worker, still encoded.
+
+    Fields:
+        song_number (int)
+        data (buffer or str)    The song in the serialize.py format - only valid until the next record is taken
+                                from the pool (see SongPool.imap), since it's a view of a slot that gets reused
+    """
+
+    def __init__(self, song_number, data):
+        self.song_number = song_number
+        self.data = data
+
+    def get_bytes(self):
+        """
+        Returns:
+            (str): A copy of the encoded song, which stays valid
+        """
+        return str(self.data)
+
+    def get_song(self):
+        """
+        Returns:
+            (Song): The song, decoded - only do this if the Song objects are actually needed
+        """
+        return decode_song(self.data)
+
+
+class SongPool:
+    """
+    Worker processes that generate songs by number.
+
+    Songs are handed out to workers in order, and the n-th song handed out is written to slot n % slots - which its
+    worker waits for, if the parent is still reading the song that was there before. The parent takes songs in the
+    same order, so the song it's waiting for always has a free slot, and the pool can't deadlock. A song too big for
+    a slot is sent through the result queue instead.
+
+    Fields:
+        processes (int)
+        slots (int)             Songs that can be waiting for the parent at once
+        slot_size (int)         Bytes in each slot of the ring buffer
+    """
+
+    def __init__(self, generate, processes, slots=None, slot_size=1 << 16):
+        """
+        Args:
+            generate (callable): Called in a worker with a song number, returning the Song. It doesn't need to be
+                picklable - workers are forked.
+            processes (int)
+            slots (int): By default, twice the number of processes
+            slot_size (int)
+        """
+        self.processes = processes
+        self.slots = slots if slots is not None else 2 * processes
+        self.slot_size = slot_size
+        self._ring = SharedRing(self.slots, slot_size)
+        self._tasks = multiprocessing.Queue()
+        self._results = multiprocessing.Queue()
+        self._workers = [multiprocessing.Process(target=self._work, args=(generate,)) for x in range(processes)]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+    def _work(self, generate):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            sequence, song_number = task
+            try:
+                data = encode_song(generate(song_number))
+            except Exception:
+                self._results.put((sequence, None, None, traceback.format_exc()))
+                return
+            slot = sequence % self.slots
+            self._ring.acquire(slot)
+            if len(data) <= self.slot_size:
+                self._ring.write(slot, data)
+                self._results.put((sequence, len(data), None, None))
+            else:
+                self._results.put((sequence, len(data), data, None))
+
+    def imap(self, song_numbers):
+        """
+        Generates songs in the workers, in parallel.
+
+        Args:
+            song_numbers (iterable of int)
+        Yields:
+            (SongRecord): One for each song number, in order. Each record's data is only valid until the next record
+                is taken.
+        Raises:
+            RuntimeError: If generating a song failed in a worker
+        """
+        song_numbers = iter(song_numbers)
+        dispatched = deque()  # (sequence, song number) of every song handed out but not yet taken
+        finished = {}  # sequence => (length, data) of songs that are ready, but not yet taken
+        sequence = 0
+        for song_number in song_numbers:
+            self._tasks.put((sequence, song_number))
+            dispatched.append((sequence, song_number))
+            sequence += 1
+            if sequence == self.slots:
+                break
+
+        while len(dispatched) > 0:
+            next_sequence, song_number = dispatched.popleft()
+            while next_sequence not in finished:
+                result_sequence, length, data, error = self._results.get()
+                if error is not None:
+                    raise RuntimeError("Couldn't generate a song in a worker process:\n" + error)
+                finished[result_sequence] = (length, data)
+            length, data = finished.pop(next_sequence)
+            slot = next_sequence % self.slots
+            yield SongRecord(song_number, data if data is not None else self._ring.view(slot, length))
+            self._ring.release(slot)
+
+            song_number = next(song_numbers, None)
+            if song_number is not None:
+                self._tasks.put((sequence, song_number))
+                dispatched.append((sequence, song_number))
+                sequence += 1
+
+    def close(self):
+        """
+        Stops the workers, once they've finished what they're generating.
+        """
+        for worker in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._ring.close()
+
+    def terminate(self):
+        for worker in self._workers:
+            worker.terminate()
+        self._ring.close()
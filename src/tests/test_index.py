@@ -0,0 +1,45 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+"""
+Checks that a song gets the same near-duplicate index entry whether or not it's generated with --stream.
+"""
+
+_SOURCE_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class StreamIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="makemusic-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_index(self, name, *options):
+        """
+        Returns:
+            (str): The index file written by a run of main.py with the options
+        """
+        index_file = os.path.join(self.directory, name + ".idx")
+        with open(os.devnull, "w") as devnull:
+            subprocess.check_call([sys.executable, "main.py", "--seed", "9", "--count", "2", "--measures-per-section", "8",
+                                   "--index", index_file, "--output", os.path.join(self.directory, name + ".xml")] +
+                                  list(options), cwd=_SOURCE_DIRECTORY, stdout=devnull)
+        with open(index_file, "rb") as f:
+            return f.read()
+
+    def test_same_index_with_stream(self):
+        self.assertEqual(self.write_index("default"), self.write_index("stream", "--stream"))
+
+    def test_same_index_with_stream_and_motifs(self):
+        self.assertEqual(self.write_index("default", "--motifs", "0.5"),
+                         self.write_index("stream", "--motifs", "0.5", "--stream"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from render import RenderQueue
+
+"""
+Runs RenderQueue against a stub renderer script, so no engraver needs to be installed. Run from src/, with
+    python -m unittest discover -s tests -t .
+"""
+
+_STUB = """import shutil, sys, time
+mode, input_file, output_file = sys.argv[1:]
+if mode == "sleep":
+    time.sleep(30)
+if mode == "fail":
+    sys.exit(3)
+shutil.copy(input_file, output_file)
+"""
+
+
+class RenderQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="makemusic-test-")
+        self.stub = os.path.join(self.directory, "stub.py")
+        with open(self.stub, "w") as f:
+            f.write(_STUB)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_queue(self, mode, **kwargs):
+        command = '"%s" "%s" %s {input} {output}' % (sys.executable, self.stub, mode)
+        return RenderQueue(command, **kwargs)
+
+    def submit(self, queue, name):
+        input_file = os.path.join(self.directory, name + ".xml")
+        with open(input_file, "w") as f:
+            f.write("<score-partwise/>")
+        return queue.submit_file(input_file, os.path.join(self.directory, name + ".pdf"))
+
+    def test_success(self):
+        queue = self.make_queue("copy")
+        jobs = [self.submit(queue, "song-%d" % i) for i in range(3)]
+        self.assertEqual(queue.close(), jobs)
+        for job in jobs:
+            self.assertTrue(job.succeeded(), str(job))
+            self.assertEqual(job.attempts, 1)
+            self.assertEqual(job.returncode, 0)
+            self.assertTrue(os.path.exists(job.output_file))
+            self.assertFalse(os.path.exists(job.input_file))
+
+    def test_exit_status(self):
+        queue = self.make_queue("fail", retries=1)
+        job = self.submit(queue, "song")
+        queue.close()
+        self.assertFalse(job.succeeded())
+        self.assertEqual(job.error, "exit status 3")
+        self.assertEqual(job.returncode, 3)
+        self.assertEqual(job.attempts, 2)
+        self.assertFalse(os.path.exists(job.input_file))
+
+    def test_timeout(self):
+        queue = self.make_queue("sleep", timeout=0.5, retries=0)
+        job = self.submit(queue, "song")
+        queue.close()
+        self.assertFalse(job.succeeded())
+        self.assertEqual(job.error, "timed out after 0.5s")
+        self.assertIsNone(job.returncode)
+        self.assertLess(job.get_render_time(), 10)
+
+    def test_unexpected_error(self):
+        queue = self.make_queue("copy", concurrency=1)
+        real_run = queue._run
+
+        def run(job):
+            if job.output_file.endswith("broken.pdf"):
+                raise IOError("disk full")
+            return real_run(job)
+        queue._run = run
+        broken = self.submit(queue, "broken")
+        job = self.submit(queue, "song")
+        queue.close()
+        self.assertFalse(broken.succeeded())
+        self.assertEqual(broken.error, "IOError: disk full")
+        self.assertFalse(os.path.exists(broken.input_file))
+        self.assertTrue(job.succeeded(), str(job))  # The worker carried on after the error
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+"""
+Checks that --stream keeps memory flat however long the sections are - nothing kept per measure may grow with the song.
+Each run is a separate process, which reports its own peak resident set size.
+"""
+
+_SOURCE_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_RUN = """import resource, runpy, sys
+sys.argv = ["main.py"] + sys.argv[1:]
+runpy.run_path("main.py", run_name="__main__")
+sys.stderr.write("%d\\n" % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+MAX_GROWTH_KB = 4 * 1024
+
+
+class StreamMemoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="makemusic-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get_peak_kb(self, measures_per_section):
+        """
+        Returns:
+            (int): Peak resident set size of a --stream run, in KB (ru_maxrss, on Linux)
+        """
+        process = subprocess.Popen([sys.executable, "-c", _RUN, "--seed", "7", "--stream", "--sections", "2",
+                                    "--measures-per-section", str(measures_per_section),
+                                    "--output", os.path.join(self.directory, "song.xml")],
+                                   cwd=_SOURCE_DIRECTORY, stdout=open(os.devnull, "w"), stderr=subprocess.PIPE)
+        error = process.communicate()[1]
+        self.assertEqual(process.returncode, 0, error)
+        return int(error.split()[-1])
+
+    def test_memory_is_flat(self):
+        short_peak = self.get_peak_kb(16)
+        long_peak = self.get_peak_kb(3000)
+        self.assertLess(long_peak - short_peak, MAX_GROWTH_KB, "%d KB with 16 measures per section, %d KB with 3000" %
+                        (short_peak, long_peak))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,24 +2,110 @@ __author__ = 'Wilson'
 from elementtree.SimpleXMLWriter import XMLWriter
 from Core.chords import Chord,make_chord_measure
 from Core.music_theory import *
+from mxl import MXLFile
+from output import ChunkedOutput
+from cStringIO import StringIO
+import tempfile
 
 class XMLNote(Note):
     def __init__(self,note,tie):
-        Note.__init__(self,note.pitch,note.duration)
+        self.pitch = note.pitch
+        self.set_ticks(note.ticks)
         self.tie = tie
 
+class FragmentRecorder:
+    """
+    Passes everything written to it on to a file, and keeps a copy of what's written between startRecording() and
+    stopRecording().
+    """
+    def __init__(self,file):
+        self.file = file
+        self.recorded = None
+    def write(self,data):
+        self.file.write(data)
+        if self.recorded is not None:
+            self.recorded.append(data)
+    def flush(self):
+        self.file.flush()
+    def startRecording(self):
+        self.recorded = []
+    def stopRecording(self):
+        fragment = "".join(self.recorded)
+        self.recorded = None
+        return fragment
+
+class PartOutput:
+    """
+    Where one part of the score is written to, and the writer state that each part has its own copy of.
+
+    The piano part (part is None) is written straight to the output. Other parts are written to a SpooledTemporaryFile
+    while the measures go past, and copied to the output after the piano part - MusicXML has each part in one piece,
+    but this way every part's measures can be generated and written in the same pass.
+    """
+    spoolSize = 1 << 20 # Bytes of a part that are kept in memory, before the rest goes to a temporary file
+    fragmentCacheSize = 1 << 20 # Most bytes of measure XML kept for repeats - so memory doesn't grow with the song
+    def __init__(self,part,file=None):
+        self.part = part #Core.song_data.Part, or None for the piano part
+        if file is None:
+            file = tempfile.SpooledTemporaryFile(self.spoolSize)
+        self.file = file
+        self.recorder = FragmentRecorder(file)
+        self.writer = XMLWriter(self.recorder)
+        self.fragments = {} # (section, position) => XML of the measure, split around its number
+        self.fragmentBytes = 0
+        self.currentMeasure = None
+        self.lastMeasure = None
+
 class MusicXMLWriter:
     song = None #Core.MusicData.Song
     writer = None #elementtree.SimpleXMLWriter.XMLWriter
-    currentBeat = 0
-    divisions = 2 #Hmm
+    currentTick = 0
+    divisions = PPQ # Durations are written straight from note ticks
     currentMeasureIndex = -1
+    currentMeasure = None
+    lastMeasure = None
     def __init__(self,song):
         self.song = song
-    def write(self,fileName):
-        file = open(fileName,"w")
+    def write(self,target,measures=None,compressed=None,flushSize=None,partMeasures=None):
+        """
+        Writes the song as MusicXML to target - a file name, any file-like object, or a connected socket. Targets
+        other than file names are left open.
+
+        measures can be any iterable of Measure objects to write instead of the song's populated measures (i.e.
+        MelodyEngine.iter_song_measures()). Each measure is flushed to the target as soon as it's written, and nothing
+        holds on to it afterwards. With a flushSize, output is passed on in chunks of at least that many bytes instead
+        (see output.ChunkedOutput).
+
+        The song's parts (see Song.parts) are written after the piano part. partMeasures is a list of iterables of
+        Measure objects, one for each part - by default, each part's populated measures. They're read in step with
+        measures (i.e. from PartEngine.iter_part_measures()), so all parts are generated and written in one pass.
+
+        If compressed is True, the output is a compressed MusicXML (.mxl) archive, compressed as the measures are
+        written. By default, that's decided by whether target is a file name ending with ".mxl".
+
+        The measures must be the song's measures, in order. Measures at the same position of the same section are
+        identical (see Song.iter_measure_positions), so each one is only turned into XML once - its repeats are the
+        same XML with a different measure number.
+        """
+        if measures is None:
+            measures = self.song.get_measures()
+        if partMeasures is None:
+            partMeasures = [part.get_measures() for part in self.song.parts]
+        if len(partMeasures) != len(self.song.parts):
+            raise ValueError("partMeasures needs measures for each of the song's parts!")
+        ownedFile = None
+        if isinstance(target,basestring):
+            if compressed is None:
+                compressed = target.lower().endswith(".mxl")
+            target = ownedFile = open(target,"wb")
+        output = ChunkedOutput(target,flushSize)
+        if compressed:
+            file = MXLFile(output)
+        else:
+            file = output
         file.write("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n")
-        self.writer = XMLWriter(file)
+        piano = PartOutput(None,file)
+        self.writer = piano.writer
 
         structure = self.writer.start("score-partwise",{"version":"3.0"})
 
@@ -27,30 +113,82 @@ class MusicXMLWriter:
         self.writer.start("score-part",{"id":"P1"})
         self.writer.element("part-name","Music")
         self.writer.end("score-part")
+        for part in self.song.parts:
+            self.writer.start("score-part",{"id":part.part_id})
+            self.writer.element("part-name",part.name)
+            self.writer.end("score-part")
         self.writer.end("part-list")
         self.writer.start("part",{"id":"P1"})
 
+        partOutputs = [PartOutput(part) for part in self.song.parts]
+        for partOutput in partOutputs:
+            partOutput.writer.start("part",{"id":partOutput.part.part_id})
+        partMeasures = [iter(m) for m in partMeasures]
 
-        for index,measure in enumerate(self.song.get_measures()):
-            #raw_input()
-            self.currentMeasureIndex = index
-            self.currentBeat = 0
+        positions = self.song.iter_measure_positions()
+        for index,measure in enumerate(measures):
+            position = next(positions,None)
+            self.writeMeasure(piano,index,measure,position)
+            for partOutput,partIterator in zip(partOutputs,partMeasures):
+                partMeasure = next(partIterator,None)
+                if partMeasure is None:
+                    raise ValueError("Part "+partOutput.part.part_id+" has fewer measures than the song!")
+                self.writeMeasure(partOutput,index,partMeasure,position)
+        self.writer = piano.writer
+        self.writer.end("part")
+        for partOutput,partIterator in zip(partOutputs,partMeasures):
+            if next(partIterator,None) is not None:
+                raise ValueError("Part "+partOutput.part.part_id+" has more measures than the song!")
+            partOutput.writer.end("part")
+            partOutput.file.seek(0)
+            for chunk in iter(lambda: partOutput.file.read(1 << 16),""):
+                file.write(chunk)
+            partOutput.file.close()
+            file.flush()
+        self.writer.end(structure)
+        file.close()
+        output.close()
+        if ownedFile is not None:
+            ownedFile.close()
+        self.currentMeasure = self.lastMeasure = None
+    def writeMeasure(self,partOutput,index,measure,position):
+        """
+        Writes one measure of a part, or the same XML as an earlier measure at the same position.
+        """
+        self.writer = partOutput.writer
+        self.currentMeasureIndex = index
+        self.lastMeasure = partOutput.lastMeasure = partOutput.currentMeasure
+        self.currentMeasure = partOutput.currentMeasure = measure
+        self.currentTick = 0
+        file = partOutput.file
+        isPiano = partOutput.part is None
+
+        if position in partOutput.fragments:
+            head,tail = partOutput.fragments[position]
+            file.write(head+str(index+1)+tail)
+            file.flush()
+            return
 
-            self.writer.start("measure",{"number": str(index+1)})
-            self.writer.start("attributes")
-            self.writer.element("divisions",str(self.divisions))
+        # The first measure also has the key, time and clefs. Once the cache is full, measures are just written.
+        cacheable = position is not None and index > 0 and partOutput.fragmentBytes < partOutput.fragmentCacheSize
+        if cacheable:
+            partOutput.recorder.startRecording()
+        self.writer.start("measure",{"number": str(index+1)})
+        self.writer.start("attributes")
+        self.writer.element("divisions",str(self.divisions))
 
 
 
-            if(index == 0):
-                self.writer.start("key")
-                self.writer.element("fifths",str(KeySignature.key_sig_values[self.song.key.value]))
-                self.writer.element("mode","major")
-                self.writer.end("key")
-                self.writer.start("time")
-                self.writer.element("beats",str(measure.duration))
-                self.writer.element("beat-type","4")
-                self.writer.end("time")
+        if(index == 0):
+            self.writer.start("key")
+            self.writer.element("fifths",str(KeySignature.key_sig_values[self.song.key.value]))
+            self.writer.element("mode","major")
+            self.writer.end("key")
+            self.writer.start("time")
+            self.writer.element("beats",str(measure.duration))
+            self.writer.element("beat-type","4")
+            self.writer.end("time")
+            if isPiano:
                 self.writer.element("staves","2")
                 self.writer.start("clef",{"number":"1"})
                 self.writer.element("sign","G")
@@ -60,45 +198,68 @@ class MusicXMLWriter:
                 self.writer.element("sign","F")
                 self.writer.element("line","4")
                 self.writer.end("clef")
+            else:
+                self.writer.start("clef")
+                self.writer.element("sign",partOutput.part.clef)
+                self.writer.element("line","2" if partOutput.part.clef == "G" else "4")
+                self.writer.end("clef")
 
 
-            self.writer.end("attributes")
+        self.writer.end("attributes")
 
+        if isPiano:
             self.writeChordSymbol(measure.chords[0])
 
-            for note in measure._notes:
-                if note.duration == 1.5 and self.currentBeat % 1 == 0.5:
-                    splitNotes = self.splitDottedHalf(note)
-                    #for x in splitNotes:
-                        #print str(x.pitch)+", "+str(x.duration)
-                    self.writeNoteXML(splitNotes[0],1,"start")
-                    self.writeNoteXML(splitNotes[1],1,"stop")
-                else:
-                    if len(measure.harmonies) == 1:
-                        if self.currentBeat == measure.harmonies[0][0]:
-                            #print "harmony found: "+str(index+1)
-                            self.writeNoteXML([note,measure.harmonies[0][1]],1)
-                        else:
-                            self.writeNoteXML(note,1)
-                    else:
-                        self.writeNoteXML(note,1)
+        harmonies = {}  # tick => harmony notes
+        for beat,harmony_note in measure.harmonies:
+            harmonies.setdefault(beats_to_ticks(beat),[]).append(harmony_note)
+
+        for note in measure._notes:
+            if note.ticks == 3*EIGHTH_TICKS and self.currentTick % PPQ == EIGHTH_TICKS:
+                splitNotes = self.splitDottedHalf(note)
+                #for x in splitNotes:
+                    #print str(x.pitch)+", "+str(x.duration)
+                firstHalf,secondHalf = [splitNotes[0]],[splitNotes[1]]
+                for harmony_note in harmonies.get(self.currentTick,[]): # Split and tied the same way as the note
+                    splitHarmony = self.splitDottedHalf(harmony_note)
+                    firstHalf.append(splitHarmony[0])
+                    secondHalf.append(splitHarmony[1])
+                self.writeNoteXML(firstHalf,1,"start")
+                self.writeNoteXML(secondHalf,1,"stop")
+            elif self.currentTick in harmonies:
+                self.writeNoteXML([note]+harmonies[self.currentTick],1)
+            else:
+                self.writeNoteXML(note,1)
 
 
+        if isPiano:
             self.writer.start("backup")
-            self.writer.element("duration",str(measure.duration*self.divisions))
+            self.writer.element("duration",str(measure.ticks))
             self.writer.end("backup")
             ### OLD
             #c = measure.chords[0].get_random_voicing(measure.duration)
             #self.writeNoteXML(c,2)
             ### NEW
-            newThing = make_chord_measure(measure.chords[0],measure.duration)
+            newThing = make_chord_measure(measure.chords[0],measure.duration,
+                                          self.song.get_accompaniment_random(index,position))
             for note_tuple in newThing:
                 self.writeNoteXML(note_tuple,2)
             ####
 
-            self.writer.end("measure")
-        self.writer.end("part")
-        self.writer.end(structure)
+        self.writer.end("measure")
+        if cacheable:
+            fragment = partOutput.recorder.stopRecording()
+            if partOutput.fragmentBytes+len(fragment) <= partOutput.fragmentCacheSize:
+                partOutput.fragments[position] = fragment.split(str(index+1),1)
+                partOutput.fragmentBytes += len(fragment)
+        file.flush()
+    def getBytes(self,measures=None,compressed=False):
+        """
+        :return: the song as MusicXML (or .mxl, if compressed) in a str, without going through a file
+        """
+        buffer = StringIO()
+        self.write(buffer,measures,compressed)
+        return buffer.getvalue()
     def writeNoteXML(self,note_s,staffNumber,tied = None):
         """
         This can output XML for either a note or a chord.
@@ -121,7 +282,7 @@ class MusicXMLWriter:
             else:
                 self.writer.element("octave",str(n.pitch.octave))
             self.writer.end("pitch")
-            self.writer.element("duration",str(n.duration*self.divisions))
+            self.writer.element("duration",str(n.ticks))
 
             if(tied == "start" or n.tie == "start"):
                 self.writer.start("notations")
@@ -131,18 +292,21 @@ class MusicXMLWriter:
                 self.writer.start("notations")
                 self.writer.element("tied",None,{"type":"stop"})
                 self.writer.end("notations")
-            nextNote = self.song.get_measure_at_index(self.currentMeasureIndex).get_note_at_beat(self.currentBeat+n.duration)
-            last_note_measure_change = int(math.floor((self.currentBeat-0.25)/4))
-            last_beat = (self.song.beats_per_measure+self.currentBeat-0.25) % self.song.beats_per_measure
-            lastNote = self.song.get_measure_at_index(last_note_measure_change).get_note_at_beat(last_beat)#I think this works...
+            nextNote = self.currentMeasure.get_note_at_tick(self.currentTick+n.ticks)
+            if self.currentTick > 0:
+                lastNote = self.currentMeasure.get_note_at_tick(self.currentTick-1)
+            elif self.lastMeasure is not None:
+                lastNote = self.lastMeasure.get_note_at_tick(self.lastMeasure.ticks-1)
+            else:
+                lastNote = None
             #The conditionals below are only self detecting for eighth notes, if parameter "beam" is None
             if n is None:
                 brk = 0
             """
-            if n.type == "eighth" and self.currentBeat % 1 == 0 and nextNote is not None and tied is None:
+            if n.type == "eighth" and self.currentTick % PPQ == 0 and nextNote is not None and tied is None:
                 if nextNote.type == "eighth":
                     self.writer.element("beam","begin")
-            elif n.type == "eighth" and self.currentBeat % 1 == 0.5 and lastNote.type == "eighth"  and tied is None: #lastNote NULL???
+            elif n.type == "eighth" and self.currentTick % PPQ == EIGHTH_TICKS and lastNote.type == "eighth"  and tied is None: #lastNote NULL???
                 self.writer.element("beam","end")
             """
             self.writer.element("type",n.type)
@@ -153,7 +317,7 @@ class MusicXMLWriter:
             if(i > 0):
                 self.writer.element("chord")
             self.writer.end("note")
-        self.currentBeat += note_s[0].duration
+        self.currentTick += note_s[0].ticks
 
 
     def writeChordSymbol(self,chord):
@@ -169,8 +333,8 @@ class MusicXMLWriter:
         self.writer.element("kind","none",{"text":typeText})
         self.writer.end("harmony")
     def splitDottedHalf(self,note):
-        firstEighth = Note(Pitch(note.pitch.value,self.song.key),0.5)
-        secondQuarter = Note(Pitch(note.pitch.value,self.song.key),note.duration-0.5)
+        firstEighth = Note.from_ticks(Pitch(note.pitch.value,self.song.key),EIGHTH_TICKS)
+        secondQuarter = Note.from_ticks(Pitch(note.pitch.value,self.song.key),note.ticks-EIGHTH_TICKS)
         return [firstEighth,secondQuarter]
         
 